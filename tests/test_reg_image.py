@@ -268,6 +268,23 @@ def test_reg_image_loader_to_itk(im_gry_np, mask_np):
     assert reg_image.mask.GetSpacing() == (0.65, 0.65)
 
 
+@pytest.mark.usefixtures("im_gry_np", "mask_np")
+def test_reg_image_loader_to_itk_twice(im_gry_np, mask_np):
+    reg_image = reg_image_loader(im_gry_np, 0.65, mask=mask_np)
+    reg_image.read_reg_image()
+    pixel_id = reg_image.reg_image.GetPixelID()
+    reg_image.reg_image_sitk_to_itk(cast_to_float32=False)
+    assert reg_image.reg_image_pixel_id == pixel_id
+    assert itk.template(reg_image.reg_image)[1][0] != itk.F
+
+    reg_image.reg_image_sitk_to_itk(cast_to_float32=True)
+    assert isinstance(reg_image.reg_image, itk.Image) is True
+    assert itk.template(reg_image.reg_image)[1][0] == itk.F
+    assert reg_image.reg_image_pixel_id == pixel_id
+    assert reg_image.reg_image.GetSpacing() == (0.65, 0.65)
+    assert isinstance(reg_image.mask, itk.Image) is True
+
+
 @pytest.mark.usefixtures("im_gry_np", "mask_geojson")
 def test_gj_reg_image_loader_mask(im_gry_np, mask_geojson):
     reg_image = reg_image_loader(im_gry_np, 0.65, mask=mask_geojson)
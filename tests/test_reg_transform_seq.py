@@ -1,9 +1,19 @@
+import json
 import os
 from pathlib import Path
 
+import numpy as np
 import pytest
 
+from wsireg.reg_transforms.reg_transform import RegTransform
 from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
+from wsireg.utils.shape_utils import invert_nonrigid_transforms
+from wsireg.utils.tform_utils import (
+    collapse_linear_transforms,
+    read_wsireg_transform_npz,
+    transform_pts_batch,
+    write_wsireg_transform_npz,
+)
 
 HERE = os.path.dirname(__file__)
 FIXTURES_DIR = os.path.join(HERE, "fixtures")
@@ -83,3 +93,282 @@ def test_RegTransformSeq_append():
 
     assert len(rts_1.reg_transforms) == 6
     assert rts_1.transform_seq_idx == [0, 1, 1, 2, 3, 3]
+
+
+def test_collapse_linear_transforms():
+    test_tform = str(Path(FIXTURES_DIR) / "test-tform.json")
+    rts = RegTransformSeq(test_tform)
+    collapsed = collapse_linear_transforms(rts.reg_transforms_itk_order)
+    rts_collapsed = RegTransformSeq(
+        collapsed, transform_seq_idx=list(range(len(collapsed)))
+    )
+
+    assert len(collapsed) == 4
+    assert rts_collapsed.output_size == rts.output_size
+
+    pts = np.random.uniform(0, 5000, (50, 2))
+    pts_seq = [rts.composite_transform.TransformPoint(pt) for pt in pts]
+    pts_collapsed = [
+        rts_collapsed.composite_transform.TransformPoint(pt) for pt in pts
+    ]
+    np.testing.assert_allclose(pts_seq, pts_collapsed, atol=1e-6)
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_RegTransformSeq_transform_points_batch(simple_transform_affine_nl):
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    invert_nonrigid_transforms(rts.reg_transforms)
+    assert any(
+        t.inverse_transform.GetName() == "DisplacementFieldTransform"
+        for t in rts.reg_transforms
+    )
+
+    pts = np.random.uniform(-50, 3200, (500, 2))
+    tformed_pts = rts.transform_points(pts, px_idx=False, output_idx=False)
+
+    # reference: point-by-point through each SimpleITK transform
+    ref_pts = []
+    for pt in pts:
+        for t in rts.reg_transforms_itk_order:
+            pt = t.inverse_transform.TransformPoint(pt)
+        ref_pts.append(pt)
+
+    np.testing.assert_allclose(tformed_pts, ref_pts, atol=1e-6)
+
+
+def test_RegTransformSeq_transform_points_no_inplace(simple_transform_affine):
+    pts = np.random.uniform(0, 1000, (100, 2))
+    pts_orig = pts.copy()
+
+    tformed_pts = transform_pts_batch(pts, [])
+    assert not np.shares_memory(tformed_pts, pts)
+    tformed_pts *= 2
+    np.testing.assert_array_equal(pts, pts_orig)
+
+    rts = RegTransformSeq(simple_transform_affine)
+    rts.transform_points(pts, px_idx=False, output_idx=True)
+    np.testing.assert_array_equal(pts, pts_orig)
+
+
+def test_RegTransformSeq_simplified_composite():
+    test_tform = str(Path(FIXTURES_DIR) / "test-tform.json")
+    rts = RegTransformSeq(test_tform)
+
+    assert len(rts.reg_transforms_simplified) == 4
+    assert rts.composite_transform.GetNumberOfTransforms() == 4
+
+    # the simplified composite evaluates to the full chain
+    pts = np.random.uniform(0, 5000, (50, 2))
+    pts_simplified = [rts.composite_transform.TransformPoint(pt) for pt in pts]
+    pts_full = []
+    for pt in pts:
+        for t in rts.reg_transforms_itk_order[::-1]:
+            pt = t.itk_transform.TransformPoint(pt)
+        pts_full.append(pt)
+    np.testing.assert_allclose(pts_simplified, pts_full, atol=1e-6)
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_RegTransformSeq_bake_displacement_field(
+    simple_transform_affine_nl, tmp_path
+):
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    pts = np.random.uniform(0, 2000, (50, 2))
+    pts_full = [rts.composite_transform.TransformPoint(pt) for pt in pts]
+
+    zarr_path = tmp_path / "dfield.zarr"
+    rts_baked, max_error = rts.bake_displacement_field(
+        grid_factor=4, zarr_path=zarr_path
+    )
+    assert max_error < 0.1
+    assert zarr_path.exists()
+
+    pts_baked = [
+        rts_baked.composite_transform.TransformPoint(pt) for pt in pts
+    ]
+    np.testing.assert_allclose(pts_baked, pts_full, atol=0.1)
+
+    # the baked sequence is a copy, the original keeps the exact transforms
+    assert rts_baked is not rts
+    assert rts.composite_transform.GetNumberOfTransforms() > 1
+    np.testing.assert_array_equal(
+        [rts.composite_transform.TransformPoint(pt) for pt in pts], pts_full
+    )
+
+    # reloaded from the zarr store, the check points are reproducible
+    rts_reload = RegTransformSeq(simple_transform_affine_nl)
+    assert rts_reload.transforms_digest == rts.transforms_digest
+    rts_reload_baked, max_error_reload = rts_reload.bake_displacement_field(
+        grid_factor=4, zarr_path=zarr_path
+    )
+    assert max_error_reload == max_error
+    pts_reload = [
+        rts_reload_baked.composite_transform.TransformPoint(pt) for pt in pts
+    ]
+    np.testing.assert_allclose(pts_reload, pts_baked)
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_RegTransform_inverse_nonlinear_coarse(simple_transform_affine_nl):
+    bspline_tform = [
+        t
+        for v in simple_transform_affine_nl.values()
+        for t in (v if isinstance(v, list) else [v])
+        if t["Transform"][0] == "BSplineTransform"
+    ][0]
+    # moderate deformation
+    bspline_tform["TransformParameters"] = [
+        str(float(p) * 0.05) for p in bspline_tform["TransformParameters"]
+    ]
+    rt = RegTransform(bspline_tform)
+    inverse_residual = rt.compute_inverse_nonlinear(
+        grid_factor=4, n_check_pts=1000
+    )
+
+    assert rt.inverse_transform.GetName() == "DisplacementFieldTransform"
+    assert rt.inverse_residual == inverse_residual
+    assert inverse_residual["mean"] < 0.5
+    assert inverse_residual["max"] >= inverse_residual["mean"]
+
+    # the check points are drawn with a fixed seed
+    assert (
+        RegTransform(bspline_tform).compute_inverse_nonlinear(
+            grid_factor=4, n_check_pts=1000
+        )
+        == inverse_residual
+    )
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_RegTransform_inverse_nonlinear_default(simple_transform_affine_nl):
+    bspline_tform = [
+        t
+        for v in simple_transform_affine_nl.values()
+        for t in (v if isinstance(v, list) else [v])
+        if t["Transform"][0] == "BSplineTransform"
+    ][0]
+    bspline_tform["Size"] = ["512", "384"]
+    rt = RegTransform(bspline_tform)
+
+    # no residual check and a field no larger than the output grid by default
+    assert rt.compute_inverse_nonlinear() is None
+    assert rt.inverse_residual is None
+    assert (
+        list(rt.inverse_transform.GetDisplacementField().GetSize())
+        == rt.output_size
+    )
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_RegTransform_inverse_nonlinear_edges(simple_transform_affine_nl):
+    bspline_tform = [
+        t
+        for v in simple_transform_affine_nl.values()
+        for t in (v if isinstance(v, list) else [v])
+        if t["Transform"][0] == "BSplineTransform"
+    ][0]
+    # smooth deformation displacing points beyond the output edges
+    grid_x, grid_y = np.meshgrid(np.arange(34), np.arange(24))
+    bspline_tform["GridOrigin"] = ["-200", "-200"]
+    bspline_tform["GridSpacing"] = ["120", "120"]
+    bspline_tform["TransformParameters"] = [
+        str(p)
+        for p in np.concatenate(
+            [
+                3 + np.sin(grid_x.ravel() / 3),
+                -2 + np.cos(grid_y.ravel() / 3),
+            ]
+        )
+    ]
+    grid_factor = 8
+    rt = RegTransform(bspline_tform)
+    rt.compute_inverse_nonlinear(grid_factor=grid_factor)
+
+    # points within grid_factor px of the output edges
+    origin = np.asarray(rt.output_origin)
+    spacing = np.asarray(rt.output_spacing)
+    extent = origin + np.asarray(rt.output_size) * spacing
+    edge_dist = np.random.uniform(0, grid_factor, 300) * spacing[0]
+    along = np.random.uniform(0, 1, 300)
+    pts = np.concatenate(
+        [
+            np.column_stack(
+                [
+                    origin[0] + along * (extent[0] - origin[0]),
+                    origin[1] + edge_dist,
+                ]
+            ),
+            np.column_stack(
+                [
+                    origin[0] + along * (extent[0] - origin[0]),
+                    extent[1] - edge_dist,
+                ]
+            ),
+            np.column_stack(
+                [
+                    origin[0] + edge_dist,
+                    origin[1] + along * (extent[1] - origin[1]),
+                ]
+            ),
+            np.column_stack(
+                [
+                    extent[0] - edge_dist,
+                    origin[1] + along * (extent[1] - origin[1]),
+                ]
+            ),
+        ]
+    )
+    residuals = [
+        np.linalg.norm(
+            np.asarray(
+                rt.itk_transform.TransformPoint(
+                    rt.inverse_transform.TransformPoint(tuple(pt))
+                )
+            )
+            - pt
+        )
+        for pt in pts
+    ]
+    assert np.max(residuals) < 0.1
+
+
+def test_RegTransformSeq_from_npz(tmp_path):
+    test_tform = str(Path(FIXTURES_DIR) / "test-tform.json")
+    tform_data = json.load(open(test_tform, "r"))
+    npz_fp = write_wsireg_transform_npz(
+        tform_data, tmp_path / "test-tform.npz"
+    )
+
+    rts_json = RegTransformSeq(test_tform)
+    rts_npz = RegTransformSeq(npz_fp)
+
+    assert len(rts_npz.reg_transforms) == len(rts_json.reg_transforms)
+    assert rts_npz.transform_seq_idx == rts_json.transform_seq_idx
+    assert isinstance(
+        rts_npz.reg_transforms[0].elastix_transform["TransformParameters"],
+        np.ndarray,
+    )
+
+    pts = np.random.uniform(0, 2048, (100, 2)).tolist()
+    np.testing.assert_allclose(
+        [rts_npz.composite_transform.TransformPoint(pt) for pt in pts],
+        [rts_json.composite_transform.TransformPoint(pt) for pt in pts],
+    )
+    assert (
+        rts_npz.reg_transforms[0]
+        .elastix_transform["TransformParameters"]
+        .dtype
+        == np.float64
+    )
+
+    # parameters are memory-mapped and only read when used
+    tform_data_npz = read_wsireg_transform_npz(npz_fp)
+    for key, tforms in tform_data_npz.items():
+        for idx, tform in enumerate(tforms):
+            assert isinstance(tform["TransformParameters"], np.memmap)
+            np.testing.assert_array_equal(
+                tform["TransformParameters"],
+                np.asarray(
+                    tform_data[key][idx]["TransformParameters"], dtype=float
+                ),
+            )
@@ -2,18 +2,40 @@ from pathlib import Path
 import os
 import random
 import string
+import time
+import weakref
 
 import numpy as np
 import pytest
-from tifffile import imread
+import SimpleITK as sitk
+from tifffile import TiffFile, imread
 import dask.array as da
+import zarr
 
 from wsireg.reg_images.loader import reg_image_loader
 from wsireg.reg_images.merge_reg_image import MergeRegImage
 from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
+from wsireg.utils import resource_utils
+from wsireg.utils.cache_utils import ChunkCache
+from wsireg.utils.resource_utils import (
+    get_memory_limit,
+    set_resource_limits,
+)
+from wsireg.utils.writer_utils import (
+    choose_file_writer,
+    choose_merge_file_writer,
+    estimate_plane_writer_memory,
+    estimate_tile_writer_memory,
+)
 from wsireg.writers.merge_ome_tiff_writer import MergeOmeTiffWriter
 from wsireg.writers.ome_tiff_writer import OmeTiffWriter
-from wsireg.writers.tiled_ome_tiff_writer import OmeTiffTiledWriter
+from wsireg.writers.ome_zarr_writer import OmeZarrWriter
+from wsireg.writers.tiled_ome_tiff_writer import (
+    OmeTiffTiledWriter,
+    allocate_pyramid_level,
+    hilbert_index,
+    registered_dask_array,
+)
 
 HERE = os.path.dirname(__file__)
 TFORM_FP = os.path.join(HERE, "fixtures/complex_linear_reg_transform.json")
@@ -337,3 +359,886 @@ def test_MergeOmeTiffWriter_mix_merge(simple_transform_affine_nl, tmp_path):
     im_plane = imread(by_plane_fp)
 
     assert im_plane.shape[0] == 9
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_registered_dask_array_mc(simple_transform_affine_nl, tmp_path):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (3, 1024, 1024), dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    ometiffwriter = OmeTiffWriter(reg_image, reg_transform_seq=rts)
+    by_plane_fp = ometiffwriter.write_image_by_plane(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+    )
+    im_plane = imread(by_plane_fp)
+
+    registered_image = registered_dask_array(reg_image, rts, chunk_size=256)
+
+    assert isinstance(registered_image, da.Array)
+    assert registered_image.shape == im_plane.shape
+    assert registered_image.chunksize == (1, 256, 256)
+    assert np.array_equal(
+        registered_image[1, 300:700, 100:900].compute(),
+        im_plane[1, 300:700, 100:900],
+    )
+    assert np.array_equal(registered_image.compute(), im_plane)
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_registered_dask_array_compare_tile(
+    simple_transform_affine_nl, tmp_path
+):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (1024, 1024, 3), dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    ometiletiffwriter = OmeTiffTiledWriter(
+        reg_image, reg_transform_seq=rts, zarr_tile_size=1024
+    )
+    by_tile_fp = ometiletiffwriter.write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        zarr_temp_dir=tmp_path,
+        compression=None,
+    )
+    im_tile = imread(by_tile_fp)
+
+    registered_image = ometiletiffwriter.to_dask_array()
+
+    assert registered_image.chunksize == (1024, 1024, 3)
+    assert np.array_equal(registered_image.compute(), im_tile)
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+@pytest.mark.parametrize("is_rgb", [False, True])
+def test_OmeTiffTiledWriter_stream(
+    simple_transform_affine_nl, is_rgb, tmp_path
+):
+    im_shape = (1024, 1024, 3) if is_rgb else (3, 1024, 1024)
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, im_shape, dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    ometiletiffwriter = OmeTiffTiledWriter(reg_image, reg_transform_seq=rts)
+
+    by_tile_fp = ometiletiffwriter.write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        zarr_temp_dir=tmp_path,
+        compression=None,
+    )
+    stream_fp = ometiletiffwriter.write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        compression=None,
+        stream=True,
+    )
+
+    with TiffFile(by_tile_fp) as tif_tile, TiffFile(stream_fp) as tif_stream:
+        levels_tile = tif_tile.series[0].levels
+        levels_stream = tif_stream.series[0].levels
+        assert len(levels_tile) == len(levels_stream) > 1
+        for level_tile, level_stream in zip(levels_tile, levels_stream):
+            assert np.array_equal(level_tile.asarray(), level_stream.asarray())
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_OmeTiffTiledWriter_stream_all_channels(
+    simple_transform_affine_nl, tmp_path, monkeypatch
+):
+    reg_image = reg_image_loader(
+        np.random.randint(1, 255, (3, 1024, 1024), dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    ometiletiffwriter = OmeTiffTiledWriter(
+        reg_image, reg_transform_seq=rts, tile_size=256
+    )
+
+    # the transform is evaluated and the moving footprint read once per tile
+    field_evaluations = []
+    region_reads = []
+    tile_displacement_field = OmeTiffTiledWriter._tile_displacement_field
+    read_moving_region = OmeTiffTiledWriter._read_moving_region
+
+    def tracked_tile_displacement_field(self, tile_origin, tile_size=None):
+        field_evaluations.append(tile_origin)
+        return tile_displacement_field(self, tile_origin, tile_size=tile_size)
+
+    def tracked_read_moving_region(self, ch_idx, *region):
+        region_reads.append(ch_idx)
+        return read_moving_region(self, ch_idx, *region)
+
+    monkeypatch.setattr(
+        OmeTiffTiledWriter,
+        "_tile_displacement_field",
+        tracked_tile_displacement_field,
+    )
+    monkeypatch.setattr(
+        OmeTiffTiledWriter, "_read_moving_region", tracked_read_moving_region
+    )
+
+    stream_fp = ometiletiffwriter.write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        compression=None,
+        stream=True,
+    )
+
+    n_tiles = len(ometiletiffwriter._output_tile_positions())
+    assert 0 < len(field_evaluations) <= n_tiles
+    assert len(set(field_evaluations)) == len(field_evaluations)
+    assert region_reads == [None] * len(field_evaluations)
+
+    monkeypatch.undo()
+    by_plane_fp = OmeTiffWriter(
+        reg_image, reg_transform_seq=rts
+    ).write_image_by_plane(
+        gen_project_name_str(), output_dir=str(tmp_path), compression=None
+    )
+    np.testing.assert_allclose(
+        imread(stream_fp).astype(int), imread(by_plane_fp).astype(int), atol=1
+    )
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_OmeTiffTiledWriter_compare_tile_plane_high_freq_nl(
+    simple_transform_affine_nl, tmp_path
+):
+    bspline_tform = [
+        t
+        for v in simple_transform_affine_nl.values()
+        for t in (v if isinstance(v, list) else [v])
+        if t["Transform"][0] == "BSplineTransform"
+    ][0]
+    # a narrow bump on the boundary between two output tiles, between the points of the
+    # footprint sampling grid, pushing the left tile into the moving pixels of the right one
+    grid_size = 1024 // 8 + 7
+    params = np.zeros((2, grid_size, grid_size))
+    params[0, 7, 67] = 40
+    bspline_tform.update(
+        GridSize=[str(grid_size)] * 2,
+        GridSpacing=["8", "8"],
+        GridOrigin=["-24", "-24"],
+        NumberOfParameters=[str(params.size)],
+        Size=["1024", "1024"],
+        TransformParameters=[str(p) for p in params.ravel()],
+    )
+    rts = RegTransformSeq({"nl": [bspline_tform]})
+    assert rts.composite_transform.TransformPoint((511.0, 32.0))[0] > 520
+
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (1, 1024, 1024), dtype=np.uint8), 1
+    )
+    ometiletiffwriter = OmeTiffTiledWriter(reg_image, reg_transform_seq=rts)
+    ometiffwriter = OmeTiffWriter(reg_image, reg_transform_seq=rts)
+
+    by_tile_fp = ometiletiffwriter.write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        stream=True,
+    )
+    by_plane_fp = ometiffwriter.write_image_by_plane(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+    )
+
+    assert np.array_equal(imread(by_tile_fp), imread(by_plane_fp))
+
+
+@pytest.mark.usefixtures(
+    "simple_transform_affine", "simple_transform_affine_nl"
+)
+def test_OmeTiffTiledWriter_tile_displacement_field(
+    simple_transform_affine, simple_transform_affine_nl
+):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint8), 1
+    )
+    tile_size = (256, 256)
+    field_bytes = 2048 * 2048 * 2 * 8
+
+    # linear sequences are resampled with their composite transform
+    linear_writer = OmeTiffTiledWriter(
+        reg_image, reg_transform_seq=RegTransformSeq(simple_transform_affine)
+    )
+    assert linear_writer._tile_displacement_field((0, 0), tile_size) is None
+    moving_areas = [
+        np.prod(np.abs(mt_pos[1] - mt_pos[0]))
+        for mt_pos in linear_writer.moving_tile_positions
+    ]
+    assert linear_writer.tile_memory_estimate() == int(
+        (max(moving_areas) + 2048 * 2048) * 2 * 4
+    )
+
+    nl_writer = OmeTiffTiledWriter(
+        reg_image,
+        reg_transform_seq=RegTransformSeq(simple_transform_affine_nl),
+    )
+    field = nl_writer._tile_displacement_field((0, 0), tile_size)
+    assert field.GetName() == "DisplacementFieldTransform"
+    moving_areas = [
+        np.prod(np.abs(mt_pos[1] - mt_pos[0]))
+        for mt_pos in nl_writer.moving_tile_positions
+    ]
+    assert nl_writer.tile_memory_estimate() == int(
+        (max(moving_areas) + 2048 * 2048) * 2 * 4 + field_bytes
+    )
+
+
+def test_ChunkCache_read_region():
+    image = da.from_array(
+        np.random.randint(0, 255, (3, 700, 900), dtype=np.uint8),
+        chunks=(1, 256, 256),
+    )
+    chunk_nbytes = 256 * 256
+    cache = ChunkCache(image, max_bytes=8 * chunk_nbytes)
+
+    region = (slice(1, 3), slice(100, 600), slice(250, 900))
+    np.testing.assert_array_equal(
+        cache.read_region(region), image[region].compute()
+    )
+    n_chunks = 2 * 3 * 4
+    assert cache.stats()["misses"] == n_chunks
+    assert cache.n_bytes <= 8 * chunk_nbytes
+    assert cache.stats()["evictions"] > 0
+
+    region = (slice(0, 1), slice(0, 200), slice(0, 200))
+    cache.read_region(region)
+    cache.read_region(region)
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == n_chunks + 1
+
+
+def test_ChunkCache_channel_axis():
+    image = da.from_array(
+        np.random.randint(0, 255, (3, 700, 900), dtype=np.uint8),
+        chunks=(3, 256, 256),
+    )
+    channel_nbytes = 256 * 256
+    cache = ChunkCache(image, max_bytes=18 * channel_nbytes, channel_axis=0)
+    assert cache.max_chunk_bytes == channel_nbytes
+
+    region = (slice(1, 2), slice(100, 600), slice(250, 500))
+    np.testing.assert_array_equal(
+        cache.read_region(region), image[region].compute()
+    )
+    stats = cache.stats()
+    assert stats["misses"] == 3 * 2
+    assert stats["n_bytes"] == 700 * 512
+    assert stats["uncached"] == 0
+
+    region = (slice(0, 3), slice(100, 600), slice(250, 500))
+    np.testing.assert_array_equal(
+        cache.read_region(region), image[region].compute()
+    )
+    stats = cache.stats()
+    assert stats["hits"] == 3 * 2
+    assert stats["misses"] == 3 * 3 * 2
+
+    cache = ChunkCache(image, max_bytes=channel_nbytes // 2)
+    cache.read_region(region)
+    cache.read_region(region)
+    stats = cache.stats()
+    assert stats["hits"] == 0
+    assert stats["uncached"] == stats["misses"]
+    assert "exceed the cache size" in cache.summary()
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_OmeTiffTiledWriter_chunk_cache(simple_transform_affine_nl, tmp_path):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+
+    im_fps = []
+    for chunk_cache_bytes in [None, 0]:
+        ometiletiffwriter = OmeTiffTiledWriter(
+            reg_image,
+            reg_transform_seq=rts,
+            chunk_cache_bytes=chunk_cache_bytes,
+        )
+        im_fps.append(
+            ometiletiffwriter.write_image_by_tile(
+                gen_project_name_str(),
+                output_dir=str(tmp_path),
+                stream=True,
+            )
+        )
+        if chunk_cache_bytes is None:
+            assert ometiletiffwriter.chunk_cache.stats()["hits"] > 0
+        else:
+            assert ometiletiffwriter.chunk_cache is None
+
+    assert np.array_equal(imread(im_fps[0]), imread(im_fps[1]))
+
+
+def test_hilbert_index():
+    yy, xx = np.mgrid[0:8, 0:8]
+    distances = hilbert_index(xx.ravel(), yy.ravel(), 3)
+    assert np.array_equal(np.sort(distances), np.arange(64))
+
+    curve_order = np.argsort(distances)
+    cells = np.stack([xx.ravel()[curve_order], yy.ravel()[curve_order]], 1)
+    assert np.all(np.abs(np.diff(cells, axis=0)).sum(axis=1) == 1)
+
+
+def test_allocate_pyramid_level(tmp_path, monkeypatch):
+    # without a memory budget, large levels are memory-mapped against half of the
+    # physical memory
+    monkeypatch.setattr(
+        resource_utils, "get_system_memory", lambda: 4 * 1024**2
+    )
+    previous_memory_limit = get_memory_limit()
+    set_resource_limits(memory_limit=None)
+    try:
+        level = allocate_pyramid_level((512, 512), np.uint8, temp_dir=tmp_path)
+        assert type(level) is np.ndarray
+
+        level = allocate_pyramid_level(
+            (2048, 1024), np.uint8, temp_dir=tmp_path
+        )
+        assert isinstance(level, np.memmap)
+        assert Path(level.temp_file.name).parent == tmp_path
+        level[-1, -1] = 1
+        del level
+        assert len(list(tmp_path.iterdir())) == 0
+
+        set_resource_limits(memory_limit="64MB")
+        level = allocate_pyramid_level(
+            (2048, 1024), np.uint8, temp_dir=tmp_path
+        )
+        assert type(level) is np.ndarray
+    finally:
+        set_resource_limits(memory_limit=previous_memory_limit)
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_OmeTiffTiledWriter_tile_schedule(simple_transform_affine_nl):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (1, 2048, 2048), dtype=np.uint8), 1
+    )
+    chunk_size = 128
+    reg_image._dask_image = reg_image.dask_image.rechunk(
+        (1, chunk_size, chunk_size)
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    # the cache holds the chunks of a few footprints but not of a row of tiles
+    ometiletiffwriter = OmeTiffTiledWriter(
+        reg_image,
+        reg_transform_seq=rts,
+        chunk_cache_bytes=32 * chunk_size**2,
+    )
+    ometiletiffwriter.set_zarr_tile_size(256)
+
+    tile_schedule = ometiletiffwriter._tile_schedule()
+    n_tiles = len(ometiletiffwriter.fixed_tile_positions)
+    assert sorted(tile_schedule) == list(range(n_tiles))
+
+    # reading the moving footprints in schedule order decodes fewer chunks than row-major
+    x_size, y_size = ometiletiffwriter._get_image_size()
+    chunk_misses = []
+    for tile_order in [range(n_tiles), tile_schedule]:
+        ometiletiffwriter.chunk_cache.clear()
+        for tile_idx in tile_order:
+            (
+                x_max,
+                x_min,
+                y_max,
+                y_min,
+            ) = ometiletiffwriter._get_moving_tile_slice(
+                ometiletiffwriter.moving_tile_positions[tile_idx],
+                x_size,
+                y_size,
+            )
+            if x_min < x_max and y_min < y_max:
+                ometiletiffwriter._read_moving_region(
+                    0, x_max, x_min, y_max, y_min
+                )
+        chunk_misses.append(ometiletiffwriter.chunk_cache.stats()["misses"])
+    row_major_misses, schedule_misses = chunk_misses
+    assert schedule_misses < 0.8 * row_major_misses
+
+
+@pytest.mark.usefixtures("simple_transform_affine_nl")
+def test_OmeTiffTiledWriter_stream_tile_schedule(
+    simple_transform_affine_nl, monkeypatch
+):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (1, 2048, 2048), dtype=np.uint8), 1
+    )
+    chunk_size = 256
+    reg_image._dask_image = reg_image.dask_image.rechunk(
+        (1, chunk_size, chunk_size)
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+
+    def streamed_strips_and_misses(chunk_cache_chunks):
+        ometiletiffwriter = OmeTiffTiledWriter(
+            reg_image,
+            reg_transform_seq=rts,
+            tile_size=128,
+            chunk_cache_bytes=chunk_cache_chunks * chunk_size**2,
+        )
+        strips = np.concatenate(
+            list(ometiletiffwriter.strip_generator(0, max_workers=1))
+        )
+        return (
+            ometiletiffwriter.tile_band_rows(),
+            strips,
+            ometiletiffwriter.chunk_cache.stats()["misses"],
+        )
+
+    # the cache cannot hold the chunks of a row of tiles, bands of rows are
+    # resampled along the schedule and decode fewer chunks than rows in order
+    band_rows, schedule_strips, schedule_misses = streamed_strips_and_misses(8)
+    assert band_rows == 2
+    # a cache holding a row of tiles keeps the rows in order
+    assert streamed_strips_and_misses(64)[0] == 1
+
+    monkeypatch.setattr(
+        OmeTiffTiledWriter,
+        "_output_tile_schedule",
+        lambda self, tile_positions: list(range(len(tile_positions))),
+    )
+    _, row_major_strips, row_major_misses = streamed_strips_and_misses(8)
+
+    assert np.array_equal(schedule_strips, row_major_strips)
+    assert schedule_misses < 0.9 * row_major_misses
+
+
+@pytest.mark.parametrize("is_rgb", [False, True])
+def test_OmeZarrWriter(simple_transform_affine_nl, is_rgb, tmp_path):
+    im_shape = (1024, 1024, 3) if is_rgb else (2, 1024, 1024)
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, im_shape, dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+
+    zarr_fp = OmeZarrWriter(
+        reg_image, reg_transform_seq=rts, tile_size=256
+    ).write_image(gen_project_name_str(), output_dir=str(tmp_path))
+    stream_fp = OmeTiffTiledWriter(
+        reg_image, reg_transform_seq=rts, tile_size=256
+    ).write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        compression=None,
+        stream=True,
+    )
+
+    zgrp = zarr.open(zarr_fp, mode="r")
+    multiscales = zgrp.attrs["multiscales"][0]
+    assert [ax["name"] for ax in multiscales["axes"]] == ["c", "y", "x"]
+    assert (
+        len(zgrp.attrs["omero"]["channels"]) == im_shape[-1 if is_rgb else 0]
+    )
+
+    with TiffFile(stream_fp) as tif_stream:
+        levels_stream = tif_stream.series[0].levels
+        assert len(multiscales["datasets"]) == len(levels_stream) > 1
+        for pyr_idx, (dataset, level_stream) in enumerate(
+            zip(multiscales["datasets"], levels_stream)
+        ):
+            level_stream = level_stream.asarray()
+            if is_rgb:
+                level_stream = np.moveaxis(level_stream, -1, 0)
+            assert np.array_equal(zgrp[dataset["path"]][:], level_stream)
+            assert dataset["coordinateTransformations"][0]["scale"] == [
+                1.0,
+                rts.output_spacing[1] * 2**pyr_idx,
+                rts.output_spacing[0] * 2**pyr_idx,
+            ]
+
+
+def test_OmeTiffWriter_compression_workers(simple_transform_affine, tmp_path):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine)
+
+    by_plane_fps = [
+        OmeTiffWriter(reg_image, reg_transform_seq=rts).write_image_by_plane(
+            gen_project_name_str(),
+            output_dir=str(tmp_path),
+            tile_size=256,
+            compression_workers=compression_workers,
+        )
+        for compression_workers in [1, 4]
+    ]
+    stream_fps = [
+        OmeTiffTiledWriter(
+            reg_image, reg_transform_seq=rts
+        ).write_image_by_tile(
+            gen_project_name_str(),
+            output_dir=str(tmp_path),
+            stream=True,
+            compression_workers=compression_workers,
+        )
+        for compression_workers in [1, 4]
+    ]
+
+    for fps in [by_plane_fps, stream_fps]:
+        with TiffFile(fps[0]) as tif_single, TiffFile(fps[1]) as tif_multi:
+            levels_single = tif_single.series[0].levels
+            levels_multi = tif_multi.series[0].levels
+            assert len(levels_single) == len(levels_multi)
+            for level_single, level_multi in zip(levels_single, levels_multi):
+                assert np.array_equal(
+                    level_single.asarray(), level_multi.asarray()
+                )
+
+
+@pytest.mark.parametrize("is_rgb", [False, True])
+def test_OmeTiffTiledWriter_empty_tiles(
+    simple_transform_affine, is_rgb, tmp_path
+):
+    im_shape = (1024, 1024, 3) if is_rgb else (2, 1024, 1024)
+    image = np.random.randint(1, 255, im_shape, dtype=np.uint8)
+    if is_rgb:
+        image[:, :512] = 0
+    else:
+        image[:, :, :512] = 0
+    reg_image = reg_image_loader(image, 1)
+    rts = RegTransformSeq(simple_transform_affine)
+    ometiletiffwriter = OmeTiffTiledWriter(
+        reg_image, reg_transform_seq=rts, tile_size=256
+    )
+
+    im_fps = [
+        ometiletiffwriter.write_image_by_tile(
+            gen_project_name_str(),
+            output_dir=str(tmp_path),
+            compression=None,
+            stream=stream,
+        )
+        for stream in [False, True]
+    ]
+    by_plane_fp = OmeTiffWriter(
+        reg_image, reg_transform_seq=rts
+    ).write_image_by_plane(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        tile_size=256,
+        compression=None,
+        write_pyramid=False,
+    )
+    by_plane_image = imread(by_plane_fp)
+
+    for im_fp in im_fps:
+        with TiffFile(im_fp) as tif:
+            for level in tif.series[0].levels:
+                assert 0 in level.pages[0].databytecounts
+                assert max(level.pages[0].databytecounts) > 0
+        assert np.array_equal(imread(im_fp), by_plane_image)
+        assert np.array_equal(
+            reg_image_loader(im_fp, 1).dask_image.compute(),
+            by_plane_image,
+        )
+
+
+@pytest.mark.parametrize("is_rgb", [False, True])
+def test_OmeTiffWriter_by_plane_strip_pyramid(
+    simple_transform_affine_nl, is_rgb, tmp_path
+):
+    shape = (1024, 1024, 3) if is_rgb else (2, 1024, 1024)
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, shape, dtype=np.uint8), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+
+    by_plane_fp = OmeTiffWriter(
+        reg_image, reg_transform_seq=rts
+    ).write_image_by_plane(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        tile_size=256,
+        compression=None,
+    )
+    stream_fp = OmeTiffTiledWriter(
+        reg_image, reg_transform_seq=rts, tile_size=256
+    ).write_image_by_tile(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        compression=None,
+        stream=True,
+    )
+
+    with TiffFile(by_plane_fp) as tif_plane, TiffFile(stream_fp) as tif_stream:
+        levels_plane = tif_plane.series[0].levels
+        levels_stream = tif_stream.series[0].levels
+        assert len(levels_plane) == len(levels_stream) > 1
+        for level_plane, level_stream in zip(levels_plane, levels_stream):
+            assert np.array_equal(
+                level_plane.asarray(), level_stream.asarray()
+            )
+
+
+def test_MergeOmeTiffWriter_strip_pyramid(
+    simple_transform_affine_nl, tmp_path
+):
+    reg_image1 = np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint8)
+    reg_image2 = np.random.randint(0, 255, (1, 1024, 1024), dtype=np.uint8)
+    mreg_image = MergeRegImage(
+        [reg_image1, reg_image2],
+        [1, 1],
+        channel_names=[["1", "2"], ["1"]],
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+
+    merge_fp = MergeOmeTiffWriter(
+        mreg_image, reg_transform_seqs=[rts, rts]
+    ).merge_write_image_by_plane(
+        gen_project_name_str(),
+        ["1", "2"],
+        output_dir=str(tmp_path),
+        tile_size=256,
+        compression=None,
+    )
+    s1_fp = OmeTiffWriter(
+        reg_image_loader(reg_image1, 1), reg_transform_seq=rts
+    ).write_image_by_plane(
+        gen_project_name_str(),
+        output_dir=str(tmp_path),
+        tile_size=256,
+        compression=None,
+    )
+
+    with TiffFile(merge_fp) as tif_merge, TiffFile(s1_fp) as tif_s1:
+        levels_merge = tif_merge.series[0].levels
+        levels_s1 = tif_s1.series[0].levels
+        assert len(levels_merge) == len(levels_s1) > 1
+        for level_merge, level_s1 in zip(levels_merge, levels_s1):
+            im_merge = level_merge.asarray()
+            assert im_merge.shape[0] == 3
+            assert np.array_equal(im_merge[:2], level_s1.asarray())
+
+
+def test_MergeOmeTiffWriter_by_tile(
+    simple_transform_affine_nl, tmp_path, monkeypatch
+):
+    # tiles are resampled one channel, or RGB component, at a time
+    resampled_tile_dims = set()
+    resample_output_tile = OmeTiffTiledWriter._resample_output_tile
+
+    def tracked_resample_output_tile(self, ch_idx, fixed_tile_position):
+        tile = resample_output_tile(self, ch_idx, fixed_tile_position)
+        resampled_tile_dims.add(tile.ndim)
+        return tile
+
+    monkeypatch.setattr(
+        OmeTiffTiledWriter,
+        "_resample_output_tile",
+        tracked_resample_output_tile,
+    )
+
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    x_size, y_size = rts.output_size
+    images = [
+        np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint8),
+        np.random.randint(0, 255, (1024, 1024, 3), dtype=np.uint8),
+        np.random.randint(0, 4000, (1, y_size, x_size), dtype=np.uint16),
+    ]
+
+    merge_fps = []
+    for write_method in [
+        "merge_write_image_by_plane",
+        "merge_write_image_by_tile",
+    ]:
+        merge_ometiffwriter = MergeOmeTiffWriter(
+            MergeRegImage(images, [1, 1, 1]),
+            reg_transform_seqs=[rts, rts, None],
+        )
+        merge_fps.append(
+            getattr(merge_ometiffwriter, write_method)(
+                gen_project_name_str(),
+                ["1", "2", "3"],
+                output_dir=str(tmp_path),
+                tile_size=256,
+                compression=None,
+            )
+        )
+
+    with TiffFile(merge_fps[0]) as tif_plane, TiffFile(
+        merge_fps[1]
+    ) as tif_tile:
+        levels_plane = tif_plane.series[0].levels
+        levels_tile = tif_tile.series[0].levels
+        assert len(levels_plane) == len(levels_tile) > 1
+        assert levels_tile[0].shape == (6, y_size, x_size)
+        assert levels_tile[0].dtype == np.uint16
+        for level_plane, level_tile in zip(levels_plane, levels_tile):
+            assert np.array_equal(level_plane.asarray(), level_tile.asarray())
+    assert resampled_tile_dims == {2}
+
+
+def test_OmeTiffWriter_prefetch_channels(simple_transform_affine, tmp_path):
+    image = np.random.randint(0, 255, (4, 1024, 1024), dtype=np.uint8)
+    reg_image = reg_image_loader(image, 1)
+    rts = RegTransformSeq(simple_transform_affine)
+    ometiffwriter = OmeTiffWriter(reg_image, reg_transform_seq=rts)
+
+    assert ometiffwriter._prefetch_depth() == 1
+    assert ometiffwriter._prefetch_depth(10) == 3
+    with pytest.raises(ValueError):
+        ometiffwriter._prefetch_depth(-1)
+    # the plane being written, its sitk copy and the pyramid next to the prefetched planes
+    plane_bytes = 1024 * 1024
+    pyramid_bytes = int(np.prod(rts.output_size)) // 3
+    written_bytes = 2 * plane_bytes + pyramid_bytes
+    previous_memory_limit = get_memory_limit()
+    try:
+        # room for one plane read ahead
+        set_resource_limits(memory_limit=written_bytes + plane_bytes)
+        assert ometiffwriter._prefetch_depth(3) == 1
+        set_resource_limits(memory_limit=written_bytes + plane_bytes - 1)
+        assert ometiffwriter._prefetch_depth(3) == 0
+    finally:
+        set_resource_limits(memory_limit=previous_memory_limit)
+
+    prefetched = [
+        (channel_idx, sitk.GetArrayFromImage(plane))
+        for channel_idx, plane in ometiffwriter._prefetched_channels(2)
+    ]
+    assert [channel_idx for channel_idx, _ in prefetched] == [0, 1, 2, 3]
+    for channel_idx, plane in prefetched:
+        assert np.array_equal(plane, image[channel_idx])
+
+    # at most the yielded plane and the prefetched ones are alive at once
+    plane_refs = []
+    read_channel = ometiffwriter._read_channel
+
+    def tracked_read_channel(channel_idx):
+        plane = read_channel(channel_idx)
+        plane_refs.append(weakref.ref(plane))
+        return plane
+
+    ometiffwriter._read_channel = tracked_read_channel
+    max_planes_alive = 0
+    for _, plane in ometiffwriter._prefetched_channels(2):
+        time.sleep(0.1)
+        max_planes_alive = max(
+            max_planes_alive, sum(ref() is not None for ref in plane_refs)
+        )
+        del plane
+    del ometiffwriter._read_channel
+    assert max_planes_alive == 3
+
+    images = []
+    for prefetch_channels in [0, 2]:
+        im_fp = ometiffwriter.write_image_by_plane(
+            gen_project_name_str(),
+            output_dir=str(tmp_path),
+            tile_size=256,
+            prefetch_channels=prefetch_channels,
+        )
+        images.append(imread(im_fp))
+    assert np.array_equal(images[0], images[1])
+
+
+def test_choose_file_writer(simple_transform_affine_nl):
+    reg_image = reg_image_loader(
+        np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint16), 1
+    )
+    rts = RegTransformSeq(simple_transform_affine_nl)
+
+    plane_memory = estimate_plane_writer_memory(reg_image, rts)
+    tile_memory = estimate_tile_writer_memory(reg_image, rts, 512, 1)
+    assert plane_memory > 2 * 1024 * 1024 * 2
+
+    # small images are written plane-by-plane when there is enough memory
+    choice = choose_file_writer(reg_image, rts, memory_limit=2 * plane_memory)
+    assert choice.file_writer == "ome.tiff"
+    assert choice.tile_size == 512
+    assert choice.plane_memory == plane_memory
+
+    # plane-by-plane writing that does not fit the budget is written tile-by-tile
+    choice = choose_file_writer(
+        reg_image, rts, memory_limit=min(plane_memory, tile_memory) - 1
+    )
+    assert choice.file_writer == "ome.tiff-bytile"
+    assert choice.tile_size < 512
+    assert choice.zarr_tile_size % choice.tile_size == 0
+    OmeTiffTiledWriter(
+        reg_image,
+        rts,
+        tile_size=choice.tile_size,
+        zarr_tile_size=choice.zarr_tile_size,
+    )
+
+    # small tiles under a tight budget keep zarr tiles covering 2048 px chunks
+    chunked_image = reg_image_loader(
+        da.zeros((2, 6000, 6000), dtype=np.uint16, chunks=(2, 2048, 2048)), 1
+    )
+    linear_rts = RegTransformSeq(TFORM_FP)
+    choice = choose_file_writer(chunked_image, linear_rts, memory_limit=30e6)
+    assert choice.file_writer == "ome.tiff-bytile"
+    assert choice.tile_size < 512
+    assert choice.zarr_tile_size == 2048
+    OmeTiffTiledWriter(
+        chunked_image,
+        linear_rts,
+        tile_size=choice.tile_size,
+        zarr_tile_size=choice.zarr_tile_size,
+    )
+
+    # untransformed images are written plane-by-plane
+    assert choose_file_writer(reg_image, None).file_writer == "ome.tiff"
+
+    # outputs covering a small part of the input only read its footprint
+    large_image = reg_image_loader(
+        da.zeros((1, 8192, 8192), dtype=np.uint16, chunks=(1, 1024, 1024)), 1
+    )
+    choice = choose_file_writer(
+        large_image,
+        rts,
+        memory_limit=2 * estimate_plane_writer_memory(large_image, rts),
+    )
+    assert choice.file_writer == "ome.tiff-bytile"
+    assert choice.tile_size == 512
+
+
+def test_choose_merge_file_writer(simple_transform_affine_nl, capsys):
+    rts = RegTransformSeq(simple_transform_affine_nl)
+    small_image = reg_image_loader(
+        np.random.randint(0, 255, (1, 1024, 1024), dtype=np.uint8), 1
+    )
+    large_image = reg_image_loader(
+        np.random.randint(0, 255, (2, 1024, 1024), dtype=np.uint16), 1
+    )
+    small_plane_memory = estimate_plane_writer_memory(small_image, rts)
+    large_plane_memory = estimate_plane_writer_memory(large_image, rts)
+    assert small_plane_memory < large_plane_memory
+
+    # all sub-images fit plane-by-plane
+    choice = choose_merge_file_writer(
+        [small_image, large_image],
+        [rts, None],
+        memory_limit=2 * large_plane_memory,
+    )
+    assert choice.file_writer == "ome.tiff"
+    assert "merged image ome.tiff" in capsys.readouterr().out
+
+    # the smallest tile size chosen for the sub-images written tile-by-tile
+    memory_limit = large_plane_memory - 1
+    large_choice = choose_file_writer(large_image, rts, memory_limit)
+    assert large_choice.file_writer == "ome.tiff-bytile"
+    choice = choose_merge_file_writer(
+        [small_image, large_image], [rts, rts], memory_limit=memory_limit
+    )
+    assert choice.file_writer == "ome.tiff-bytile"
+    assert choice.tile_size == large_choice.tile_size
+    assert choice.zarr_tile_size == large_choice.zarr_tile_size
+    assert choice.plane_memory == large_plane_memory
+    assert "merged image ome.tiff-bytile" in capsys.readouterr().out
+
+    # plane-only readers are written plane-by-plane, even beyond the budget
+    large_image.reader = "sitk"
+    choice = choose_merge_file_writer(
+        [small_image, large_image], [rts, rts], memory_limit=memory_limit
+    )
+    assert choice.file_writer == "ome.tiff"
+    assert "exceeds the memory budget" in choice.reason
@@ -1,16 +1,34 @@
 import os
 import random
+from copy import deepcopy
 import string
+import tempfile
 from pathlib import Path
 
 import numpy as np
 import pytest
+import SimpleITK as sitk
 from ome_types import from_xml
 from tifffile import TiffFile, imread
 import dask
 
 from wsireg.parameter_maps.preprocessing import ImagePreproParams
+from wsireg.parameter_maps.reg_model import RegModel
 from wsireg.reg_images.loader import reg_image_loader
+from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
+from wsireg.utils.output_utils import read_iteration_npz
+from wsireg.utils.reg_utils import (
+    calibration_reg_models,
+    metric_convergence_iteration,
+)
+from wsireg.utils.resource_utils import (
+    get_compression_workers,
+    get_memory_limit,
+    get_n_threads,
+    parse_memory_limit,
+    set_resource_limits,
+    workers_for_memory,
+)
 from wsireg.wsireg2d import WsiReg2D
 
 HERE = os.path.dirname(__file__)
@@ -40,7 +58,10 @@ def test_WsiReg2D_instantiation(data_out_dir):
     assert wsi_reg.project_name == pstr
     assert wsi_reg.output_dir == Path(str(data_out_dir))
 
+
 dask.config.set(scheduler="single-threaded")
+
+
 def test_wsireg2d_add_modality_w_fp(data_out_dir, data_im_fp):
     wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
     img_fp1 = str(data_im_fp)
@@ -402,6 +423,44 @@ def test_wsireg_run_reg_wmerge(data_out_dir, disk_im_gry):
     assert merged_im.shape == (2, 2048, 2048)
 
 
+@pytest.mark.parametrize("memory_limit", [None, "8MB"])
+def test_wsireg_run_reg_auto_writer(data_out_dir, disk_im_gry, memory_limit):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    for modality in ["mod1", "mod2", "mod3"]:
+        wsi_reg.add_modality(
+            modality,
+            img_fp1,
+            0.65,
+            channel_names=["test"],
+            channel_colors=["red"],
+        )
+
+    wsi_reg.add_reg_path(
+        "mod1", "mod2", reg_params=["rigid_test", "affine_test"]
+    )
+    wsi_reg.add_reg_path(
+        "mod3", "mod2", reg_params=["rigid_test", "affine_test"]
+    )
+    wsi_reg.add_merge_modalities("test_merge", ["mod1", "mod2"])
+    wsi_reg.register_images()
+    previous_memory_limit = get_memory_limit()
+    try:
+        # a budget below the plane writer's estimate selects the tiled writers
+        set_resource_limits(memory_limit=memory_limit)
+        im_fps = wsi_reg.transform_images(
+            file_writer="auto", transform_non_reg=True
+        )
+    finally:
+        set_resource_limits(memory_limit=previous_memory_limit)
+
+    assert len(im_fps) == 2
+    for im_fp in im_fps:
+        assert Path(im_fp).exists() is True
+        assert reg_image_loader(im_fp, 0.65).shape[-2:] == (2048, 2048)
+
+
 def test_wsireg_run_reg_wmerge_and_indiv(data_out_dir, disk_im_gry):
     wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
     img_fp1 = str(disk_im_gry)
@@ -1157,3 +1216,389 @@ def test_wsireg_run_reg_reload_from_cache(data_out_dir, im_mch_np):
 
     assert not np.array_equal(pp_mod1_r1, pp_mod1_r2)
     assert not np.array_equal(pp_mod2_r1, pp_mod2_r2)
+
+
+def test_wsireg_add_reg_stack_paths(data_out_dir):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    sections = [f"section{idx}" for idx in range(5)]
+    for section in sections:
+        wsi_reg.add_modality(section, "", 0.65)
+
+    wsi_reg.add_reg_stack("stack", sections, reference_idx=2)
+
+    assert wsi_reg.n_registrations == 4
+    assert wsi_reg.reg_paths["section0"] == ["section1", "section2"]
+    assert wsi_reg.reg_paths["section1"] == ["section2"]
+    assert wsi_reg.reg_paths["section3"] == ["section2"]
+    assert wsi_reg.reg_paths["section4"] == ["section3", "section2"]
+    assert len(wsi_reg.transform_paths["section0"]) == 2
+    assert wsi_reg.reg_stacks["stack"]["reference_idx"] == 2
+
+    with pytest.raises(ValueError):
+        wsi_reg.add_reg_stack("stack", sections)
+
+    with pytest.raises(ValueError):
+        wsi_reg.add_reg_stack("stack2", sections, reference_idx=5)
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_stack_parallel(data_out_dir, disk_im_gry):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    sections = [f"section{idx}" for idx in range(4)]
+    for section in sections:
+        wsi_reg.add_modality(section, img_fp1, 0.65)
+
+    wsi_reg.add_reg_stack(
+        "stack",
+        sections,
+        reference_idx=0,
+        reg_params=["rigid_test", "affine_test"],
+    )
+    wsi_reg.register_images(parallel=True)
+
+    assert all([e.get("registered") for e in wsi_reg.reg_graph_edges])
+    assert len(wsi_reg.registration_iter_data) == 3
+
+    # three edges of rigid + affine collapse to a single affine
+    full_seq = wsi_reg.transformations["section3"]["full-transform-seq"]
+    assert len(full_seq.reg_transforms) == 1
+    assert full_seq.reg_transforms[0].itk_transform.GetName() == (
+        "AffineTransform"
+    )
+
+    wsi_reg.save_transformations()
+    im_fps = wsi_reg.transform_images(transform_non_reg=False)
+    assert len(im_fps) == 3
+    assert all([Path(im_fp).exists() for im_fp in im_fps])
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_warm_start(data_out_dir, disk_im_gry):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+
+    wsi_reg.add_reg_path("mod1", "mod2", reg_params=["rigid_test"])
+    wsi_reg.register_images()
+
+    prev_rigid = wsi_reg.reg_graph_edges[0]["transforms"][
+        "registration"
+    ].reg_transforms[0]
+
+    wsi_reg.update_reg_params("mod1", ["rigid_test", "affine_test"])
+    assert wsi_reg.reg_graph_edges[0]["registered"] is False
+
+    wsi_reg.register_images(warm_start=True)
+
+    reg_tforms = wsi_reg.reg_graph_edges[0]["transforms"][
+        "registration"
+    ].reg_transforms
+    assert len(reg_tforms) == 2
+    assert (
+        reg_tforms[0].elastix_transform["TransformParameters"]
+        == prev_rigid.elastix_transform["TransformParameters"]
+    )
+    assert reg_tforms[1].itk_transform.GetName() == "AffineTransform"
+    assert len(wsi_reg.registration_iter_data["mod1_to_mod2"]) == 2
+
+    # unchanged models are not optimized again
+    wsi_reg.reset_registered_modality("mod1")
+    wsi_reg.register_images(warm_start=True)
+    assert (
+        wsi_reg.reg_graph_edges[0]["transforms"]["registration"]
+        .reg_transforms[1]
+        .elastix_transform["TransformParameters"]
+        == reg_tforms[1].elastix_transform["TransformParameters"]
+    )
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_warm_start_multi_model(data_out_dir, disk_im_gry):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+
+    wsi_reg.add_reg_path("mod1", "mod2", reg_params=["rigid_test"])
+    wsi_reg.register_images()
+
+    prev_rigid = wsi_reg.reg_graph_edges[0]["transforms"][
+        "registration"
+    ].reg_transforms[0]
+
+    wsi_reg.update_reg_params(
+        "mod1", ["rigid_test", "affine_test", "rigid_test"]
+    )
+    wsi_reg.register_images(warm_start=True)
+
+    reg_tforms = wsi_reg.reg_graph_edges[0]["transforms"][
+        "registration"
+    ].reg_transforms
+    assert [rt.itk_transform.GetName() for rt in reg_tforms] == [
+        "Euler2DTransform",
+        "AffineTransform",
+        "Euler2DTransform",
+    ]
+    assert (
+        reg_tforms[0].elastix_transform["TransformParameters"]
+        == prev_rigid.elastix_transform["TransformParameters"]
+    )
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_convergence(data_out_dir, disk_im_gry):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+
+    wsi_reg.add_reg_path(
+        "mod1", "mod2", reg_params=["rigid_test", "affine_test"]
+    )
+    wsi_reg.register_images(
+        convergence={"rel_tol": 1e-2, "window": 3, "min_iterations": 2}
+    )
+
+    iter_data = wsi_reg.registration_iter_data["mod1_to_mod2"]
+    for model_data in iter_data.values():
+        for res_data in model_data.values():
+            assert (
+                res_data["calibrated_iterations"] <= res_data["max_iterations"]
+            )
+            assert len(res_data["metric"]) <= res_data["calibrated_iterations"]
+
+    # presets are not modified by the calibration
+    assert RegModel.rigid_test.value["MaximumNumberOfIterations"] == ["10"]
+
+    # registering the same edge again reuses the calibration
+    assert len(wsi_reg._calibration_cache) == 1
+    wsi_reg.reg_graph_edges[0]["registered"] = False
+    wsi_reg.register_images(
+        convergence={"rel_tol": 1e-2, "window": 3, "min_iterations": 2}
+    )
+    assert len(wsi_reg._calibration_cache) == 1
+    for model_idx, model_data in iter_data.items():
+        for res_idx, res_data in model_data.items():
+            assert (
+                wsi_reg.registration_iter_data["mod1_to_mod2"][model_idx][
+                    res_idx
+                ]["calibrated_iterations"]
+                == res_data["calibrated_iterations"]
+            )
+
+
+def test_calibration_reg_models():
+    reg_model = {
+        "NumberOfResolutions": ["2"],
+        "MaximumNumberOfIterations": ["200", "50"],
+        "NumberOfSpatialSamples": ["4000"],
+    }
+    calibration_model = calibration_reg_models(
+        [reg_model], 0.25, iteration_fraction=0.5, min_iterations=40
+    )[0]
+    assert calibration_model["NumberOfSpatialSamples"] == ["1000"]
+    assert calibration_model["MaximumNumberOfIterations"] == ["100", "40"]
+    assert reg_model["MaximumNumberOfIterations"] == ["200", "50"]
+
+
+def test_metric_convergence_iteration():
+    metric = np.concatenate([np.linspace(-0.1, -1, 50), np.full(100, -1.0)])
+    assert 60 < metric_convergence_iteration(metric, 1e-3, 10) <= 70
+    assert metric_convergence_iteration(metric[:40], 1e-3, 10) == 40
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_compact_diagnostics(data_out_dir, disk_im_gry):
+    wsi_reg = WsiReg2D(
+        gen_project_name_str(), str(data_out_dir), diagnostics="compact"
+    )
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+
+    wsi_reg.add_reg_path(
+        "mod1", "mod2", reg_params=["rigid_test", "affine_test"]
+    )
+    wsi_reg.register_images()
+
+    output_path = wsi_reg._edge_output_path(wsi_reg.reg_graph_edges[0])
+    assert len(list(output_path.glob("IterationInfo*"))) == 0
+    assert len(list(output_path.glob("TransformParameters*"))) == 0
+
+    iter_data, tform_data = read_iteration_npz(
+        output_path / "IterationData.npz"
+    )
+    assert len(iter_data) == 2
+    assert len(tform_data) == 2
+    np.testing.assert_array_equal(
+        iter_data[1][0]["metric"],
+        wsi_reg.registration_iter_data["mod1_to_mod2"][1][0]["metric"],
+    )
+
+    plot_process = wsi_reg.write_iteration_plots(background=True)
+    plot_process.join()
+    assert plot_process.exitcode == 0
+    assert len(list(output_path.glob("IterationPlot*.png"))) > 0
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_no_diagnostics(data_out_dir, disk_im_gry, monkeypatch):
+    wsi_reg = WsiReg2D(
+        gen_project_name_str(), str(data_out_dir), diagnostics="none"
+    )
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+
+    wsi_reg.add_reg_path(
+        "mod1", "mod2", reg_params=["rigid_test", "affine_test"]
+    )
+
+    temp_dirs = []
+    mkdtemp = tempfile.mkdtemp
+
+    def _mkdtemp(*args, **kwargs):
+        temp_dirs.append(mkdtemp(*args, **kwargs))
+        return temp_dirs[-1]
+
+    monkeypatch.setattr(tempfile, "mkdtemp", _mkdtemp)
+    wsi_reg.register_images()
+
+    assert not wsi_reg._edge_output_path(wsi_reg.reg_graph_edges[0]).exists()
+    assert len(temp_dirs) == 0
+    assert (
+        len(
+            wsi_reg.reg_graph_edges[0]["transforms"][
+                "registration"
+            ].reg_transforms
+        )
+        == 2
+    )
+    assert "mod1_to_mod2" not in wsi_reg.registration_iter_data
+
+
+def test_wsireg_diagnostics_error(data_out_dir):
+    with pytest.raises(ValueError):
+        WsiReg2D(gen_project_name_str(), str(data_out_dir), diagnostics="all")
+
+
+def test_wsireg_resource_limits(data_out_dir):
+    assert parse_memory_limit("16GB") == 16 * 1024**3
+    assert parse_memory_limit("512m") == 512 * 1024**2
+    assert parse_memory_limit(1000) == 1000
+    with pytest.raises(ValueError):
+        parse_memory_limit("lots")
+
+    dask_config = deepcopy(dask.config.config)
+    try:
+        wsi_reg = WsiReg2D(
+            gen_project_name_str(),
+            str(data_out_dir),
+            n_threads=4,
+            memory_limit="1GB",
+        )
+        assert dask.config.get("num_workers") == 4
+        assert wsi_reg.n_threads == 4
+        assert get_n_threads() == 4
+        assert get_n_threads(3) == 1
+        assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 4
+        assert get_memory_limit() == 1024**3
+        assert workers_for_memory(4, 512 * 1024**2) == 2
+        assert workers_for_memory(4, 2 * 1024**3) == 1
+        assert get_compression_workers() == 4
+        assert get_compression_workers(2) == 2
+        with pytest.raises(ValueError):
+            get_compression_workers(0)
+
+        # a memory budget alone leaves the dask configuration alone
+        dask.config.set(scheduler="single-threaded")
+        set_resource_limits(memory_limit="1GB")
+        assert dask.config.get("scheduler") == "single-threaded"
+    finally:
+        set_resource_limits()
+        dask.config.config.clear()
+        dask.config.config.update(dask_config)
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_run_reg_bake_transforms(
+    data_out_dir, disk_im_gry, monkeypatch
+):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+    wsi_reg.add_attachment_images("mod1", "mod1_att", img_fp1, 0.65)
+
+    wsi_reg.add_reg_path("mod1", "mod2", reg_params=["rigid_test", "nl_test"])
+    wsi_reg.register_images()
+    im_fps = wsi_reg.transform_images(
+        transform_non_reg=False, bake_grid_factor=4
+    )
+
+    assert len(im_fps) == 2
+    assert all([Path(im_fp).exists() for im_fp in im_fps])
+    dfield_cache = Path(data_out_dir) / f".dfield_cache_{wsi_reg.project_name}"
+    assert not dfield_cache.exists()
+
+    # images are written with baked copies, the registration keeps the exact transforms
+    full_seq = wsi_reg.transformations["mod1"]["full-transform-seq"]
+    assert (
+        full_seq.composite_transform.GetNumberOfTransforms()
+        == len(full_seq.reg_transforms_simplified)
+        > 1
+    )
+
+    # the cache is removed when writing fails after it was filled
+    transform_write_image = wsi_reg._transform_write_image
+
+    def failing_transform_write_image(*args, **kwargs):
+        transform_write_image(*args, **kwargs)
+        assert dfield_cache.exists()
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(
+        wsi_reg, "_transform_write_image", failing_transform_write_image
+    )
+    with pytest.raises(RuntimeError):
+        wsi_reg.transform_images(transform_non_reg=False, bake_grid_factor=4)
+    assert not dfield_cache.exists()
+
+
+@pytest.mark.usefixtures("disk_im_gry")
+def test_wsireg_save_transformations_npz(data_out_dir, disk_im_gry):
+    wsi_reg = WsiReg2D(gen_project_name_str(), str(data_out_dir))
+    img_fp1 = str(disk_im_gry)
+
+    wsi_reg.add_modality("mod1", img_fp1, 0.65)
+    wsi_reg.add_modality("mod2", img_fp1, 0.65)
+    wsi_reg.add_reg_path("mod1", "mod2", reg_params=["rigid_test", "nl_test"])
+    wsi_reg.register_images()
+
+    with pytest.raises(ValueError):
+        wsi_reg.save_transformations(file_format="txt")
+
+    wsi_reg.save_transformations(file_format="both")
+
+    tform_stem = f"{wsi_reg.project_name}-mod1_to_mod2_transformations"
+    json_fp = wsi_reg.output_dir / f"{tform_stem}.json"
+    npz_fp = wsi_reg.output_dir / f"{tform_stem}.npz"
+    assert json_fp.exists() is True
+    assert npz_fp.exists() is True
+
+    rts_json = RegTransformSeq(json_fp)
+    rts_npz = RegTransformSeq(npz_fp)
+    pts = np.random.uniform(0, 100, (50, 2)).tolist()
+    np.testing.assert_allclose(
+        [rts_npz.composite_transform.TransformPoint(pt) for pt in pts],
+        [rts_json.composite_transform.TransformPoint(pt) for pt in pts],
+    )
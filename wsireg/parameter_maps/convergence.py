@@ -0,0 +1,49 @@
+from pydantic import BaseModel, validator
+
+
+class ConvergenceParams(BaseModel):
+    """Convergence control of elastix registration models.
+
+    Elastix's AdaptiveStochasticGradientDescent optimizer, used by all presets, always runs
+    `MaximumNumberOfIterations` per resolution. wsireg instead runs a short calibration registration
+    with a fraction of the spatial samples and iterations, finds where the metric plateaus at each
+    resolution and registers with per-resolution iteration counts trimmed to that point. Calibrations
+    are cached per registration models and image pair.
+
+    Parameters
+    ----------
+    rel_tol: float
+        A resolution is converged once the relative change of the mean metric between two consecutive
+        windows of iterations is below `rel_tol`
+    window: int
+        Number of iterations in each window
+    min_iterations: int
+        Lower bound on the iterations of a resolution
+    margin: float
+        Factor applied to the converged iteration to allow for the noisier calibration metric
+    calibration_sample_fraction: float
+        Fraction of `NumberOfSpatialSamples` used in the calibration registration
+    calibration_iteration_fraction: float
+        Fraction of `MaximumNumberOfIterations` run at each resolution of the calibration
+        registration, resolutions that don't converge within it keep the preset iterations
+
+    """
+
+    rel_tol: float = 1e-3
+    window: int = 10
+    min_iterations: int = 20
+    margin: float = 1.2
+    calibration_sample_fraction: float = 0.25
+    calibration_iteration_fraction: float = 0.5
+
+    @validator("window", "min_iterations")
+    def _check_positive(cls, v):
+        if v < 1:
+            raise ValueError("must be at least 1")
+        return v
+
+    @validator("calibration_sample_fraction", "calibration_iteration_fraction")
+    def _check_fraction(cls, v):
+        if not 0 < v <= 1:
+            raise ValueError("must be in (0, 1]")
+        return v
@@ -41,8 +41,19 @@ class NumpyRegImage(RegImage):
 
         self._n_ch = self._shape[2] if self._is_rgb else self._shape[0]
 
+        # chunks of at most 2048 px, smaller chunks of dask inputs are kept
+        y_chunk, x_chunk = [
+            min(2048, c)
+            for c in (
+                self._dask_image.chunksize[:2]
+                if self.is_rgb
+                else self._dask_image.chunksize[1:]
+            )
+        ]
         rechunk_size = (
-            (2048, 2048, self.n_ch) if self.is_rgb else (self.n_ch, 2048, 2048)
+            (y_chunk, x_chunk, self.n_ch)
+            if self.is_rgb
+            else (self.n_ch, y_chunk, x_chunk)
         )
         self._dask_image = self._dask_image.rechunk(rechunk_size)
 
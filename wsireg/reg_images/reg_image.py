@@ -18,6 +18,7 @@ from wsireg.utils.im_utils import (
     sitk_max_int_proj,
     transform_plane,
 )
+from wsireg.utils.itk_im_conversions import itk_image_to_sitk_image
 from wsireg.utils.tform_utils import (
     gen_aff_tform_flip,
     gen_rig_to_original,
@@ -35,6 +36,8 @@ class RegImage(ABC):
     # image data
     _dask_image: da.Array
     _reg_image: Union[sitk.Image, itk.Image]
+    _reg_image_pixel_id: Optional[int] = None
+    _reg_image_cast_to_float32: Optional[bool] = None
     _mask: Optional[Union[sitk.Image, itk.Image]] = None
 
     # image dimension information
@@ -131,6 +134,11 @@ class RegImage(ABC):
         """Preprocessed version of image for registration"""
         return self._reg_image
 
+    @property
+    def reg_image_pixel_id(self) -> Optional[int]:
+        """SimpleITK pixel type of `reg_image` before conversion to ITK"""
+        return self._reg_image_pixel_id
+
     @property
     def preprocessing(self) -> Optional[ImagePreproParams]:
         """Preprocessing params to make `reg_image`"""
@@ -398,8 +406,23 @@ class RegImage(ABC):
         ----------
         cast_to_float32: bool
             Whether to make image float32 for ITK, needs to be true for registration.
+            An image that is already converted is only converted again when
+            this differs from the previous conversion. The pixel type before
+            conversion is kept in `reg_image_pixel_id`.
 
         """
+        if not isinstance(self._reg_image, sitk.Image):
+            # already converted, e.g. by a previous registration of the image
+            if cast_to_float32 is self._reg_image_cast_to_float32:
+                return
+            self._reg_image = sitk.Cast(
+                itk_image_to_sitk_image(self._reg_image),
+                self._reg_image_pixel_id,
+            )
+
+        self._reg_image_pixel_id = self._reg_image.GetPixelID()
+        self._reg_image_cast_to_float32 = cast_to_float32
+
         origin = self._reg_image.GetOrigin()
         spacing = self._reg_image.GetSpacing()
         # direction = image.GetDirection()
@@ -416,7 +439,7 @@ class RegImage(ABC):
         self._reg_image.SetOrigin(origin)
         self._reg_image.SetSpacing(spacing)
 
-        if self._mask is not None:
+        if isinstance(self._mask, sitk.Image):
             origin = self._mask.GetOrigin()
             spacing = self._mask.GetSpacing()
             # direction = image.GetDirection()
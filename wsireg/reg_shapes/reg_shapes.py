@@ -174,6 +174,7 @@ class RegShapes:
         transformations: Union[str, Path, dict, RegTransformSeq],
         px_idx: bool = True,
         output_idx: bool = True,
+        inverse_grid_factor: int = 1,
     ):
         """
         Transform shapes using transformations data from wsireg
@@ -188,6 +189,8 @@ class RegShapes:
         output_idx: bool
             whether transformed shape points should be output in physical coordinates (i.e., microns) or
             in pixel indices
+        inverse_grid_factor: int
+            invert non-linear transforms on a grid this many times coarser than the registration grid
         """
         if isinstance(transformations, (str, Path, dict)):
             transformations_seq = RegTransformSeq(transformations)
@@ -195,12 +198,13 @@ class RegShapes:
             transformations_seq = transformations
 
         invert_nonrigid_transforms(
-            transformations_seq.reg_transforms_itk_order
+            transformations_seq.reg_transforms_simplified,
+            grid_factor=inverse_grid_factor,
         )
 
         self.transformed_shape_data = transform_shapes(
             self.shape_data,
-            transformations_seq.reg_transforms_itk_order,
+            transformations_seq.reg_transforms_simplified,
             px_idx=px_idx,
             source_res=self.source_res,
             output_idx=output_idx,
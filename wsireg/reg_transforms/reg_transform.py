@@ -1,5 +1,5 @@
 from warnings import warn
-from typing import Optional
+from typing import Dict, Optional
 import numpy as np
 import SimpleITK as sitk
 
@@ -32,6 +32,8 @@ class RegTransform:
         Inverse of the itk transform used for transforming from moving to fixed space
         Only calculated for non-rigid transforms when called by `compute_inverse_nonlinear`
         as the process is quite memory and computationally intensive
+    inverse_residual: dict or None
+        inverse-consistency error of a computed non-linear inverse
 
     """
 
@@ -82,23 +84,137 @@ class RegTransform:
         else:
             self.inverse_transform = None
 
-    def compute_inverse_nonlinear(self) -> None:
-        """Compute the inverse of a BSpline transform using ITK"""
+        self.inverse_residual: Optional[Dict[str, float]] = None
 
-        tform_to_dfield = sitk.TransformToDisplacementFieldFilter()
-        tform_to_dfield.SetOutputSpacing(self.output_spacing)
-        tform_to_dfield.SetOutputOrigin(self.output_origin)
-        tform_to_dfield.SetOutputDirection(self.output_direction)
-        tform_to_dfield.SetSize(self.output_size)
+    def compute_inverse_nonlinear(
+        self,
+        grid_factor: int = 1,
+        max_iterations: int = 10,
+        max_error_tolerance: float = 0.1,
+        mean_error_tolerance: float = 0.001,
+        n_check_pts: int = 0,
+    ) -> Optional[Dict[str, float]]:
+        """Compute the inverse of a BSpline transform using ITK
+
+        The transform is rasterized to a displacement field, optionally on a grid coarser than
+        the registration grid, and inverted by ITK's multithreaded fixed-point iteration.
+        Coarse fields are padded beyond the output by the largest displacement, so the inverse
+        is also accurate at the output edges, but never have more nodes than the output grid.
+
+        Parameters
+        ----------
+        grid_factor: int
+            spacing of the displacement field grid relative to the registration output spacing,
+            B-spline transforms are smooth so a coarse grid is usually accurate to sub-pixel level
+            at a fraction of the memory and time
+        max_iterations: int
+            maximum number of fixed-point iterations
+        max_error_tolerance: float
+            stop when the largest inversion error of the field is below this value
+        mean_error_tolerance: float
+            stop when the mean inversion error of the field is below this value
+        n_check_pts: int
+            number of random points, drawn with a fixed seed, at which the inverse-consistency
+            error is measured, 0 skips the check
+
+        Returns
+        -------
+        inverse_residual: dict or None
+            "max" and "mean" inverse-consistency error, i.e. distance between a point and the
+            point mapped through the inverse and then the forward transform, in physical units,
+            None if not checked
+        """
+        output_spacing = np.asarray(self.output_spacing) * grid_factor
+        # one more grid node than cells so the field spans the whole output extent,
+        # at most as many nodes as the output grid
+        full_size = np.asarray(self.output_size).astype(int)
+        output_size = np.minimum(
+            np.ceil(full_size / grid_factor).astype(int) + 1, full_size
+        )
+        max_pad = int(np.min(full_size - output_size) // 2)
+        output_direction = np.asarray(self.output_direction).reshape(2, 2)
 
-        displacement_field = tform_to_dfield.Execute(self.itk_transform)
-        displacement_field = sitk.InvertDisplacementField(displacement_field)
+        def _displacement_field(pad):
+            tform_to_dfield = sitk.TransformToDisplacementFieldFilter()
+            tform_to_dfield.SetOutputSpacing(
+                [float(s) for s in output_spacing]
+            )
+            tform_to_dfield.SetOutputOrigin(
+                [
+                    float(o)
+                    for o in np.asarray(self.output_origin)
+                    - output_direction @ (pad * output_spacing)
+                ]
+            )
+            tform_to_dfield.SetOutputDirection(self.output_direction)
+            tform_to_dfield.SetSize([int(s) for s in output_size + 2 * pad])
+            return tform_to_dfield.Execute(self.itk_transform)
+
+        # the inverse at the edge of the output samples the forward field up to the largest
+        # displacement beyond it, pad the field by that many grid nodes
+        pad = 0
+        if max_pad > 0:
+            if self.itk_transform.GetName() == "BSplineTransform":
+                # B-spline weights are positive and sum to 1, no displacement is larger
+                # than the largest coefficient
+                max_displacement = np.max(
+                    np.abs(self.itk_transform.GetParameters())
+                )
+            else:
+                max_displacement = np.max(
+                    np.abs(sitk.GetArrayViewFromImage(_displacement_field(0)))
+                )
+            pad = min(
+                int(np.ceil(max_displacement / np.min(output_spacing))) + 1,
+                max_pad,
+            )
+        displacement_field = _displacement_field(pad)
+
+        invert_dfield = sitk.InvertDisplacementFieldImageFilter()
+        invert_dfield.SetMaximumNumberOfIterations(max_iterations)
+        invert_dfield.SetMaxErrorToleranceThreshold(max_error_tolerance)
+        invert_dfield.SetMeanErrorToleranceThreshold(mean_error_tolerance)
+        invert_dfield.EnforceBoundaryConditionOn()
+        displacement_field = invert_dfield.Execute(displacement_field)
         displacement_field = sitk.DisplacementFieldTransform(
             displacement_field
         )
 
         self.inverse_transform = displacement_field
 
+        if not n_check_pts:
+            return None
+
+        output_extent = np.asarray(self.output_size) * np.asarray(
+            self.output_spacing
+        )
+        check_pts = (
+            np.asarray(self.output_origin)
+            + np.random.default_rng(0).uniform(0, 1, (n_check_pts, 2))
+            * output_extent
+        )
+        residuals = [
+            np.linalg.norm(
+                np.asarray(
+                    self.itk_transform.TransformPoint(
+                        self.inverse_transform.TransformPoint(tuple(pt))
+                    )
+                )
+                - pt
+            )
+            for pt in check_pts
+        ]
+        self.inverse_residual = {
+            "max": float(np.max(residuals)),
+            "mean": float(np.mean(residuals)),
+        }
+        print(
+            "inverse-consistency error of the inverted transform: "
+            f"max: {self.inverse_residual['max']:.4f}, "
+            f"mean: {self.inverse_residual['mean']:.4f}"
+        )
+        return self.inverse_residual
+
     def as_np_matrix(
         self,
         use_np_ordering: bool = False,
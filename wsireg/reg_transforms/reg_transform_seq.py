@@ -1,21 +1,40 @@
+import hashlib
 import json
+from copy import copy
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import SimpleITK as sitk
+import zarr
 
 from wsireg.reg_transforms.reg_transform import RegTransform
-from wsireg.utils.tform_utils import ELX_TO_ITK_INTERPOLATORS
+from wsireg.utils.tform_utils import (
+    ELX_TO_ITK_INTERPOLATORS,
+    collapse_linear_transforms,
+    elastix_transform_to_txt,
+    read_wsireg_transform_npz,
+    transform_pts_batch,
+)
 
 
 class RegTransformSeq:
-    """Class to concatenate and compose sequences of transformations"""
+    """Class to concatenate and compose sequences of transformations
+
+    Attributes
+    ----------
+    reg_transforms_itk_order: list of RegTransform
+        transforms in the order they are added to the ITK composite transform
+    reg_transforms_simplified: list of RegTransform
+        `reg_transforms_itk_order` with each run of adjacent linear transforms merged into one
+        affine transform, used for the composite transform and point transformation
+    """
 
     reg_transforms: List[RegTransform] = []
     resampler: Optional[sitk.ResampleImageFilter] = None
     composed_linear_mats: Optional[Dict[str, np.ndarray]] = None
     reg_transforms_itk_order: List[RegTransform] = []
+    reg_transforms_simplified: List[RegTransform] = []
 
     def __init__(
         self,
@@ -55,7 +74,7 @@ class RegTransformSeq:
 
         Parameters
         ----------
-        transforms: path to wsireg transforms .json, elastix transform dict,RegTransform ot List of RegTransform
+        transforms: path to wsireg transforms .json or .npz, elastix transform dict,RegTransform ot List of RegTransform
         transform_seq_idx: list of int
             Order in sequence of the transform. If a pre-reg transform, it will not be reversed like a sequence
             of elastix transforms would to make the composite ITK transform
@@ -183,17 +202,20 @@ class RegTransformSeq:
             else:
                 composite_index = composite_index + list(in_seq_tform_idx)
 
+        self.reg_transforms_itk_order = [
+            self.reg_transforms[i] for i in composite_index
+        ]
+        # adjacent linear transforms are evaluated as a single affine
+        self.reg_transforms_simplified = collapse_linear_transforms(
+            self.reg_transforms_itk_order
+        )
+
         composite_transform = sitk.CompositeTransform(2)
 
-        for tform_idx in composite_index:
-            composite_transform.AddTransform(
-                reg_transforms[tform_idx].itk_transform
-            )
+        for reg_transform in self.reg_transforms_simplified:
+            composite_transform.AddTransform(reg_transform.itk_transform)
 
         self._composite_transform = composite_transform
-        self.reg_transforms_itk_order = [
-            self.reg_transforms[i] for i in composite_index
-        ]
 
     def _build_resampler(self) -> None:
         resampler = sitk.ResampleImageFilter()
@@ -231,22 +253,139 @@ class RegTransformSeq:
         tformed_pts: np.ndarray
             Transformed points
         """
-        tformed_pts = []
-        for pt in pt_data:
-            if px_idx is True:
-                pt = pt * source_res
-            for idx, t in enumerate(self.reg_transforms):
-                if idx == 0:
-                    t_pt = t.inverse_transform.TransformPoint(pt)
-                else:
-                    t_pt = t.inverse_transform.TransformPoint(t_pt)
-            t_pt = np.array(t_pt)
-
-            if output_idx is True:
-                t_pt *= 1 / self._output_spacing[0]
-            tformed_pts.append(t_pt)
-
-        return np.stack(tformed_pts)
+        pt_data = np.asarray(pt_data, dtype=np.float64)
+        if px_idx is True:
+            pt_data = pt_data * source_res
+
+        tformed_pts = transform_pts_batch(
+            pt_data,
+            [t.inverse_transform for t in self.reg_transforms_simplified],
+        )
+
+        if output_idx is True:
+            tformed_pts = tformed_pts / self._output_spacing[0]
+
+        return tformed_pts
+
+    @property
+    def transforms_digest(self) -> str:
+        """Digest of the elastix transforms in the sequence, identifies the mapping."""
+        tform_data = json.dumps(
+            [
+                elastix_transform_to_txt(t.elastix_transform)
+                for t in self.reg_transforms_itk_order
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha1(tform_data.encode("utf-8")).hexdigest()
+
+    def bake_displacement_field(
+        self,
+        grid_factor: int = 4,
+        zarr_path: Optional[Union[str, Path]] = None,
+        n_check_pts: int = 1000,
+    ) -> Tuple["RegTransformSeq", float]:
+        """
+        Copy of the sequence whose composite transform is a displacement field of the fixed to
+        moving mapping, sampled on a grid `grid_factor` times coarser than the output grid and
+        linearly interpolated in between. Evaluating the transform then costs the same for any
+        chain length or B-spline order, so all images resampled with the copy share one
+        precomputation. This sequence keeps the exact transforms.
+
+        Parameters
+        ----------
+        grid_factor: int
+            spacing of the displacement field grid relative to the output spacing
+        zarr_path: str or Path
+            chunked zarr store of the displacement field, loaded if it exists and matches the
+            transforms and grid, otherwise written after computing the field
+        n_check_pts: int
+            number of random output points, drawn with a fixed seed, at which the baked field
+            is compared with the full composite transform
+
+        Returns
+        -------
+        baked_seq: RegTransformSeq
+            copy of the sequence resampling with the displacement field
+        max_error: float
+            largest deviation from the full composite transform at the checked points,
+            in physical units
+        """
+        output_origin = np.asarray(self.reg_transforms[-1].output_origin)
+        output_direction = self.reg_transforms[-1].output_direction
+        output_extent = np.asarray(self._output_size) * np.asarray(
+            self._output_spacing
+        )
+        field_spacing = np.asarray(self._output_spacing) * grid_factor
+        field_size = [
+            int(s)
+            for s in np.ceil(output_extent / field_spacing).astype(int) + 1
+        ]
+        field_attrs = {
+            "transforms_digest": self.transforms_digest,
+            "origin": [float(o) for o in output_origin],
+            "spacing": [float(s) for s in field_spacing],
+            "direction": [float(d) for d in output_direction],
+            "size": field_size,
+        }
+
+        full_composite = sitk.CompositeTransform(2)
+        for reg_transform in self.reg_transforms_simplified:
+            full_composite.AddTransform(reg_transform.itk_transform)
+
+        field = None
+        if zarr_path is not None and Path(zarr_path).exists():
+            field_store = zarr.open(str(zarr_path), mode="r")
+            if dict(field_store.attrs) == field_attrs:
+                field = sitk.GetImageFromArray(
+                    field_store[:].astype(np.float64), isVector=True
+                )
+
+        if field is None:
+            tform_to_dfield = sitk.TransformToDisplacementFieldFilter()
+            tform_to_dfield.SetOutputSpacing(field_attrs["spacing"])
+            tform_to_dfield.SetOutputOrigin(field_attrs["origin"])
+            tform_to_dfield.SetOutputDirection(field_attrs["direction"])
+            tform_to_dfield.SetSize(field_size)
+            field = tform_to_dfield.Execute(full_composite)
+
+            if zarr_path is not None:
+                field_array = sitk.GetArrayFromImage(field)
+                field_store = zarr.open(
+                    str(zarr_path),
+                    mode="w",
+                    shape=field_array.shape,
+                    chunks=(1024, 1024, 2),
+                    dtype=field_array.dtype,
+                )
+                field_store[:] = field_array
+                field_store.attrs.update(field_attrs)
+
+        field.SetOrigin(field_attrs["origin"])
+        field.SetSpacing(field_attrs["spacing"])
+        field.SetDirection(field_attrs["direction"])
+
+        check_pts = output_origin + np.random.default_rng(0).uniform(
+            0, 1, (n_check_pts, 2)
+        ) * (output_extent - np.asarray(self._output_spacing))
+
+        baked_transform = sitk.CompositeTransform(2)
+        baked_transform.AddTransform(sitk.DisplacementFieldTransform(field))
+
+        max_error = 0.0
+        for pt in check_pts:
+            pt = tuple(pt)
+            error = np.linalg.norm(
+                np.asarray(full_composite.TransformPoint(pt))
+                - np.asarray(baked_transform.TransformPoint(pt))
+            )
+            max_error = max(max_error, float(error))
+
+        baked_seq = copy(self)
+        baked_seq._composite_transform = baked_transform
+        baked_seq._build_resampler()
+
+        return baked_seq, max_error
 
     def append(self, other) -> None:
         """
@@ -267,9 +406,12 @@ class RegTransformSeq:
 def _read_wsireg_transform(
     parameter_data: Union[str, Path, Dict[Any, Any]]
 ) -> Tuple[List[Dict[str, List[str]]], List[int]]:
-    """Convert wsireg transform dict or from file to List of RegTransforms"""
+    """Convert wsireg transform dict or from file (.json or .npz) to List of RegTransforms"""
     if isinstance(parameter_data, (str, Path)):
-        parameter_data_in = json.load(open(parameter_data, "r"))
+        if Path(parameter_data).suffix == ".npz":
+            parameter_data_in = read_wsireg_transform_npz(parameter_data)
+        else:
+            parameter_data_in = json.load(open(parameter_data, "r"))
     else:
         parameter_data_in = parameter_data
 
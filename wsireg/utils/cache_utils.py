@@ -0,0 +1,218 @@
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+import dask.array as da
+import numpy as np
+
+
+class ChunkCache:
+    """
+    Size-bounded, thread-safe LRU cache of the decoded chunks of a dask array.
+
+    Regions are assembled from whole chunks so overlapping reads, i.e., of neighbouring
+    tiles of a transformed image, decode each chunk of the source once while it is cached.
+    With a `channel_axis`, chunks are cached per channel so reads of a single channel
+    neither decode nor hold the other channels of chunks spanning several channels.
+
+    Parameters
+    ----------
+    dask_image: da.Array
+        image whose chunks are cached
+    max_bytes: int
+        maximum size of the cached chunks in bytes, least recently used chunks are
+        evicted beyond it
+    channel_axis: int or None
+        axis of the channels, cached one channel at a time
+
+    Attributes
+    ----------
+    hits: int
+        number of chunk reads served from the cache
+    misses: int
+        number of chunk reads that decoded the chunk
+    evictions: int
+        number of chunks evicted from the cache
+    uncached: int
+        number of decoded chunks larger than `max_bytes` that could not be cached
+    """
+
+    def __init__(
+        self,
+        dask_image: da.Array,
+        max_bytes: int,
+        channel_axis: Optional[int] = None,
+    ):
+        self.dask_image = dask_image
+        self.max_bytes = max_bytes
+        self.channel_axis = (
+            channel_axis % dask_image.ndim
+            if channel_axis is not None
+            else None
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+
+        self._chunks: "OrderedDict[Tuple[int, ...], np.ndarray]" = (
+            OrderedDict()
+        )
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+        self._chunk_bounds = [
+            np.concatenate([[0], np.cumsum(c)]) for c in dask_image.chunks
+        ]
+        chunk_shape = [max(c) for c in dask_image.chunks]
+        if self.channel_axis is not None:
+            self._channel_bounds = self._chunk_bounds[self.channel_axis]
+            self._chunk_bounds[self.channel_axis] = np.arange(
+                dask_image.shape[self.channel_axis] + 1
+            )
+            chunk_shape[self.channel_axis] = 1
+        self._max_chunk_bytes = (
+            int(np.prod(chunk_shape)) * dask_image.dtype.itemsize
+        )
+
+    @property
+    def n_bytes(self) -> int:
+        """Size of the cached chunks in bytes."""
+        return self._n_bytes
+
+    @property
+    def max_chunk_bytes(self) -> int:
+        """Size in bytes of the largest cached unit, a chunk or a channel of a chunk."""
+        return self._max_chunk_bytes
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Hit/miss statistics of the cache."""
+        with self._lock:
+            n_reads = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / n_reads if n_reads else 0.0,
+                "uncached": self.uncached,
+                "n_chunks": len(self._chunks),
+                "n_bytes": self._n_bytes,
+            }
+
+    def summary(self) -> str:
+        """Statistics of the cache, noting chunks too large to be cached."""
+        stats = self.stats()
+        message = str(stats)
+        if stats["uncached"] > 0:
+            message += (
+                f", {stats['uncached']} chunk reads were not cached, chunks of up to "
+                f"{self.max_chunk_bytes} bytes exceed the cache size of "
+                f"{self.max_bytes} bytes"
+            )
+        return message
+
+    def clear(self) -> None:
+        """Empty the cache and reset the statistics."""
+        with self._lock:
+            self._chunks.clear()
+            self._n_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.uncached = 0
+
+    def _decode_chunk(self, block_idx: Tuple[int, ...]) -> np.ndarray:
+        if self.channel_axis is None:
+            return np.asarray(self.dask_image.blocks[block_idx])
+
+        # block_idx holds the channel on the channel axis, read it from its chunk
+        channel = block_idx[self.channel_axis]
+        channel_block = (
+            np.searchsorted(self._channel_bounds, channel, side="right") - 1
+        )
+        dask_block_idx = list(block_idx)
+        dask_block_idx[self.channel_axis] = channel_block
+        channel_start = channel - self._channel_bounds[channel_block]
+        channel_slice = [slice(None)] * self.dask_image.ndim
+        channel_slice[self.channel_axis] = slice(
+            channel_start, channel_start + 1
+        )
+        return np.asarray(
+            self.dask_image.blocks[tuple(dask_block_idx)][tuple(channel_slice)]
+        )
+
+    def _get_chunk(self, block_idx: Tuple[int, ...]) -> np.ndarray:
+        with self._lock:
+            chunk = self._chunks.get(block_idx)
+            if chunk is not None:
+                self._chunks.move_to_end(block_idx)
+                self.hits += 1
+                return chunk
+            self.misses += 1
+
+        # decode outside of the lock so workers decode different chunks concurrently
+        chunk = self._decode_chunk(block_idx)
+
+        if chunk.nbytes > self.max_bytes:
+            with self._lock:
+                self.uncached += 1
+        else:
+            with self._lock:
+                if block_idx not in self._chunks:
+                    self._chunks[block_idx] = chunk
+                    self._n_bytes += chunk.nbytes
+                while self._n_bytes > self.max_bytes:
+                    _, evicted = self._chunks.popitem(last=False)
+                    self._n_bytes -= evicted.nbytes
+                    self.evictions += 1
+
+        return chunk
+
+    def read_region(self, region: Tuple[slice, ...]) -> np.ndarray:
+        """
+        Read a region of the image from cached chunks.
+
+        Parameters
+        ----------
+        region: tuple of slice
+            one slice with positive, in-bounds start and stop per axis
+
+        Returns
+        -------
+        image: np.ndarray
+            the region of the image
+        """
+        starts = [s.start for s in region]
+        stops = [s.stop for s in region]
+        image = np.empty(
+            [stop - start for start, stop in zip(starts, stops)],
+            dtype=self.dask_image.dtype,
+        )
+        if image.size == 0:
+            return image
+
+        block_ranges = [
+            range(
+                np.searchsorted(bounds, start, side="right") - 1,
+                np.searchsorted(bounds, stop, side="left"),
+            )
+            for bounds, start, stop in zip(self._chunk_bounds, starts, stops)
+        ]
+
+        for block_idx in itertools.product(*block_ranges):
+            chunk = self._get_chunk(block_idx)
+            chunk_starts = [
+                bounds[b] for bounds, b in zip(self._chunk_bounds, block_idx)
+            ]
+            src = []
+            dst = []
+            for start, stop, chunk_start, size in zip(
+                starts, stops, chunk_starts, chunk.shape
+            ):
+                lo = max(start, chunk_start)
+                hi = min(stop, chunk_start + size)
+                src.append(slice(lo - chunk_start, hi - chunk_start))
+                dst.append(slice(lo - start, hi - start))
+            image[tuple(dst)] = chunk[tuple(src)]
+
+        return image
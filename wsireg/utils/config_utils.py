@@ -41,6 +41,13 @@ def parse_check_reg_config(yaml_filepath):
             if isinstance(val.get("reg_params"), str):
                 val.update({"reg_params": [val.get("reg_params")]})
 
+    if reg_config.get("reg_stacks"):
+
+        for key, val in reg_config["reg_stacks"].items():
+            [check_for_key(key, val, ck) for ck in ["modalities"]]
+            if isinstance(val.get("reg_params"), str):
+                val.update({"reg_params": [val.get("reg_params")]})
+
     if reg_config.get("attachment_images"):
 
         for key, val in reg_config["attachment_images"].items():
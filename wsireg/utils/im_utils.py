@@ -1,4 +1,3 @@
-import multiprocessing
 import warnings
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
@@ -20,6 +19,7 @@ from tifffile import (
 )
 
 from wsireg.parameter_maps.preprocessing import BoundingBox, ImagePreproParams
+from wsireg.utils.resource_utils import get_n_threads
 from wsireg.utils.tform_utils import sitk_transform_image
 
 TIFFFILE_EXTS = [".scn", ".tif", ".tiff", ".ndpi", ".svs"]
@@ -61,7 +61,7 @@ COLNAME_TO_HEX = {
     "blue": "0000FF",
     "magenta": "FF00FF",
     "yellow": "FFFF00",
-    "cyan": "00FFFFF",
+    "cyan": "00FFFF",
     "white": "FFFFFF",
 }
 
@@ -406,7 +406,7 @@ class CziRegImageReader(CziFile):
             out = create_output(None, tuple(out_shape), out_dtype)
 
         if max_workers is None:
-            max_workers = multiprocessing.cpu_count() - 1
+            max_workers = max(get_n_threads() - 1, 1)
 
         def func(
             directory_entry, resize=resize, order=order, start=start, out=out
@@ -514,7 +514,7 @@ class CziRegImageReader(CziFile):
             out = create_output(None, tuple(out_shape), out_dtype)
 
         if max_workers is None:
-            max_workers = multiprocessing.cpu_count() - 1
+            max_workers = max(get_n_threads() - 1, 1)
 
         def func(
             directory_entry, resize=resize, order=order, start=start, out=out
@@ -780,7 +780,12 @@ def generate_channels(channel_names, channel_colors, im_dtype):
                 "label": channel_name,
                 "color": channel_color,
                 "active": True,
-                "window": {"start": 0, "end": int(np.iinfo(im_dtype).max)},
+                "window": {
+                    "start": 0,
+                    "end": int(np.iinfo(im_dtype).max)
+                    if np.issubdtype(im_dtype, np.integer)
+                    else 1.0,
+                },
             }
         )
     return channel_info
@@ -808,6 +813,36 @@ def format_channel_names(channel_names, n_ch):
     return channel_names
 
 
+def format_channel_colors(channel_colors, n_ch):
+    """
+    Format channel colors as hex strings, defaulting to the named colors in order when
+    no colors are given or the number of colors does not match the number of channels
+
+    Parameters
+    ----------
+    channel_colors: list
+        list of str channel color names
+    n_ch: int
+        number of channels detected in image
+
+    Returns
+    -------
+    channel_colors:
+        list of hex str colors
+    """
+    n_colors = n_ch // len(COLNAME_TO_HEX) + 1
+    color_palette = [*COLNAME_TO_HEX] * n_colors
+
+    if channel_colors is None:
+        channel_colors = [color_palette[idx] for idx in range(n_ch)]
+    elif n_ch != len(channel_colors) and n_ch != 1:
+        channel_colors = [color_palette[idx] for idx in range(n_ch)]
+    elif n_ch != len(channel_colors) and n_ch == 1:
+        return ["FFFFFF"]
+
+    return [COLNAME_TO_HEX[ch] for ch in channel_colors]
+
+
 def get_pyramid_info(y_size, x_size, n_ch, tile_size):
     """
     Get pyramidal info for OME-zarr output
@@ -905,17 +940,7 @@ def prepare_ome_zarr_group(
 
     channel_names = format_channel_names(channel_names, n_ch)
 
-    n_colors = n_ch // len(COLNAME_TO_HEX) + 1
-    color_palette = [*COLNAME_TO_HEX] * n_colors
-
-    if channel_colors is None:
-        channel_colors = [color_palette[idx] for idx in range(n_ch)]
-    elif n_ch != len(channel_colors) and n_ch != 1:
-        channel_colors = [color_palette[idx] for idx in range(n_ch)]
-    elif n_ch != len(channel_colors) and n_ch == 1:
-        channel_colors = ["FFFFFF"]
-    else:
-        channel_colors = [COLNAME_TO_HEX[ch] for ch in channel_colors]
+    channel_colors = format_channel_colors(channel_colors, n_ch)
 
     channel_info = generate_channels(channel_names, channel_colors, im_dtype)
 
@@ -1,5 +1,6 @@
-from typing import Dict, Union
+from typing import Dict, Tuple, Union
 from pathlib import Path
+import json
 import re
 import numpy as np
 import matplotlib.pyplot as plt
@@ -196,7 +197,7 @@ def create_iteration_plot(
     }
 
     for k, v in iteration_dict.items():
-        if k == "iteration":
+        if k not in plt_pos:
             continue
         x_data = iteration_dict["iteration"]
         y_data = v
@@ -244,3 +245,80 @@ def write_iteration_plots(
             out_fig = create_iteration_plot(res_data, plot_title)
             out_fig.savefig(str(output_filepath))
             plt.close(out_fig)
+
+
+def write_iteration_npz(
+    all_iteration_data: Dict[int, Dict[int, Dict[str, np.ndarray]]],
+    all_tform_data: Dict[int, Dict[int, Dict[str, str]]],
+    output_fp: Union[str, Path],
+) -> str:
+    """
+    Write iteration and intermediate transform data of a registration to a single npz file.
+
+    Parameters
+    ----------
+    all_iteration_data: Dict[int, Dict[int, Dict[str, np.ndarray]]]
+        Data for each registration. Keys are 0, 1, 2 for first transform, second transform, etc.
+        sub-keys of each top level key are resolution 0, 1, 2, etc.
+    all_tform_data: Dict[int, Dict[int, Dict[str, str]]]
+        Transform parameter data for each registration and resolution
+    output_fp: str or Path
+        file path of the npz file
+
+    Returns
+    -------
+    output_fp: str
+        Path to the saved file
+    """
+    arrays = {
+        f"{model_idx}/{res_idx}/{k}": v
+        for model_idx, model_data in all_iteration_data.items()
+        for res_idx, res_data in model_data.items()
+        for k, v in res_data.items()
+    }
+    arrays["transform_data"] = np.asarray(json.dumps(all_tform_data))
+    np.savez_compressed(output_fp, **arrays)
+    return str(output_fp)
+
+
+def read_iteration_npz(
+    npz_fp: Union[str, Path]
+) -> Tuple[
+    Dict[int, Dict[int, Dict[str, np.ndarray]]],
+    Dict[int, Dict[int, Dict[str, str]]],
+]:
+    """
+    Read iteration and intermediate transform data written by `write_iteration_npz`.
+
+    Parameters
+    ----------
+    npz_fp: str or Path
+        file path of the npz file
+
+    Returns
+    -------
+    all_iteration_data: Dict[int, Dict[int, Dict[str, np.ndarray]]]
+        Data for each registration and resolution
+    all_tform_data: Dict[int, Dict[int, Dict[str, str]]]
+        Transform parameter data for each registration and resolution
+    """
+    all_iteration_data = dict()
+    all_tform_data = dict()
+    with np.load(npz_fp) as npz_data:
+        for key in npz_data.files:
+            if key == "transform_data":
+                tform_data = json.loads(str(npz_data[key]))
+                all_tform_data = {
+                    int(model_idx): {
+                        int(res_idx): res_data
+                        for res_idx, res_data in model_data.items()
+                    }
+                    for model_idx, model_data in tform_data.items()
+                }
+                continue
+            model_idx, res_idx, data_name = key.split("/", 2)
+            all_iteration_data.setdefault(int(model_idx), dict()).setdefault(
+                int(res_idx), dict()
+            )[data_name] = npz_data[key]
+
+    return all_iteration_data, all_tform_data
@@ -1,11 +1,14 @@
 import json
+from copy import deepcopy
+from math import ceil
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import itk
 import numpy as np
 import SimpleITK as sitk
 
+from wsireg.parameter_maps.convergence import ConvergenceParams
 from wsireg.parameter_maps.reg_model import RegModel
 from wsireg.utils.itk_im_conversions import itk_image_to_sitk_image
 
@@ -99,6 +102,28 @@ def json_to_pmap_dict(json_file):
     return pmap_dict
 
 
+# parameters wsireg sets on each map at registration time
+_RUNTIME_REG_PARAMETERS = [
+    "WriteResultImage",
+    "AutomaticTransformInitialization",
+]
+
+
+def _reg_models_match(
+    reg_model_a: Dict[str, List[str]], reg_model_b: Dict[str, List[str]]
+) -> bool:
+    """Compare two elastix parameter maps, ignoring parameters wsireg sets at runtime."""
+
+    def _strip(reg_model):
+        return {
+            k: [str(p) for p in v]
+            for k, v in reg_model.items()
+            if k not in _RUNTIME_REG_PARAMETERS
+        }
+
+    return _strip(reg_model_a) == _strip(reg_model_b)
+
+
 def _prepare_reg_models(
     reg_params: List[Union[RegModel, Dict[str, List[str]]]]
 ) -> List[Dict[str, List[str]]]:
@@ -113,6 +138,151 @@ def _prepare_reg_models(
     return prepared_params
 
 
+def _per_resolution_values(
+    reg_model: Dict[str, List[str]], param_name: str
+) -> List[int]:
+    """Expand an elastix parameter given once or per resolution to one int per resolution."""
+    n_res = int(reg_model.get("NumberOfResolutions", ["1"])[0])
+    values = [int(float(v)) for v in reg_model[param_name]]
+    if len(values) == 1:
+        values = values * n_res
+    return values
+
+
+def metric_convergence_iteration(
+    metric: np.ndarray, rel_tol: float, window: int
+) -> int:
+    """
+    Find the iteration at which an elastix metric plateaus.
+
+    Parameters
+    ----------
+    metric: np.ndarray
+        metric value at each iteration of a resolution
+    rel_tol: float
+        relative change of the mean metric between two consecutive windows below which
+        the metric is considered converged
+    window: int
+        number of iterations in each window
+
+    Returns
+    -------
+    n_iterations: int
+        number of iterations until convergence, all iterations if the metric did not converge
+    """
+    metric = np.asarray(metric, dtype=np.float64)
+    for end in range(2 * window, len(metric) + 1):
+        prev_mean = np.mean(metric[end - 2 * window : end - window])
+        curr_mean = np.mean(metric[end - window : end])
+        denom = max(abs(prev_mean), np.finfo(np.float64).eps)
+        if abs(curr_mean - prev_mean) / denom < rel_tol:
+            return end
+    return len(metric)
+
+
+def calibration_reg_models(
+    reg_params: List[Dict[str, List[str]]],
+    sample_fraction: float,
+    iteration_fraction: float = 1.0,
+    min_iterations: int = 1,
+) -> List[Dict[str, List[str]]]:
+    """Copies of the registration models using a fraction of the spatial samples and of the
+    iterations of each resolution, at least `min_iterations`, for a calibration registration."""
+    calibration_params = []
+    for reg_model in deepcopy(reg_params):
+        if "NumberOfSpatialSamples" in reg_model:
+            reg_model["NumberOfSpatialSamples"] = [
+                str(max(1, int(float(n) * sample_fraction)))
+                for n in reg_model["NumberOfSpatialSamples"]
+            ]
+        if "MaximumNumberOfIterations" in reg_model:
+            reg_model["MaximumNumberOfIterations"] = [
+                str(
+                    min(
+                        n,
+                        max(min_iterations, int(ceil(n * iteration_fraction))),
+                    )
+                )
+                for n in _per_resolution_values(
+                    reg_model, "MaximumNumberOfIterations"
+                )
+            ]
+        calibration_params.append(reg_model)
+    return calibration_params
+
+
+def calibrate_reg_models(
+    reg_params: List[Dict[str, List[str]]],
+    calibration_iter_data: Dict[int, Dict[int, Dict[str, np.ndarray]]],
+    convergence: ConvergenceParams,
+) -> Tuple[List[Dict[str, List[str]]], Dict[int, Dict[int, Dict[str, int]]]]:
+    """
+    Set per-resolution `MaximumNumberOfIterations` of registration models from the
+    iteration data of a calibration registration.
+
+    Parameters
+    ----------
+    reg_params: list of dict
+        elastix registration parameter maps
+    calibration_iter_data: Dict[int, Dict[int, Dict[str, np.ndarray]]]
+        iteration data of the calibration registration as read by
+        wsireg.utils.output_utils.read_elastix_iteration_dir
+    convergence: ConvergenceParams
+        convergence settings
+
+    Returns
+    -------
+    calibrated_params: list of dict
+        copies of the registration models with calibrated iterations
+    iteration_counts: Dict[int, Dict[int, Dict[str, int]]]
+        "max_iterations" of the model and "calibrated_iterations" for each model and resolution
+    """
+    calibrated_params = deepcopy(reg_params)
+    iteration_counts = dict()
+    for model_idx, reg_model in enumerate(calibrated_params):
+        if "MaximumNumberOfIterations" not in reg_model:
+            continue
+        max_iterations = _per_resolution_values(
+            reg_model, "MaximumNumberOfIterations"
+        )
+        model_iter_data = calibration_iter_data.get(model_idx, dict())
+        calibrated_iterations = []
+        for res_idx, res_max_iterations in enumerate(max_iterations):
+            res_iter_data = model_iter_data.get(res_idx)
+            if res_iter_data is None:
+                calibrated_iterations.append(res_max_iterations)
+                continue
+            n_converged = metric_convergence_iteration(
+                res_iter_data["metric"],
+                convergence.rel_tol,
+                convergence.window,
+            )
+            if n_converged >= len(res_iter_data["metric"]):
+                # not converged within the calibration iterations
+                calibrated_iterations.append(res_max_iterations)
+                continue
+            n_iterations = max(
+                convergence.min_iterations,
+                int(ceil(n_converged * convergence.margin)),
+            )
+            calibrated_iterations.append(min(n_iterations, res_max_iterations))
+
+        reg_model["MaximumNumberOfIterations"] = [
+            str(n) for n in calibrated_iterations
+        ]
+        iteration_counts[model_idx] = {
+            res_idx: {
+                "max_iterations": max_it,
+                "calibrated_iterations": cal_it,
+            }
+            for res_idx, (max_it, cal_it) in enumerate(
+                zip(max_iterations, calibrated_iterations)
+            )
+        }
+
+    return calibrated_params, iteration_counts
+
+
 def parameter_to_itk_pobj(reg_param_map):
     """
     Transfer parameter data stored in dict to ITKElastix ParameterObject
@@ -138,9 +308,12 @@ def register_2d_images_itkelx(
     source_image,
     target_image,
     reg_params: List[Dict[str, List[str]]],
-    reg_output_fp: Union[str, Path],
+    reg_output_fp: Optional[Union[str, Path]],
     histogram_match=False,
     return_image=False,
+    initial_transforms: Optional[List[Dict[str, List[str]]]] = None,
+    log_to_console: bool = True,
+    n_threads: Optional[int] = None,
 ):
     """
     Register 2D images with multiple models and return a list of elastix
@@ -156,13 +329,24 @@ def register_2d_images_itkelx(
         registration parameter maps stored in a dict, can be file paths to SimpleElastix parameterMaps stored
         as text or one of the default parameter maps (see parameter_load() function)
     reg_output_fp : str
-        where to store registration outputs (iteration data and transformation files)
+        where to store registration outputs (iteration data and transformation files),
+        None writes no outputs
     histogram_match : bool
         whether to attempt histogram matching to improve registration
+    return_image : bool
+        whether to return the registered moving image
+    initial_transforms : list of dict
+        elastix transformation maps from a previous registration used as a fixed
+        initial transform, only `reg_params` are optimized
+    log_to_console : bool
+        whether elastix prints its log to the console
+    n_threads : int
+        number of threads elastix uses, defaults to the ITK global default
     Returns
     -------
         tform_list: list
-            list of ITKElastix transformation parameter maps
+            list of ITKElastix transformation parameter maps, always the
+            `initial_transforms` followed by one map per model in `reg_params`
         image: itk.Image
             resulting registered moving image
     """
@@ -175,7 +359,6 @@ def register_2d_images_itkelx(
             source_image.reg_image, target_image.reg_image
         )
 
-    pixel_id = source_image.reg_image.GetPixelID()
     source_image.reg_image_sitk_to_itk()
     target_image.reg_image_sitk_to_itk()
 
@@ -184,8 +367,11 @@ def register_2d_images_itkelx(
     )
 
     # Set additional options
-    selx.SetLogToConsole(True)
-    selx.SetOutputDirectory(str(reg_output_fp))
+    selx.SetLogToConsole(log_to_console)
+    if n_threads:
+        selx.SetNumberOfThreads(n_threads)
+    if reg_output_fp is not None:
+        selx.SetOutputDirectory(str(reg_output_fp))
 
     if source_image.mask is not None:
         selx.SetMovingMask(source_image.mask)
@@ -196,9 +382,15 @@ def register_2d_images_itkelx(
     selx.SetMovingImage(source_image.reg_image)
     selx.SetFixedImage(target_image.reg_image)
 
+    if initial_transforms:
+        parameter_object_initial = itk.ParameterObject.New()
+        for tform in initial_transforms:
+            parameter_object_initial.AddParameterMap(tform)
+        selx.SetInitialTransformParameterObject(parameter_object_initial)
+
     parameter_object_registration = itk.ParameterObject.New()
     for idx, pmap in enumerate(reg_params):
-        if idx == 0:
+        if idx == 0 and not initial_transforms:
             pmap["WriteResultImage"] = ["true"] if return_image else ["false"]
             if target_image.mask is not None:
                 pmap["AutomaticTransformInitialization"] = ["false"]
@@ -232,5 +424,5 @@ def register_2d_images_itkelx(
     else:
         image = selx.GetOutput()
         image = itk_image_to_sitk_image(image)
-        image = sitk.Cast(image, pixel_id)
+        image = sitk.Cast(image, source_image.reg_image_pixel_id)
         return tform_list, image
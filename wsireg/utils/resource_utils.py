@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+import re
+from typing import Optional, Union
+
+import dask
+import itk
+import SimpleITK as sitk
+
+# process-wide CPU and memory budget shared by registration, resampling and writing
+_RESOURCE_LIMITS = {"n_threads": None, "memory_limit": None}
+
+_MEMORY_UNITS = {
+    "": 1,
+    "B": 1,
+    "KB": 1024,
+    "MB": 1024**2,
+    "GB": 1024**3,
+    "TB": 1024**4,
+}
+
+
+def parse_memory_limit(memory_limit: Union[int, str]) -> int:
+    """
+    Parse a memory limit to bytes.
+
+    Parameters
+    ----------
+    memory_limit: int or str
+        number of bytes or a string with a unit, i.e., "512MB", "16GB", "16G"
+
+    Returns
+    -------
+    memory_limit: int
+        memory limit in bytes
+    """
+    if isinstance(memory_limit, (int, float)):
+        return int(memory_limit)
+
+    match = re.fullmatch(
+        r"\s*([0-9.]+)\s*([KMGT]?)(I?B)?\s*", memory_limit.upper()
+    )
+    if match is None:
+        raise ValueError(f"could not parse memory limit: {memory_limit}")
+    value, unit, _ = match.groups()
+    unit = f"{unit}B" if unit else ""
+    return int(float(value) * _MEMORY_UNITS[unit])
+
+
+def set_resource_limits(
+    n_threads: Optional[int] = None,
+    memory_limit: Optional[Union[int, str]] = None,
+) -> None:
+    """
+    Set the CPU and memory budget of wsireg. The thread budget is applied to ITK/elastix,
+    SimpleITK and, when `n_threads` is given, to the dask scheduler and used to size wsireg's
+    own thread pools (tiled writing, CZI reading, parallel registration), the memory budget
+    bounds the number of tiles resampled concurrently.
+
+    Parameters
+    ----------
+    n_threads: int
+        maximum number of threads, None to use all CPUs
+    memory_limit: int or str
+        memory budget in bytes or as a string with a unit (i.e., "16GB"), None for no limit
+    """
+    if n_threads is not None and n_threads < 1:
+        raise ValueError(f"n_threads must be at least 1, got {n_threads}")
+
+    _RESOURCE_LIMITS["n_threads"] = n_threads
+    _RESOURCE_LIMITS["memory_limit"] = (
+        parse_memory_limit(memory_limit) if memory_limit is not None else None
+    )
+
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(get_n_threads())
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(get_n_threads())
+    # the dask configuration belongs to the caller, only change it when asked to
+    if n_threads is not None:
+        dask.config.set(scheduler="threads", num_workers=n_threads)
+
+
+def get_n_threads(n_parts: int = 1) -> int:
+    """
+    Number of threads available, optionally for one of `n_parts` concurrent tasks.
+
+    Parameters
+    ----------
+    n_parts: int
+        number of tasks sharing the budget
+
+    Returns
+    -------
+    n_threads: int
+        threads for each task, at least 1
+    """
+    n_threads = _RESOURCE_LIMITS["n_threads"]
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    return max(1, n_threads // max(1, n_parts))
+
+
+def get_memory_limit() -> Optional[int]:
+    """Memory budget in bytes, None when not limited."""
+    return _RESOURCE_LIMITS["memory_limit"]
+
+
+def get_system_memory() -> Optional[int]:
+    """Physical memory in bytes, None if it can't be determined."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_memory_budget() -> Optional[int]:
+    """Memory budget in bytes, half of the physical memory when not limited, None if
+    neither is known."""
+    memory_limit = get_memory_limit()
+    if memory_limit is None:
+        system_memory = get_system_memory()
+        memory_limit = system_memory // 2 if system_memory else None
+    return memory_limit
+
+
+def workers_for_memory(max_workers: int, bytes_per_worker: int) -> int:
+    """
+    Reduce a number of workers so their combined memory use stays within the memory budget.
+
+    Parameters
+    ----------
+    max_workers: int
+        number of workers allowed by the thread budget
+    bytes_per_worker: int
+        estimated peak memory of one worker
+
+    Returns
+    -------
+    n_workers: int
+        number of workers, at least 1
+    """
+    memory_limit = get_memory_limit()
+    if memory_limit is None or bytes_per_worker <= 0:
+        return max_workers
+    return max(1, min(max_workers, memory_limit // bytes_per_worker))
+
+
+def get_compression_workers(compression_workers: Optional[int] = None) -> int:
+    """
+    Number of threads encoding TIFF tiles, passed to tifffile as `maxworkers`.
+
+    Parameters
+    ----------
+    compression_workers: int
+        requested number of threads, None to use the thread budget
+
+    Returns
+    -------
+    n_workers: int
+        number of encoding threads
+    """
+    if compression_workers is None:
+        return get_n_threads()
+    if compression_workers < 1:
+        raise ValueError(
+            f"compression_workers must be at least 1, got {compression_workers}"
+        )
+    return compression_workers
@@ -9,7 +9,10 @@ import numpy as np
 import SimpleITK as sitk
 
 from wsireg.reg_transforms.reg_transform import RegTransform
-from wsireg.utils.tform_utils import wsireg_transforms_to_itk_composite
+from wsireg.utils.tform_utils import (
+    transform_pts_batch,
+    wsireg_transforms_to_itk_composite,
+)
 
 GJ_SHAPE_TYPE = {
     "polygon": geojson.Polygon,
@@ -265,7 +268,7 @@ def scale_shape_coordinates(poly: dict, scale_factor: float):
     return poly
 
 
-def invert_nonrigid_transforms(itk_transforms: list):
+def invert_nonrigid_transforms(itk_transforms: list, grid_factor: int = 1):
     """
     Check list of sequential ITK transforms for non-linear (i.e., bspline) transforms
     Transformations need to be inverted to transform from moving to fixed space as transformations
@@ -278,6 +281,8 @@ def invert_nonrigid_transforms(itk_transforms: list):
     ----------
     itk_transforms:list
         list of itk.Transform
+    grid_factor: int
+        invert on a displacement field grid this many times coarser than the registration grid
 
     Returns
     -------
@@ -297,7 +302,9 @@ def invert_nonrigid_transforms(itk_transforms: list):
                     "inverting displacement field(s)...\n"
                     "this can take some time"
                 )
-                itk_transforms[nl_idx].compute_inverse_nonlinear()
+                itk_transforms[nl_idx].compute_inverse_nonlinear(
+                    grid_factor=grid_factor
+                )
 
     return itk_transforms
 
@@ -370,21 +377,17 @@ def itk_transform_pts(
         transformed points array where rows are points and columns are x,y
 
     """
-    tformed_pts = []
-    for pt in pt_data:
-        if px_idx is True:
-            pt = pt * source_res
-        for idx, t in enumerate(itk_transforms):
-            if idx == 0:
-                t_pt = t.inverse_transform.TransformPoint(pt)
-            else:
-                t_pt = t.inverse_transform.TransformPoint(t_pt)
-        t_pt = np.array(t_pt)
-        if output_idx is True:
-            t_pt *= 1 / target_res
-        tformed_pts.append(t_pt)
+    pt_data = np.asarray(pt_data, dtype=np.float64)
+    if px_idx is True:
+        pt_data = pt_data * source_res
+
+    tformed_pts = transform_pts_batch(
+        pt_data, [t.inverse_transform for t in itk_transforms]
+    )
+    if output_idx is True:
+        tformed_pts *= 1 / target_res
 
-    return np.stack(tformed_pts)
+    return tformed_pts
 
 
 def transform_shapes(
@@ -420,18 +423,24 @@ def transform_shapes(
         transformed_shape_data:list
             list of transformed np.ndarray data where rows are points and columns are x,y
     """
+    if len(shape_data) == 0:
+        return []
+
+    # transform all shapes in one batch, then split them up again
+    shape_pts = [np.asarray(sh.get("array")) for sh in shape_data]
+    split_idx = np.cumsum([len(pts) for pts in shape_pts])[:-1]
+    all_t_pts = itk_transform_pts(
+        np.concatenate(shape_pts),
+        itk_transforms,
+        px_idx=px_idx,
+        source_res=source_res,
+        output_idx=output_idx,
+        target_res=target_res,
+    )
+
     transformed_shape_data = []
-    for sh in shape_data:
+    for sh, t_pts in zip(shape_data, np.split(all_t_pts, split_idx)):
         t_ptset = deepcopy(sh)
-        ptset = sh.get("array")
-        t_pts = itk_transform_pts(
-            ptset,
-            itk_transforms,
-            px_idx=px_idx,
-            source_res=source_res,
-            output_idx=output_idx,
-            target_res=target_res,
-        )
         t_ptset["array"] = t_pts
         transformed_shape_data.append(t_ptset)
 
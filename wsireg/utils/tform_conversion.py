@@ -1,5 +1,6 @@
 from copy import deepcopy
 
+import numpy as np
 import SimpleITK as sitk
 
 
@@ -62,7 +63,9 @@ def bspline_elx_to_itk2d(tform):
     fixedParams += [float(p) for p in tform['GridSpacing']]
     fixedParams += [float(p) for p in tform['GridDirection']]
     bspline2d.SetFixedParameters(fixedParams)
-    bspline2d.SetParameters([float(p) for p in tform['TransformParameters']])
+    bspline2d.SetParameters(
+        np.asarray(tform['TransformParameters'], dtype=np.float64).tolist()
+    )
     return bspline2d
 
 
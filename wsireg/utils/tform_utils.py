@@ -1,6 +1,8 @@
 import json
+import zipfile
+from copy import deepcopy
 from pathlib import Path
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import itk
 import numpy as np
@@ -490,6 +492,220 @@ def make_composite_itk(itk_tforms):
     return itk_composite
 
 
+def affine_matrix_to_elx_tform(
+    affine_matrix: np.ndarray, template_tform: dict
+) -> dict:
+    """
+    Convert a homogeneous affine matrix to an elastix AffineTransform parameter map.
+
+    Parameters
+    ----------
+    affine_matrix: np.ndarray
+        3x3 homogeneous matrix in physical coordinates with the center of rotation at 0,0
+    template_tform: dict
+        elastix transform from which output size, spacing, origin, direction
+        and interpolator are taken
+
+    Returns
+    -------
+    tform: dict
+        elastix AffineTransform parameter map
+    """
+    tform = deepcopy(BASE_AFF_TFORM)
+    for key in ["Size", "Index", "Spacing", "Origin", "Direction"]:
+        tform[key] = [str(p) for p in template_tform[key]]
+    tform["ResampleInterpolator"] = [
+        str(template_tform["ResampleInterpolator"][0])
+    ]
+    tform["CenterOfRotationPoint"] = ["0.0", "0.0"]
+    tform["TransformParameters"] = [
+        str(float(p)) for p in affine_matrix[:2, :2].ravel()
+    ] + [str(float(p)) for p in affine_matrix[:2, 2]]
+    return tform
+
+
+def collapse_linear_transforms(
+    reg_transforms: List[RegTransform],
+) -> List[RegTransform]:
+    """
+    Merge runs of adjacent linear transforms into a single affine transform.
+    Non-linear transforms are kept in place, so the result evaluates to the same
+    mapping with fewer transforms in the composite.
+
+    Parameters
+    ----------
+    reg_transforms: list of RegTransform
+        Transforms in ITK composite order
+
+    Returns
+    -------
+    collapsed_transforms: list of RegTransform
+        Transforms in ITK composite order where each run of linear transforms
+        has been replaced by one AffineTransform
+    """
+    collapsed_transforms = []
+    linear_run = []
+
+    def _close_run():
+        if len(linear_run) == 1:
+            collapsed_transforms.append(linear_run[0])
+        elif len(linear_run) > 1:
+            # composite order, the last transform is applied first
+            composed_matrix = np.eye(3)
+            for rt in linear_run:
+                composed_matrix = composed_matrix @ linear_transform_to_matrix(
+                    rt.itk_transform
+                )
+            affine_tform = affine_matrix_to_elx_tform(
+                composed_matrix, linear_run[-1].elastix_transform
+            )
+            collapsed_transforms.append(RegTransform(affine_tform))
+        linear_run.clear()
+
+    for rt in reg_transforms:
+        if rt.is_linear:
+            linear_run.append(rt)
+        else:
+            _close_run()
+            collapsed_transforms.append(rt)
+    _close_run()
+
+    return collapsed_transforms
+
+
+def linear_transform_to_matrix(transform: sitk.Transform) -> np.ndarray:
+    """
+    Homogeneous matrix of any linear SimpleITK transform, found by transforming
+    the origin and the unit vectors.
+
+    Parameters
+    ----------
+    transform: sitk.Transform
+        2D linear transform
+
+    Returns
+    -------
+    matrix: np.ndarray
+        3x3 homogeneous matrix in physical coordinates
+    """
+    t_origin = np.asarray(transform.TransformPoint((0.0, 0.0)))
+    t_x = np.asarray(transform.TransformPoint((1.0, 0.0)))
+    t_y = np.asarray(transform.TransformPoint((0.0, 1.0)))
+
+    matrix = np.eye(3)
+    matrix[:2, 0] = t_x - t_origin
+    matrix[:2, 1] = t_y - t_origin
+    matrix[:2, 2] = t_origin
+    return matrix
+
+
+def sample_displacement_field(
+    displacement_field: sitk.Image, pts: np.ndarray
+) -> np.ndarray:
+    """
+    Sample a displacement field at physical points with bilinear interpolation,
+    matching ITK's linear interpolation of DisplacementFieldTransform. Points outside
+    of the field are not displaced.
+
+    Parameters
+    ----------
+    displacement_field: sitk.Image
+        2D vector image of displacements
+    pts: np.ndarray
+        array where rows are points and columns are x,y in physical coordinates
+
+    Returns
+    -------
+    displacements: np.ndarray
+        displacement of each point
+    """
+    field = sitk.GetArrayViewFromImage(displacement_field)
+    size = np.asarray(displacement_field.GetSize())
+    origin = np.asarray(displacement_field.GetOrigin())
+    spacing = np.asarray(displacement_field.GetSpacing())
+    direction = np.asarray(displacement_field.GetDirection()).reshape(2, 2)
+
+    phys_to_index = np.linalg.inv(direction @ np.diag(spacing))
+    cont_idx = (pts - origin) @ phys_to_index.T
+
+    inside = np.all((cont_idx >= -0.5) & (cont_idx < size - 0.5), axis=1)
+
+    base_idx = np.maximum(np.floor(cont_idx).astype(np.int64), 0)
+    base_idx = np.minimum(base_idx, size - 1)
+    dist = np.clip(cont_idx - base_idx, 0, 1)
+    next_idx = np.minimum(base_idx + 1, size - 1)
+
+    x0, y0 = base_idx[:, 0], base_idx[:, 1]
+    x1, y1 = next_idx[:, 0], next_idx[:, 1]
+    dx, dy = dist[:, 0:1], dist[:, 1:2]
+
+    displacements = (
+        field[y0, x0] * (1 - dx) * (1 - dy)
+        + field[y0, x1] * dx * (1 - dy)
+        + field[y1, x0] * (1 - dx) * dy
+        + field[y1, x1] * dx * dy
+    )
+    displacements[~inside] = 0
+    return displacements
+
+
+def transform_pts_batch(
+    pts: np.ndarray, transforms: List[sitk.Transform]
+) -> np.ndarray:
+    """
+    Apply a sequence of SimpleITK transforms to an array of points. Runs of linear
+    transforms are composed into one matrix applied with numpy, displacement fields are
+    sampled with vectorized bilinear interpolation, other transforms fall back to
+    transforming point by point.
+
+    Parameters
+    ----------
+    pts: np.ndarray
+        array where rows are points and columns are x,y in physical coordinates
+    transforms: list of sitk.Transform
+        transforms in the order they are applied
+
+    Returns
+    -------
+    tformed_pts: np.ndarray
+        transformed points
+    """
+    # copy so the caller's points are never modified in place
+    tformed_pts = np.array(pts, dtype=np.float64).reshape(-1, 2)
+    linear_matrix = None
+
+    def _apply_linear(pts_in, matrix):
+        if matrix is None:
+            return pts_in
+        return pts_in @ matrix[:2, :2].T + matrix[:2, 2]
+
+    for transform in transforms:
+        if transform.IsLinear():
+            matrix = linear_transform_to_matrix(transform)
+            linear_matrix = (
+                matrix if linear_matrix is None else matrix @ linear_matrix
+            )
+            continue
+
+        tformed_pts = _apply_linear(tformed_pts, linear_matrix)
+        linear_matrix = None
+
+        if transform.GetName() == "DisplacementFieldTransform":
+            dfield = sitk.DisplacementFieldTransform(
+                transform
+            ).GetDisplacementField()
+            tformed_pts = tformed_pts + sample_displacement_field(
+                dfield, tformed_pts
+            )
+        else:
+            tformed_pts = np.asarray(
+                [transform.TransformPoint(pt) for pt in tformed_pts.tolist()],
+                dtype=np.float64,
+            ).reshape(-1, 2)
+
+    return _apply_linear(tformed_pts, linear_matrix)
+
+
 def get_final_tform(parameter_data):
     if (
         isinstance(parameter_data, str)
@@ -587,3 +803,122 @@ def identity_elx_transform(
     identity.update({"Size": [str(i) for i in image_size]})
     identity.update({"Spacing": [str(i) for i in image_spacing]})
     return identity
+
+
+def elastix_transform_to_txt(tform: dict) -> dict:
+    """
+    Convert an elastix transform whose parameters were loaded as arrays back to
+    elastix's list-of-strings representation.
+
+    Parameters
+    ----------
+    tform: dict
+        elastix transform, values are lists of str or np.ndarray
+
+    Returns
+    -------
+    tform: dict
+        elastix transform with all values as lists of str
+    """
+    return {
+        k: [str(p) for p in v.tolist()] if isinstance(v, np.ndarray) else v
+        for k, v in tform.items()
+    }
+
+
+def write_wsireg_transform_npz(
+    tform_data: dict, output_path: Union[str, Path]
+) -> str:
+    """
+    Write wsireg transformation data to a binary .npz file. Transform parameters are stored as
+    float64 arrays and the remaining, small, elastix parameters as a JSON header so
+    fine-grid B-spline transforms don't have to be parsed from text when loaded.
+
+    Parameters
+    ----------
+    tform_data: dict
+        wsireg transformation data, as written to the JSON transformation file
+    output_path: str or Path
+        path of the .npz file
+
+    Returns
+    -------
+    output_path: str
+        path of the written file
+    """
+    header = {}
+    arrays = {}
+    for key, tforms in tform_data.items():
+        is_dict = isinstance(tforms, dict)
+        header_tforms = []
+        for idx, tform in enumerate([tforms] if is_dict else tforms):
+            header_tform = dict(tform)
+            arrays[f"{key}/{idx}/TransformParameters"] = np.asarray(
+                header_tform.pop("TransformParameters"), dtype=np.float64
+            )
+            header_tforms.append(header_tform)
+        header[key] = header_tforms[0] if is_dict else header_tforms
+
+    np.savez(output_path, header=np.asarray(json.dumps(header)), **arrays)
+    return str(output_path)
+
+
+def _npz_member_memmap(
+    input_path: Union[str, Path], zip_info: zipfile.ZipInfo
+) -> np.memmap:
+    """Memory-map an uncompressed array of an .npz file without reading its data."""
+    with open(input_path, "rb") as f:
+        f.seek(zip_info.header_offset)
+        local_header = f.read(30)
+        name_len = int.from_bytes(local_header[26:28], "little")
+        extra_len = int.from_bytes(local_header[28:30], "little")
+        f.seek(zip_info.header_offset + 30 + name_len + extra_len)
+        if np.lib.format.read_magic(f) == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+    return np.memmap(
+        input_path,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+def read_wsireg_transform_npz(input_path: Union[str, Path]) -> dict:
+    """
+    Read wsireg transformation data written by `write_wsireg_transform_npz`. The transform
+    parameters are memory-mapped, so they are only read from disk when they are used.
+
+    Parameters
+    ----------
+    input_path: str or Path
+        path of the .npz file
+
+    Returns
+    -------
+    tform_data: dict
+        wsireg transformation data, "TransformParameters" of each transform
+        are np.ndarrays of float64
+    """
+    with np.load(input_path, allow_pickle=False) as npz_data:
+        tform_data = json.loads(str(npz_data["header"]))
+        zip_infos = {
+            zip_info.filename[: -len(".npy")]: zip_info
+            for zip_info in npz_data.zip.infolist()
+        }
+        for key, tforms in tform_data.items():
+            for idx, tform in enumerate(
+                [tforms] if isinstance(tforms, dict) else tforms
+            ):
+                zip_info = zip_infos[f"{key}/{idx}/TransformParameters"]
+                if zip_info.compress_type == zipfile.ZIP_STORED:
+                    params = _npz_member_memmap(input_path, zip_info)
+                else:
+                    params = npz_data[f"{key}/{idx}/TransformParameters"]
+                tform["TransformParameters"] = params
+    return tform_data
@@ -0,0 +1,416 @@
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+from wsireg.reg_images.reg_image import RegImage
+from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
+from wsireg.utils.resource_utils import get_memory_budget, get_n_threads
+from wsireg.writers.tiled_ome_tiff_writer import DEFAULT_CHUNK_CACHE_BYTES
+
+# readers without a chunked dask image can only be written plane-by-plane
+PLANE_ONLY_READERS = ["czi", "sitk"]
+
+# tile sizes tried by the tiled writer, largest first
+AUTO_TILE_SIZES = [512, 256, 128]
+
+# fixed work per tile of the tiled writer (footprint mapping, resampler setup)
+# as a fraction of the pixels of the tile
+TILE_OVERHEAD_FRACTION = 0.25
+
+# growth of the moving footprint of a tile under a non-linear transform
+NONLINEAR_FOOTPRINT_FACTOR = 1.5
+
+
+class WriterChoice(NamedTuple):
+    """
+    Writer chosen for an image by `choose_file_writer`.
+    """
+
+    file_writer: str
+    tile_size: int
+    zarr_tile_size: int
+    plane_memory: int
+    tile_memory: int
+    memory_budget: Optional[int]
+    reason: str
+
+
+def _image_geometry(reg_image: RegImage, reg_transform_seq: RegTransformSeq):
+    """Input and output plane pixels, itemsize and number of components resampled together."""
+    y_in, x_in = (
+        reg_image.shape[:2] if reg_image.is_rgb else reg_image.shape[-2:]
+    )
+    x_out, y_out = reg_transform_seq.output_size
+    itemsize = np.dtype(reg_image.im_dtype).itemsize
+    n_comp = reg_image.shape[-1] if reg_image.is_rgb else 1
+    return int(y_in) * int(x_in), int(y_out) * int(x_out), itemsize, n_comp
+
+
+def _moving_tile_area(
+    reg_image: RegImage, reg_transform_seq: RegTransformSeq, tile_size: int
+) -> float:
+    """Estimated moving pixels read for one output tile."""
+    scale = (
+        float(np.mean(reg_transform_seq.output_spacing)) / reg_image.image_res
+    )
+    area = (tile_size * scale + 4) ** 2
+    if not all(rt.is_linear for rt in reg_transform_seq.reg_transforms):
+        area *= NONLINEAR_FOOTPRINT_FACTOR
+    return area
+
+
+def _zarr_tile_size(reg_image: RegImage, tile_size: int) -> int:
+    """Zarr tile size of the tiled writer, 4 tiles and at least the yx chunks of the image
+    rounded up to whole tiles, as the tiled writer does not accept chunks larger than its
+    zarr tiles."""
+    if reg_image.reader in PLANE_ONLY_READERS:
+        return 4 * tile_size
+    yx_chunks = (
+        reg_image.dask_image.chunksize[:2]
+        if reg_image.is_rgb
+        else reg_image.dask_image.chunksize[-2:]
+    )
+    return max(
+        4 * tile_size, int(np.ceil(max(yx_chunks) / tile_size)) * tile_size
+    )
+
+
+def estimate_plane_writer_memory(
+    reg_image: RegImage,
+    reg_transform_seq: RegTransformSeq,
+    prefetch_channels: int = 1,
+) -> int:
+    """
+    Peak memory in bytes of `OmeTiffWriter.write_image_by_plane`: the input planes held
+    at once (all channels for RGB images and the sitk reader, the channel being written and
+    the prefetched ones otherwise), one copy made when converting a plane to sitk
+    and the sub-resolutions of the pyramid (1/3 of the output plane).
+
+    Parameters
+    ----------
+    reg_image: RegImage
+        image to be written
+    reg_transform_seq: RegTransformSeq
+        transformations to be applied
+    prefetch_channels: int
+        number of channels read ahead of the channel being written
+
+    Returns
+    -------
+    n_bytes: int
+        estimated peak memory
+    """
+    in_pixels, out_pixels, itemsize, n_comp = _image_geometry(
+        reg_image, reg_transform_seq
+    )
+    if reg_image.is_rgb or reg_image.reader == "sitk":
+        planes_held = reg_image.n_ch
+    else:
+        planes_held = 1 + min(prefetch_channels, reg_image.n_ch - 1)
+    return int(
+        (planes_held + 1) * in_pixels * itemsize
+        + out_pixels * n_comp * itemsize / 3
+    )
+
+
+def estimate_tile_writer_memory(
+    reg_image: RegImage,
+    reg_transform_seq: RegTransformSeq,
+    tile_size: int = 512,
+    n_workers: int = 1,
+    memory_limit: Optional[int] = None,
+) -> int:
+    """
+    Peak memory in bytes of the streamed `OmeTiffTiledWriter.write_image_by_tile`: the tiles
+    resampled concurrently with all their channels (moving footprint and output tile as
+    float32, and the displacement field of the tile under non-linear transforms), the tiles
+    waiting to be written, at most a band of rows of tiles resampled out of order, the moving chunk cache, the strip being assembled, the channels
+    buffered until their plane is written and the sub-resolutions of the pyramid. The
+    buffered channels and the sub-resolutions are memory-mapped beyond half of the memory
+    budget.
+
+    Parameters
+    ----------
+    reg_image: RegImage
+        image to be written
+    reg_transform_seq: RegTransformSeq
+        transformations to be applied
+    tile_size: int
+        tile size of the output
+    n_workers: int
+        number of tiles resampled concurrently
+    memory_limit: int
+        memory budget in bytes, None for no limit, the sub-resolutions are then memory-mapped
+        against the default budget (see `get_memory_budget`)
+
+    Returns
+    -------
+    n_bytes: int
+        estimated peak memory
+    """
+    in_pixels, out_pixels, itemsize, n_comp = _image_geometry(
+        reg_image, reg_transform_seq
+    )
+    x_out, _ = reg_transform_seq.output_size
+    tile_area = tile_size**2
+    # all channels of a tile are resampled together
+    n_tile_comp = n_comp if reg_image.is_rgb else reg_image.n_ch
+
+    worker_bytes = (
+        (
+            _moving_tile_area(reg_image, reg_transform_seq, tile_size)
+            + tile_area
+        )
+        * n_tile_comp
+        * max(itemsize, 4)
+    )
+    if not all(rt.is_linear for rt in reg_transform_seq.reg_transforms):
+        # displacement field of the tile, 2D vectors of float64
+        worker_bytes += tile_area * 2 * 8
+    chunk_y = (
+        reg_image.dask_image.chunksize[0]
+        if reg_image.is_rgb
+        else reg_image.dask_image.chunksize[-2]
+    )
+    band_rows = max(2, chunk_y // tile_size)
+    queued_bytes = (
+        max(2 * n_workers * tile_area, band_rows * tile_size * x_out)
+        * n_tile_comp
+        * itemsize
+    )
+    strip_bytes = tile_size * x_out * n_tile_comp * itemsize
+    cache_bytes = min(
+        DEFAULT_CHUNK_CACHE_BYTES
+        if memory_limit is None
+        else min(DEFAULT_CHUNK_CACHE_BYTES, memory_limit // 4),
+        in_pixels * reg_image.n_ch * itemsize,
+    )
+    pyramid_bytes = out_pixels * n_comp * itemsize / 3
+    memory_budget = (
+        memory_limit if memory_limit is not None else get_memory_budget()
+    )
+    if memory_budget is not None and pyramid_bytes > memory_budget // 2:
+        pyramid_bytes = 0
+    buffered_bytes = (n_tile_comp - n_comp) * out_pixels * itemsize
+    if memory_budget is not None and buffered_bytes > memory_budget // 2:
+        buffered_bytes = 0
+
+    return int(
+        n_workers * worker_bytes
+        + queued_bytes
+        + strip_bytes
+        + cache_bytes
+        + buffered_bytes
+        + pyramid_bytes
+    )
+
+
+def _print_choice(choice: WriterChoice, image_kind: str = "") -> WriterChoice:
+    """Print the writer chosen, its memory estimates and the reason for the choice."""
+    budget = (
+        f"{choice.memory_budget / 1024**2:.0f} MB"
+        if choice.memory_budget is not None
+        else "unlimited"
+    )
+    print(
+        f"auto writer: {image_kind}{choice.file_writer} with {choice.tile_size} px tiles, "
+        f"estimated peak memory by plane {choice.plane_memory / 1024**2:.0f} MB, "
+        f"by tile {choice.tile_memory / 1024**2:.0f} MB, budget {budget}: {choice.reason}"
+    )
+    return choice
+
+
+def choose_file_writer(
+    reg_image: RegImage,
+    reg_transform_seq: Optional[RegTransformSeq],
+    memory_limit: Optional[int] = None,
+) -> WriterChoice:
+    """
+    Choose between the plane-by-plane ("ome.tiff") and the streamed tile-by-tile
+    ("ome.tiff-bytile") OME-TIFF writers and their tile sizes from the estimated peak memory
+    and cost of each.
+
+    The plane writer is used if it fits in the memory budget and costs less than the tiled
+    writer. Its cost is reading the whole input planes and resampling the output planes. The
+    tiled writer only reads the moving footprints of its tiles, but pays a fixed overhead per
+    tile, so it is chosen for images too large for the budget and for outputs covering a small
+    part of the input. Its tile size is the largest that fits in the budget, its zarr tile size
+    4 tiles or the chunk size of the image if larger.
+
+    Parameters
+    ----------
+    reg_image: RegImage
+        image to be written
+    reg_transform_seq: RegTransformSeq or None
+        transformations to be applied
+    memory_limit: int
+        memory budget in bytes, defaults to the memory budget of wsireg or, if it is not set,
+        half of the physical memory
+
+    Returns
+    -------
+    choice: WriterChoice
+        the writer, its tile and zarr tile sizes, the memory estimates of both writers and
+        the reason for the choice
+    """
+    if memory_limit is None:
+        memory_limit = get_memory_budget()
+
+    def _choice(file_writer, tile_size, plane_memory, tile_memory, reason):
+        return _print_choice(
+            WriterChoice(
+                file_writer,
+                tile_size,
+                _zarr_tile_size(reg_image, tile_size),
+                plane_memory,
+                tile_memory,
+                memory_limit,
+                reason,
+            )
+        )
+
+    if not reg_transform_seq:
+        return _choice(
+            "ome.tiff", AUTO_TILE_SIZES[0], 0, 0, "image is not transformed"
+        )
+
+    plane_memory = estimate_plane_writer_memory(reg_image, reg_transform_seq)
+
+    if reg_image.reader in PLANE_ONLY_READERS:
+        return _choice(
+            "ome.tiff",
+            AUTO_TILE_SIZES[0],
+            plane_memory,
+            0,
+            f"the {reg_image.reader} reader can only be written plane-by-plane",
+        )
+
+    n_threads = get_n_threads()
+    for tile_size in AUTO_TILE_SIZES:
+        single_worker_memory = estimate_tile_writer_memory(
+            reg_image, reg_transform_seq, tile_size, 1, memory_limit
+        )
+        if memory_limit is None or single_worker_memory <= memory_limit:
+            break
+    tile_memory = estimate_tile_writer_memory(
+        reg_image, reg_transform_seq, tile_size, n_threads, memory_limit
+    )
+
+    if memory_limit is not None and plane_memory > memory_limit:
+        return _choice(
+            "ome.tiff-bytile",
+            tile_size,
+            plane_memory,
+            tile_memory,
+            "plane-by-plane writing exceeds the memory budget",
+        )
+
+    in_pixels, out_pixels, _, _ = _image_geometry(reg_image, reg_transform_seq)
+    n_tiles = int(np.ceil(out_pixels / tile_size**2))
+    plane_cost = in_pixels + out_pixels
+    tile_cost = (
+        min(
+            in_pixels,
+            n_tiles
+            * _moving_tile_area(reg_image, reg_transform_seq, tile_size),
+        )
+        + out_pixels
+        + n_tiles * TILE_OVERHEAD_FRACTION * tile_size**2
+    )
+    if tile_cost < plane_cost:
+        return _choice(
+            "ome.tiff-bytile",
+            tile_size,
+            plane_memory,
+            tile_memory,
+            "tiles read less of the input than whole planes",
+        )
+    return _choice(
+        "ome.tiff",
+        AUTO_TILE_SIZES[0],
+        plane_memory,
+        tile_memory,
+        "plane-by-plane writing fits in the memory budget and costs less",
+    )
+
+
+def choose_merge_file_writer(
+    reg_images: List[RegImage],
+    reg_transform_seqs: List[Optional[RegTransformSeq]],
+    memory_limit: Optional[int] = None,
+) -> WriterChoice:
+    """
+    Choose the OME-TIFF writer of a merged image. The sub-images are written one after the
+    other, so the merged image is written tile-by-tile if any sub-image is (see
+    `choose_file_writer`), with the smallest tile size chosen for them and a zarr tile size
+    covering the chunks of all sub-images, and plane-by-plane otherwise or if a sub-image can
+    only be written plane-by-plane.
+
+    Parameters
+    ----------
+    reg_images: list of RegImage
+        sub-images to be merged
+    reg_transform_seqs: list of RegTransformSeq or None
+        transformations to be applied to each sub-image
+    memory_limit: int
+        memory budget in bytes, defaults to the memory budget of wsireg or, if it is not set,
+        half of the physical memory
+
+    Returns
+    -------
+    choice: WriterChoice
+        the writer, its tile and zarr tile sizes, the largest memory estimates of the
+        sub-images for both writers and the reason for the choice
+    """
+    if memory_limit is None:
+        memory_limit = get_memory_budget()
+
+    choices = [
+        choose_file_writer(reg_image, reg_transform_seq, memory_limit)
+        for reg_image, reg_transform_seq in zip(reg_images, reg_transform_seqs)
+    ]
+    plane_memory = max(choice.plane_memory for choice in choices)
+    tile_memory = max(choice.tile_memory for choice in choices)
+    tiled_choices = [
+        choice for choice in choices if choice.file_writer == "ome.tiff-bytile"
+    ]
+    plane_only_readers = sorted(
+        {
+            reg_image.reader
+            for reg_image in reg_images
+            if reg_image.reader in PLANE_ONLY_READERS
+        }
+    )
+
+    if tiled_choices and not plane_only_readers:
+        file_writer = "ome.tiff-bytile"
+        tile_size = min(choice.tile_size for choice in tiled_choices)
+        # all sub-images are written by the tiled writer
+        zarr_tile_size = max(
+            _zarr_tile_size(reg_image, tile_size) for reg_image in reg_images
+        )
+        reason = f"{len(tiled_choices)} of {len(choices)} sub-images are written tile-by-tile"
+    else:
+        file_writer = "ome.tiff"
+        tile_size = AUTO_TILE_SIZES[0]
+        zarr_tile_size = 4 * AUTO_TILE_SIZES[0]
+        reason = (
+            f"the {', '.join(plane_only_readers)} reader can only be written plane-by-plane"
+            if plane_only_readers
+            else "all sub-images are written plane-by-plane"
+        )
+        if memory_limit is not None and plane_memory > memory_limit:
+            reason += ", although it exceeds the memory budget"
+
+    return _print_choice(
+        WriterChoice(
+            file_writer,
+            tile_size,
+            zarr_tile_size,
+            plane_memory,
+            tile_memory,
+            memory_limit,
+            reason,
+        ),
+        image_kind="merged image ",
+    )
@@ -1,13 +1,14 @@
 from pathlib import Path
 from typing import List, Optional, Tuple, Union
 
-import cv2
+import dask.array as da
 import numpy as np
 import SimpleITK as sitk
 from tifffile import TiffWriter
 
 from wsireg.reg_images.reg_image import RegImage
 from wsireg.reg_images.merge_reg_image import MergeRegImage
+from wsireg.reg_images.np_reg_image import NumpyRegImage
 from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
 from wsireg.utils.im_utils import (
     SITK_TO_NP_DTYPE,
@@ -15,6 +16,12 @@ from wsireg.utils.im_utils import (
     get_pyramid_info,
     prepare_ome_xml_str,
 )
+from wsireg.utils.resource_utils import get_compression_workers
+from wsireg.writers.ome_tiff_writer import resample_bands
+from wsireg.writers.tiled_ome_tiff_writer import (
+    OmeTiffTiledWriter,
+    write_strip_pyramid,
+)
 
 
 class MergeOmeTiffWriter:
@@ -246,10 +253,13 @@ class MergeOmeTiffWriter:
         write_pyramid: bool = True,
         tile_size: int = 512,
         compression: Optional[str] = "default",
+        compression_workers: Optional[int] = None,
     ) -> str:
         """
          Write merged OME-TIFF image plane-by-plane to disk.
          RGB images will be de-interleaved with RGB channels written as separate planes.
+         Each channel is resampled in bands of `tile_size` rows and its pyramid is built from
+         the bands as they are written.
 
          Parameters
          ----------
@@ -268,6 +278,9 @@ class MergeOmeTiffWriter:
          compression: str
              tifffile string to pass to compression argument, defaults to "deflate" for minisblack
              and "jpeg" for RGB type images
+         compression_workers: int
+             Number of threads encoding tiles, defaults to the thread budget of wsireg.
+             Tiles are written in order
 
          Returns
          -------
@@ -293,6 +306,15 @@ class MergeOmeTiffWriter:
             compression=compression,
         )
 
+        n_pyr_levels = self.n_pyr_levels if write_pyramid else 1
+        options = dict(
+            tile=(self.tile_size, self.tile_size),
+            compression=self.compression,
+            photometric="minisblack",
+            metadata=None,
+            maxworkers=get_compression_workers(compression_workers),
+        )
+
         print(f"saving to {output_file_name}")
         with TiffWriter(output_file_name, bigtiff=True) as tif:
             for m_idx, merge_image in enumerate(self.reg_image.images):
@@ -324,20 +346,9 @@ class MergeOmeTiffWriter:
                     if image.GetPixelIDValue() != merge_dtype_sitk:
                         image = sitk.Cast(image, merge_dtype_sitk)
 
-                    if self.reg_transform_seqs[m_idx]:
-                        image = self.reg_transform_seqs[
-                            m_idx
-                        ].resampler.Execute(image)
-
-                    if isinstance(image, sitk.Image):
+                    if not self.reg_transform_seqs[m_idx]:
                         image = sitk.GetArrayFromImage(image)
 
-                    options = dict(
-                        tile=(tile_size, tile_size),
-                        compression=self.compression,
-                        photometric="minisblack",
-                        metadata=None,
-                    )
                     # write OME-XML to the ImageDescription tag of the first page
                     description = (
                         self.omexml
@@ -347,27 +358,210 @@ class MergeOmeTiffWriter:
                     # write channel data
                     print(
                         f" writing subimage index {m_idx} : {sub_image_names[m_idx]} - "
-                        f"channel index - {channel_idx} - shape: {image.shape}"
+                        f"channel index - {channel_idx}"
                     )
-                    tif.write(
-                        image,
+                    write_strip_pyramid(
+                        tif,
+                        resample_bands(
+                            [image],
+                            self.reg_transform_seqs[m_idx],
+                            self.tile_size,
+                        ),
+                        (self.y_size, self.x_size),
+                        np.dtype(merge_dtype_np),
+                        (self.tile_size, self.tile_size),
+                        n_pyr_levels,
+                        options,
                         subifds=self.subifds,
                         description=description,
-                        **options,
                     )
 
-                    if write_pyramid:
-                        for pyr_idx in range(1, self.n_pyr_levels):
-                            resize_shape = (
-                                self.pyr_levels[pyr_idx][0],
-                                self.pyr_levels[pyr_idx][1],
-                            )
-                            image = cv2.resize(
-                                image,
-                                resize_shape,
-                                cv2.INTER_LINEAR,
-                            )
+            return output_file_name
 
-                            tif.write(image, **options, subfiletype=1)
+    def _sub_image_tiled_writer(
+        self, m_idx: int, merge_dtype_np: np.dtype, zarr_tile_size: int = 2048
+    ) -> Optional[OmeTiffTiledWriter]:
+        """Tiled writer of a transformed sub-image, None if it is not transformed. The
+        sub-image is cast to the merge dtype before resampling, as when writing by plane,
+        and RGB components are moved to channels so each is resampled once."""
+        reg_transform_seq = (
+            self.reg_transform_seqs[m_idx] if self.reg_transform_seqs else None
+        )
+        if not reg_transform_seq:
+            return None
+
+        merge_image = self.reg_image.images[m_idx]
+        dask_image = merge_image.dask_image
+        if merge_image.is_rgb:
+            dask_image = da.moveaxis(dask_image, -1, 0)
+        if dask_image.dtype != merge_dtype_np:
+            dask_image = dask_image.astype(merge_dtype_np)
+
+        return OmeTiffTiledWriter(
+            NumpyRegImage(dask_image, merge_image.image_res),
+            reg_transform_seq=reg_transform_seq,
+            tile_size=self.tile_size,
+            zarr_tile_size=zarr_tile_size,
+        )
 
-            return output_file_name
+    def _sub_image_strips(
+        self,
+        m_idx: int,
+        tiled_writer: Optional[OmeTiffTiledWriter],
+        channel_idx: int,
+        merge_dtype_np: np.dtype,
+        max_workers: Optional[int],
+    ):
+        """Strips of `tile_size` rows of one channel of a sub-image in the merge dtype,
+        resampled tile-by-tile if the sub-image is transformed or read from its dask
+        array otherwise."""
+        if tiled_writer is not None:
+            yield from tiled_writer.strip_generator(channel_idx, max_workers)
+            return
+
+        dask_image = self.reg_image.images[m_idx].dask_image
+        for y in range(0, self.y_size, self.tile_size):
+            if self.reg_image.images[m_idx].is_rgb:
+                strip = dask_image[y : y + self.tile_size, :, channel_idx]
+            elif dask_image.ndim == 2:
+                strip = dask_image[y : y + self.tile_size, :]
+            else:
+                strip = dask_image[channel_idx, y : y + self.tile_size, :]
+            yield np.asarray(strip).astype(merge_dtype_np, copy=False)
+
+    def merge_write_image_by_tile(
+        self,
+        image_name: str,
+        sub_image_names: List[str],
+        output_dir: Union[Path, str] = "",
+        write_pyramid: bool = True,
+        tile_size: int = 512,
+        compression: Optional[str] = "default",
+        zarr_temp_dir: Optional[Union[str, Path]] = None,
+        max_workers: Optional[int] = None,
+        compression_workers: Optional[int] = None,
+        zarr_tile_size: int = 2048,
+    ) -> str:
+        """
+         Write merged OME-TIFF image tile-by-tile to disk.
+         Each transformed sub-image is resampled by an `OmeTiffTiledWriter` in a pool of workers
+         that read only the moving footprint of each tile, untransformed sub-images are read in strips.
+         Sub-images are cast to the merge dtype before resampling and all channels are streamed into
+         one OME-TIFF, so no channel plane is held in memory. RGB images will be de-interleaved with
+         RGB channels written as separate planes, each resampled once.
+
+         Parameters
+         ----------
+         image_name: str
+             Name to be written WITHOUT extension
+             for example if image_name = "cool_image" the file
+             would be "cool_image.ome.tiff"
+        sub_image_names: list of str
+            Names added before each channel of a given image to distinguish it.
+         output_dir: Path or str
+             Directory where the image will be saved
+         write_pyramid: bool
+             Whether to write the OME-TIFF with sub-resolutions or not
+         tile_size: int
+             What size to write OME-TIFF tiles to disk
+         compression: str
+             tifffile string to pass to compression argument, defaults to "deflate"
+         zarr_temp_dir: Path or str
+             Directory where pyramid levels that don't fit in the memory budget are stored
+         max_workers: int
+             Number of threads resampling tiles, defaults to the thread and memory budget of wsireg
+         compression_workers: int
+             Number of threads encoding tiles, defaults to the thread budget of wsireg.
+             Tiles are written in order
+         zarr_tile_size: int
+             Size of the tiles whose moving footprints bound the memory estimate of the tile
+             workers, see `OmeTiffTiledWriter`
+
+         Returns
+         -------
+         output_file_name: str
+             File path to the written OME-TIFF
+
+        """
+        _, merge_dtype_np = self._get_merge_dtype()
+
+        self._length_checks(sub_image_names)
+        self._create_channel_names(sub_image_names)
+        self._transform_check()
+
+        for merge_image in self.reg_image.images:
+            if merge_image.reader in ["czi", "sitk"]:
+                raise ValueError(
+                    f"tiled merge writing is not supported for the {merge_image.reader} reader, "
+                    "use merge_write_image_by_plane"
+                )
+
+        output_file_name = str(Path(output_dir) / f"{image_name}.ome.tiff")
+
+        self._prepare_image_info(
+            self.reg_image.images[0],
+            image_name,
+            merge_dtype_np,
+            reg_transform_seq=self.reg_transform_seqs[0]
+            if self.reg_transform_seqs
+            else None,
+            write_pyramid=write_pyramid,
+            tile_size=tile_size,
+            compression=compression,
+        )
+
+        n_pyr_levels = self.n_pyr_levels if write_pyramid else 1
+        options = dict(
+            tile=(self.tile_size, self.tile_size),
+            compression=self.compression,
+            photometric="minisblack",
+            metadata=None,
+            maxworkers=get_compression_workers(compression_workers),
+        )
+
+        print(f"saving to {output_file_name}")
+        with TiffWriter(output_file_name, bigtiff=True) as tif:
+            for m_idx, merge_image in enumerate(self.reg_image.images):
+                tiled_writer = self._sub_image_tiled_writer(
+                    m_idx, merge_dtype_np, zarr_tile_size
+                )
+
+                for channel_idx in range(merge_image.n_ch):
+                    # write OME-XML to the ImageDescription tag of the first page
+                    description = (
+                        self.omexml
+                        if channel_idx == 0 and m_idx == 0
+                        else None
+                    )
+                    print(
+                        f" writing subimage index {m_idx} : {sub_image_names[m_idx]} - "
+                        f"channel index - {channel_idx}"
+                    )
+                    write_strip_pyramid(
+                        tif,
+                        self._sub_image_strips(
+                            m_idx,
+                            tiled_writer,
+                            channel_idx,
+                            merge_dtype_np,
+                            max_workers,
+                        ),
+                        (self.y_size, self.x_size),
+                        np.dtype(merge_dtype_np),
+                        (self.tile_size, self.tile_size),
+                        n_pyr_levels,
+                        options,
+                        subifds=self.subifds,
+                        description=description,
+                        temp_dir=zarr_temp_dir,
+                    )
+
+                if (
+                    tiled_writer is not None
+                    and tiled_writer.chunk_cache is not None
+                ):
+                    print(
+                        f"moving chunk cache: {tiled_writer.chunk_cache.summary()}"
+                    )
+
+        return output_file_name
@@ -1,7 +1,8 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional, Tuple, Union
 
-import cv2
 import numpy as np
 import SimpleITK as sitk
 from tifffile import TiffWriter
@@ -13,6 +14,11 @@ from wsireg.utils.im_utils import (
     get_pyramid_info,
     prepare_ome_xml_str,
 )
+from wsireg.utils.resource_utils import (
+    get_compression_workers,
+    get_memory_limit,
+)
+from wsireg.writers.tiled_ome_tiff_writer import write_strip_pyramid
 
 
 class OmeTiffWriter:
@@ -141,6 +147,97 @@ class OmeTiffWriter:
         else:
             self.compression = compression
 
+    def _read_channel(self, channel_idx: int) -> Union[np.ndarray, sitk.Image]:
+        """Read a channel plane, as a sitk.Image with its spacing if it is to be transformed."""
+        image = self.reg_image.read_single_channel(channel_idx)
+        image = np.squeeze(image)
+        if self.reg_transform_seq:
+            image = sitk.GetImageFromArray(image)
+            image.SetSpacing(
+                (self.reg_image.image_res, self.reg_image.image_res)
+            )
+        return image
+
+    def _prefetch_depth(self, prefetch_channels: Optional[int] = None) -> int:
+        """Number of channels read ahead of the channel being written, at most
+        `prefetch_channels` (default 1) and as many input planes as fit in the memory budget
+        next to the plane being written, the copy made when a plane is converted to sitk and
+        the sub-resolutions of the pyramid (1/3 of the output plane)."""
+        if prefetch_channels is None:
+            prefetch_channels = 1
+        elif prefetch_channels < 0:
+            raise ValueError(
+                f"prefetch_channels must be at least 0, got {prefetch_channels}"
+            )
+
+        memory_limit = get_memory_limit()
+        if memory_limit is not None:
+            itemsize = np.dtype(self.reg_image.im_dtype).itemsize
+            y_size, x_size = (
+                self.reg_image.shape[:2]
+                if self.reg_image.is_rgb
+                else self.reg_image.shape[-2:]
+            )
+            plane_bytes = y_size * x_size * itemsize
+            x_out, y_out = (
+                self.reg_transform_seq.output_size
+                if self.reg_transform_seq
+                else (x_size, y_size)
+            )
+            pyramid_bytes = x_out * y_out * itemsize // 3
+            prefetch_channels = min(
+                prefetch_channels,
+                max(
+                    0,
+                    (memory_limit - 2 * plane_bytes - pyramid_bytes)
+                    // plane_bytes,
+                ),
+            )
+        return min(prefetch_channels, self.reg_image.n_ch - 1)
+
+    def _prefetched_channels(self, prefetch_channels: Optional[int] = None):
+        """Read channels in order while up to `prefetch_channels` following channels are
+        read by a background thread, so reading overlaps resampling and writing. A yielded
+        plane is only referenced by the caller, so at most `prefetch_channels` + 1 planes
+        are held if the caller releases each plane before the next one.
+
+        Yields
+        ------
+        channel_idx: int
+            index of the channel
+        image: np.ndarray or sitk.Image
+            channel plane
+        """
+        depth = self._prefetch_depth(prefetch_channels)
+        if depth == 0:
+            for channel_idx in range(self.reg_image.n_ch):
+                yield channel_idx, self._read_channel(channel_idx)
+            return
+
+        # a single reader keeps file access sequential, the queue keeps page order
+        with ThreadPoolExecutor(1) as executor:
+            pending = deque(
+                (channel_idx, executor.submit(self._read_channel, channel_idx))
+                for channel_idx in range(min(depth, self.reg_image.n_ch))
+            )
+            next_channel_idx = len(pending)
+            while pending:
+                ch_idx, image_future = pending.popleft()
+                image = image_future.result()
+                del image_future
+                if next_channel_idx < self.reg_image.n_ch:
+                    pending.append(
+                        (
+                            next_channel_idx,
+                            executor.submit(
+                                self._read_channel, next_channel_idx
+                            ),
+                        )
+                    )
+                    next_channel_idx += 1
+                yield ch_idx, image
+                del image
+
     def write_image_by_plane(
         self,
         image_name: str,
@@ -148,13 +245,16 @@ class OmeTiffWriter:
         write_pyramid: bool = True,
         tile_size: int = 512,
         compression: Optional[str] = "default",
+        compression_workers: Optional[int] = None,
+        prefetch_channels: Optional[int] = None,
     ) -> str:
         """
         Write OME-TIFF image plane-by-plane to disk. WsiReg compatible RegImages all
         have methods to read an image channel-by-channel, thus each channel is read, transformed, and written to
         reduce memory during write.
-        RGB images may run large memory footprints as they are interleaved before write, for RGB images,
-        using the `OmeTiledTiffWriter` is recommended.
+        Each channel is resampled in bands of `tile_size` rows as it is written, RGB channels are interleaved
+        band by band, and the pyramid is built from the bands in the same pass, so neither the transformed
+        plane nor the interleaved RGB image is held in memory.
 
         Parameters
         ----------
@@ -171,6 +271,13 @@ class OmeTiffWriter:
         compression: str
             tifffile string to pass to compression argument, defaults to "deflate" for minisblack
             and "jpeg" for RGB type images
+        compression_workers: int
+            Number of threads encoding tiles, defaults to the thread budget of wsireg.
+            Tiles are written in order
+        prefetch_channels: int
+            Number of channels read ahead by a background thread while a channel is resampled
+            and written, defaults to 1 and is reduced to the input planes that fit in the memory
+            budget of wsireg, 0 reads each channel when it is written
 
         Returns
         -------
@@ -189,105 +296,143 @@ class OmeTiffWriter:
         )
 
         rgb_im_data = []
+        n_pyr_levels = self.n_pyr_levels if write_pyramid else 1
+        options = dict(
+            tile=(self.tile_size, self.tile_size),
+            compression=self.compression,
+            photometric="rgb" if self.reg_image.is_rgb else "minisblack",
+            metadata=None,
+            maxworkers=get_compression_workers(compression_workers),
+        )
 
         print(f"saving to {output_file_name}")
         with TiffWriter(output_file_name, bigtiff=True) as tif:
             if self.reg_image.reader == "sitk":
                 self.reg_image._read_full_image()
 
-            for channel_idx in range(self.reg_image.n_ch):
-                print(f"transforming : {channel_idx}")
-                image = self.reg_image.read_single_channel(channel_idx)
-                image = np.squeeze(image)
-                image = sitk.GetImageFromArray(image)
-                image.SetSpacing(
-                    (self.reg_image.image_res, self.reg_image.image_res)
-                )
-
-                if self.reg_transform_seq:
-                    image = self.reg_transform_seq.resampler.Execute(image)
-                    # image = transform_plane(
-                    #     image, final_transform, composite_transform
-                    # )
-                    print(f"transformed : {channel_idx}")
-
+            for channel_idx, image in self._prefetched_channels(
+                prefetch_channels
+            ):
                 if self.reg_image.is_rgb:
+                    # RGB channels are resampled and interleaved band by band
                     rgb_im_data.append(image)
-                else:
-                    print("saving")
-                    if isinstance(image, sitk.Image):
-                        image = sitk.GetArrayFromImage(image)
-
-                    options = dict(
-                        tile=(self.tile_size, self.tile_size),
-                        compression=self.compression,
-                        photometric="rgb"
-                        if self.reg_image.is_rgb
-                        else "minisblack",
-                        metadata=None,
-                    )
-                    # write OME-XML to the ImageDescription tag of the first page
-                    description = self.omexml if channel_idx == 0 else None
-                    # write channel data
-                    print(
-                        f" writing channel {channel_idx} - shape: {image.shape}"
-                    )
-                    tif.write(
-                        image,
-                        subifds=self.subifds,
-                        description=description,
-                        **options,
-                    )
+                    continue
 
-                    if write_pyramid:
-                        for pyr_idx in range(1, self.n_pyr_levels):
-                            resize_shape = (
-                                self.pyr_levels[pyr_idx][0],
-                                self.pyr_levels[pyr_idx][1],
-                            )
-                            image = cv2.resize(
-                                image,
-                                resize_shape,
-                                cv2.INTER_LINEAR,
-                            )
-                            print(
-                                f"pyramid index {pyr_idx} : channel {channel_idx} shape: {image.shape}"
-                            )
-
-                            tif.write(image, **options, subfiletype=1)
-
-            if self.reg_image.is_rgb:
-                rgb_im_data = sitk.Compose(rgb_im_data)
-                rgb_im_data = sitk.GetArrayFromImage(rgb_im_data)
-
-                options = dict(
-                    tile=(self.tile_size, self.tile_size),
-                    compression=self.compression,
-                    photometric="rgb",
-                    metadata=None,
-                )
                 # write OME-XML to the ImageDescription tag of the first page
-                description = self.omexml
-
-                # write channel data
-                tif.write(
-                    rgb_im_data,
+                print(f" writing channel {channel_idx}")
+                write_strip_pyramid(
+                    tif,
+                    resample_bands(
+                        [image], self.reg_transform_seq, self.tile_size
+                    ),
+                    (self.y_size, self.x_size),
+                    _image_dtype(image),
+                    (self.tile_size, self.tile_size),
+                    n_pyr_levels,
+                    options,
                     subifds=self.subifds,
-                    description=description,
-                    **options,
+                    description=self.omexml if channel_idx == 0 else None,
                 )
+                # release the plane before the next one is read
+                del image
 
-                print(f"RGB shape: {rgb_im_data.shape}")
-                if write_pyramid:
-                    for pyr_idx in range(1, self.n_pyr_levels):
-                        resize_shape = (
-                            self.pyr_levels[pyr_idx][0],
-                            self.pyr_levels[pyr_idx][1],
-                        )
-                        rgb_im_data = cv2.resize(
-                            rgb_im_data,
-                            resize_shape,
-                            cv2.INTER_LINEAR,
-                        )
-                        tif.write(rgb_im_data, **options, subfiletype=1)
+            if self.reg_image.is_rgb:
+                print(" writing RGB")
+                write_strip_pyramid(
+                    tif,
+                    resample_bands(
+                        rgb_im_data, self.reg_transform_seq, self.tile_size
+                    ),
+                    (self.y_size, self.x_size, 3),
+                    _image_dtype(rgb_im_data[0]),
+                    (self.tile_size, self.tile_size),
+                    n_pyr_levels,
+                    options,
+                    subifds=self.subifds,
+                    description=self.omexml,
+                )
         return output_file_name
+
+
+def _image_dtype(image: Union[np.ndarray, sitk.Image]) -> np.dtype:
+    """numpy dtype of an array or sitk.Image."""
+    if isinstance(image, sitk.Image):
+        return sitk.GetArrayViewFromImage(image).dtype
+    return image.dtype
+
+
+def band_resampler(
+    reg_transform_seq: RegTransformSeq,
+) -> sitk.ResampleImageFilter:
+    """
+    Copy of the resampler of a transform sequence whose output origin and size are
+    changed to resample bands of rows.
+
+    Parameters
+    ----------
+    reg_transform_seq: RegTransformSeq
+        transformations to be applied
+
+    Returns
+    -------
+    resampler: sitk.ResampleImageFilter
+        resampler of the sequence without output origin and size
+    """
+    full_resampler = reg_transform_seq.resampler
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetTransform(full_resampler.GetTransform())
+    resampler.SetInterpolator(full_resampler.GetInterpolator())
+    resampler.SetOutputDirection(full_resampler.GetOutputDirection())
+    resampler.SetOutputSpacing(full_resampler.GetOutputSpacing())
+    resampler.SetOutputPixelType(full_resampler.GetOutputPixelType())
+    resampler.SetDefaultPixelValue(full_resampler.GetDefaultPixelValue())
+    return resampler
+
+
+def resample_bands(
+    images: List[Union[np.ndarray, sitk.Image]],
+    reg_transform_seq: Optional[RegTransformSeq],
+    band_size: int,
+):
+    """
+    Resample planes in bands of rows, top to bottom, so the transformed planes are never
+    held in memory at once. Bands equal the rows of the whole transformed planes.
+
+    Parameters
+    ----------
+    images: list of sitk.Image or np.ndarray
+        planes with their spacing set, or np.ndarrays when there is no transformation
+    reg_transform_seq: RegTransformSeq or None
+        transformations to be applied, None to only split the planes into bands
+    band_size: int
+        number of rows of each band
+
+    Yields
+    ------
+    band: np.ndarray
+        (rows, x) band of a single plane or (rows, x, n_planes) interleaved band
+    """
+    if reg_transform_seq:
+        resampler = band_resampler(reg_transform_seq)
+        full_resampler = reg_transform_seq.resampler
+        x_size, y_size = full_resampler.GetSize()
+        origin = np.asarray(full_resampler.GetOutputOrigin())
+        direction = np.reshape(full_resampler.GetOutputDirection(), (2, 2))
+        y_spacing = full_resampler.GetOutputSpacing()[1]
+    else:
+        y_size = images[0].shape[0]
+
+    for y in range(0, y_size, band_size):
+        if reg_transform_seq:
+            resampler.SetOutputOrigin(
+                (origin + direction @ np.array([0.0, y * y_spacing])).tolist()
+            )
+            resampler.SetSize((x_size, min(band_size, y_size - y)))
+            bands = [
+                sitk.GetArrayFromImage(resampler.Execute(image))
+                for image in images
+            ]
+        else:
+            bands = [image[y : y + band_size] for image in images]
+
+        yield bands[0] if len(bands) == 1 else np.stack(bands, axis=-1)
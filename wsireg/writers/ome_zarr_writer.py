@@ -0,0 +1,244 @@
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import dask.array as da
+import numpy as np
+import zarr
+
+from wsireg.reg_images.reg_image import RegImage
+from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
+from wsireg.utils.im_utils import (
+    format_channel_colors,
+    format_channel_names,
+    generate_channels,
+    get_pyramid_info,
+)
+from wsireg.writers.tiled_ome_tiff_writer import (
+    OmeTiffTiledWriter,
+    compute_sub_res,
+)
+
+
+class OmeZarrWriter(OmeTiffTiledWriter):
+    """
+    Class for transforming, then writing whole slide images to OME-Zarr (NGFF) tile-by-tile.
+    Transformed tiles are written directly into the chunks of the base layer, tiles cover
+    whole chunks so workers write concurrently without any ordering, unlike TIFF. Sub-resolutions
+    are 2x2 means of the previous level, like the tiled OME-TIFF writer.
+
+    Images are written as (c, y, x), RGB images are stored as 3 channels. Background (all zero)
+    chunks are not stored and read as the zero fill value.
+
+    Parameters
+    ----------
+    reg_image: RegImage
+        wsireg RegImage that has a dask store that is chunked in XY
+    reg_transform_seq: RegTransformSeq
+        wsireg registration transform sequence to be applied to the image
+    tile_size: int
+        Chunk size in x and y of the OME-Zarr arrays
+    zarr_tile_size: int
+        Size of the tiles transformed by each worker, must be a multiple of `tile_size`
+    moving_tile_padding: int
+        How many additional moving pixels to pull around the footprint of each tile,
+        defaults to the support of the resampling interpolator
+    footprint_sample_step: int
+        Spacing in fixed pixels of the footprint sampling grid
+    chunk_cache_bytes: int
+        Size of the cache of decoded moving image chunks in bytes, defaults to 512 MB or
+        a quarter of the memory limit, 0 disables the cache
+    """
+
+    def __init__(
+        self,
+        reg_image: RegImage,
+        reg_transform_seq: RegTransformSeq,
+        tile_size: int = 512,
+        zarr_tile_size: int = 2048,
+        moving_tile_padding: Optional[int] = None,
+        footprint_sample_step: int = 64,
+        chunk_cache_bytes: Optional[int] = None,
+    ):
+        if zarr_tile_size % tile_size != 0:
+            raise ValueError(
+                f"zarr_tile_size ({zarr_tile_size}) must be a multiple of "
+                f"tile_size ({tile_size}) so that workers write whole chunks"
+            )
+
+        super().__init__(
+            reg_image,
+            reg_transform_seq,
+            tile_size=tile_size,
+            zarr_tile_size=zarr_tile_size,
+            moving_tile_padding=moving_tile_padding,
+            footprint_sample_step=footprint_sample_step,
+            chunk_cache_bytes=chunk_cache_bytes,
+        )
+
+    @property
+    def n_out_ch(self) -> int:
+        """Number of channels in the output, 3 for RGB images."""
+        return (
+            self.reg_image.shape[-1]
+            if self.reg_image.is_rgb
+            else self.reg_image.n_ch
+        )
+
+    def _transform_write_tile(self, data):
+        """Worker function to transform and place tile in the base layer,
+        RGB tiles are de-interleaved to channels."""
+        if not self.reg_image.is_rgb:
+            return super()._transform_write_tile(data)
+
+        (
+            resample_zarray,
+            ch_idx,
+            fixed_tile_position,
+            fixed_tile_origin,
+            moving_tile_corners,
+        ) = data
+
+        tile_resampled = self._transform_tile(
+            ch_idx, fixed_tile_position, fixed_tile_origin, moving_tile_corners
+        )
+
+        if tile_resampled is not None:
+            (
+                x_max_fixed,
+                x_min_fixed,
+                y_max_fixed,
+                y_min_fixed,
+            ) = self._get_fixed_slice(fixed_tile_position)
+            resample_zarray[
+                :, y_min_fixed:y_max_fixed, x_min_fixed:x_max_fixed
+            ] = np.moveaxis(tile_resampled, -1, 0)
+
+    def _multiscales_metadata(
+        self, image_name: str, n_pyr_levels: int
+    ) -> List[Dict[str, Any]]:
+        """NGFF multiscales metadata with the physical scale of each level."""
+        x_spacing, y_spacing = self.reg_transform_seq.output_spacing
+        datasets = [
+            {
+                "path": str(pyr_idx),
+                "coordinateTransformations": [
+                    {
+                        "type": "scale",
+                        "scale": [
+                            1.0,
+                            float(y_spacing) * 2**pyr_idx,
+                            float(x_spacing) * 2**pyr_idx,
+                        ],
+                    }
+                ],
+            }
+            for pyr_idx in range(n_pyr_levels)
+        ]
+        return [
+            {
+                "version": "0.4",
+                "name": image_name,
+                "axes": [
+                    {"name": "c", "type": "channel"},
+                    {"name": "y", "type": "space", "unit": "micrometer"},
+                    {"name": "x", "type": "space", "unit": "micrometer"},
+                ],
+                "datasets": datasets,
+            }
+        ]
+
+    def _omero_metadata(self) -> Dict[str, Any]:
+        """omero channel metadata for viewers."""
+        if self.reg_image.is_rgb:
+            channel_names = ["R", "G", "B"]
+            channel_colors = ["red", "green", "blue"]
+        else:
+            channel_names = self.reg_image.channel_names
+            channel_colors = self.reg_image.channel_colors
+
+        return {
+            "id": 1,
+            "channels": generate_channels(
+                format_channel_names(channel_names, self.n_out_ch),
+                format_channel_colors(channel_colors, self.n_out_ch),
+                self.reg_image.im_dtype,
+            ),
+            "rdefs": {
+                "model": "color",
+            },
+        }
+
+    def write_image(
+        self,
+        image_name: str,
+        output_dir: Union[Path, str] = "",
+        write_pyramid: bool = True,
+        max_workers: Optional[int] = None,
+    ) -> str:
+        """
+        Write the transformed image to an OME-Zarr multiscale store.
+
+        Parameters
+        ----------
+        image_name: str
+            Name to be written WITHOUT extension
+            for example if image_name = "cool_image" the store
+            would be "cool_image.ome.zarr"
+        output_dir: Path or str
+            Directory where the store will be saved
+        write_pyramid: bool
+            Whether to write sub-resolutions or only the base layer
+        max_workers: int
+            Number of threads transforming tiles, defaults to the number
+            of threads that fit in the memory limit
+
+        Returns
+        -------
+        output_file_name: str
+            File path to the written OME-Zarr store
+        """
+        output_file_name = str(Path(output_dir) / f"{image_name}.ome.zarr")
+        x_size, y_size = self.reg_transform_seq.output_size
+        tile_size = self.tile_shape[0]
+
+        if write_pyramid:
+            pyr_levels, _ = get_pyramid_info(
+                y_size, x_size, self.n_out_ch, tile_size
+            )
+            n_pyr_levels = max(len(pyr_levels), 1)
+        else:
+            n_pyr_levels = 1
+
+        print(f"saving to {output_file_name}")
+        zgrp = zarr.group(
+            zarr.DirectoryStore(output_file_name), overwrite=True
+        )
+        base_zarray = zgrp.create_dataset(
+            "0",
+            shape=(self.n_out_ch, y_size, x_size),
+            chunks=(1,) + self.tile_shape,
+            dtype=self.reg_image.im_dtype,
+            write_empty_chunks=False,
+        )
+
+        self._transform_write_tile_set(base_zarray, max_workers=max_workers)
+
+        for pyr_idx in range(1, n_pyr_levels):
+            sub_res = compute_sub_res(
+                da.from_zarr(zgrp[str(pyr_idx - 1)]),
+                1,
+                tile_size,
+                False,
+                self.reg_image.im_dtype,
+            )
+            print(f"pyr {pyr_idx} : computing shape: {sub_res.shape}")
+            sub_res.to_zarr(
+                zgrp.store, component=str(pyr_idx), write_empty_chunks=False
+            )
+
+        zgrp.attrs["multiscales"] = self._multiscales_metadata(
+            image_name, n_pyr_levels
+        )
+        zgrp.attrs["omero"] = self._omero_metadata()
+
+        return output_file_name
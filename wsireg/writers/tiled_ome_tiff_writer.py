@@ -1,9 +1,11 @@
-import multiprocessing
 import random
 import string
+import tempfile
+import threading
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import dask.array as da
 import numpy as np
@@ -14,13 +16,30 @@ from tiler import Tiler
 from tqdm import tqdm
 from wsireg.reg_images.reg_image import RegImage
 from wsireg.reg_transforms.reg_transform_seq import RegTransformSeq
+from wsireg.utils.cache_utils import ChunkCache
 from wsireg.utils.im_utils import (
     format_channel_names,
     get_pyramid_info,
     prepare_ome_xml_str,
 )
+from wsireg.utils.resource_utils import (
+    get_compression_workers,
+    get_memory_budget,
+    get_memory_limit,
+    get_n_threads,
+    workers_for_memory,
+)
 from wsireg.utils.tform_utils import ELX_TO_ITK_INTERPOLATORS
 
+DEFAULT_CHUNK_CACHE_BYTES = 512 * 1024**2
+
+# moving pixels each side of a point used by the resampling interpolators
+INTERPOLATOR_PADDING = {
+    "FinalNearestNeighborInterpolator": 1,
+    "FinalLinearInterpolator": 1,
+    "FinalBSplineInterpolator": 2,
+}
+
 
 class OmeTiffTiledWriter:
     """
@@ -51,9 +70,18 @@ class OmeTiffTiledWriter:
         Tile used in the zarr intermediate
 
     moving_tile_padding: int
-        How much additional padded to pull from moving for each transformed tile
-        This ensures that the interpolation is correctly performed during resampling
-        Non-rigid transforms may need more spacing
+        How many additional moving pixels to pull around the footprint of each transformed tile
+        so the interpolation is correctly performed during resampling.
+        Defaults to the support of the resampling interpolator
+
+    footprint_sample_step: int
+        Spacing in fixed pixels of the grid of points mapped to moving to find the footprint of
+        each tile, under non-linear transforms the tile boundaries are also mapped at every pixel
+
+    chunk_cache_bytes: int
+        Size of the LRU cache of decoded moving image chunks shared by the tile workers, defaults
+        to 512 MB or a quarter of the memory budget if smaller, 0 disables the cache. Multichannel
+        chunks are cached per channel, chunks larger than the cache are read but not cached
 
     Attributes
     ----------
@@ -66,7 +94,11 @@ class OmeTiffTiledWriter:
     zarr_tile_shape: tuple of ints
         Shape of zarr tiles going to disk temporarily
     moving_tile_padding: int
-        Tile padding use at read in for interpolation
+        Tile padding in moving pixels used at read in for interpolation
+    footprint_sample_step: int
+        Spacing in fixed pixels of the footprint sampling grid
+    chunk_cache: ChunkCache or None
+        Cache of decoded moving image chunks, `chunk_cache.summary()` reports hits and misses
     """
 
     def __init__(
@@ -75,7 +107,9 @@ class OmeTiffTiledWriter:
         reg_transform_seq: RegTransformSeq,
         tile_size: int = 512,
         zarr_tile_size: int = 2048,
-        moving_tile_padding: int = 128,
+        moving_tile_padding: Optional[int] = None,
+        footprint_sample_step: int = 64,
+        chunk_cache_bytes: Optional[int] = None,
     ):
 
         self._fixed_tile_positions: List[Tuple[int, int, int, int]] = []
@@ -87,13 +121,55 @@ class OmeTiffTiledWriter:
             Tuple[float, float, float, float]
         ] = []
         self._tiler: Optional[Tiler] = None
+        self._moving_coordinate_grid: Optional[np.ndarray] = None
+        self._moving_boundary_lines: Dict[Tuple[int, int], np.ndarray] = {}
+        self._thread_resamplers = threading.local()
 
         self.reg_image: RegImage = reg_image
         self.reg_transform_seq: RegTransformSeq = reg_transform_seq
         self.tile_shape = (tile_size, tile_size)
         self.zarr_tile_shape = (zarr_tile_size, zarr_tile_size)
         self._check_dask_array_chunk_sizes(self.reg_image.dask_image)
-        self.moving_tile_padding = moving_tile_padding
+        self.moving_tile_padding = (
+            moving_tile_padding
+            if moving_tile_padding is not None
+            else INTERPOLATOR_PADDING.get(
+                self.reg_transform_seq.reg_transforms[
+                    -1
+                ].resample_interpolator,
+                2,
+            )
+        )
+        self.footprint_sample_step = footprint_sample_step
+
+        if chunk_cache_bytes is None:
+            memory_limit = get_memory_limit()
+            chunk_cache_bytes = (
+                DEFAULT_CHUNK_CACHE_BYTES
+                if memory_limit is None
+                else min(DEFAULT_CHUNK_CACHE_BYTES, memory_limit // 4)
+            )
+        self.chunk_cache: Optional[ChunkCache] = (
+            ChunkCache(
+                self.reg_image.dask_image,
+                chunk_cache_bytes,
+                channel_axis=0
+                if self.reg_image.dask_image.ndim == 3
+                and not self.reg_image.is_rgb
+                else None,
+            )
+            if chunk_cache_bytes > 0
+            else None
+        )
+        if (
+            self.chunk_cache is not None
+            and self.chunk_cache.max_chunk_bytes > chunk_cache_bytes
+        ):
+            print(
+                f"moving chunks of {self.chunk_cache.max_chunk_bytes} bytes exceed the "
+                f"chunk cache size of {chunk_cache_bytes} bytes and will not be cached"
+            )
+
         self._build_transformation_tiles()
 
     @property
@@ -161,6 +237,9 @@ class OmeTiffTiledWriter:
 
     def _build_transformation_tiles(self):
         """Method to reinitialize tiler if there are changes."""
+        self._moving_coordinate_grid = None
+        self._moving_boundary_lines = {}
+        self._thread_resamplers = threading.local()
         self._create_tiler()
         self._get_fixed_tile_positions()
         self._get_fixed_tile_positions_phys()
@@ -203,30 +282,140 @@ class OmeTiffTiledWriter:
         """Method to transform tile positions in fixed
         to moving so that each write tile in fixed has a corresponding
         read region in moving."""
-        for fixed_tile_pos in self._fixed_tile_positions_phys:
-            corners_phys = []
-            corners_px = []
-
-            for idx, corner in enumerate(fixed_tile_pos):
-                if idx == 0:
-                    corner -= self.moving_tile_padding
-                if idx == 1:
-                    corner += self.moving_tile_padding
-                for idx, t in enumerate(
-                    self.reg_transform_seq.reg_transforms[::-1]
-                ):
-                    if idx == 0:
-                        t_pt = t.itk_transform.TransformPoint(corner.tolist())
-                    else:
-                        t_pt = t.itk_transform.TransformPoint(t_pt)
-
-                t_pt = np.array(t_pt)
-                t_pt_px = t_pt / self.reg_image.image_res
-                corners_phys.append(t_pt)
-                corners_px.append(t_pt_px)
-
-            self._moving_tile_positions_phys.append(tuple(corners_phys))
-            self._moving_tile_positions.append(tuple(corners_px))
+        self._moving_tile_positions_phys = []
+        self._moving_tile_positions = []
+        for fixed_tile_pos in self._fixed_tile_positions:
+            corners_phys, corners_px = self._get_moving_tile_corners(
+                fixed_tile_pos
+            )
+            self._moving_tile_positions_phys.append(corners_phys)
+            self._moving_tile_positions.append(corners_px)
+
+    def _get_moving_coordinate_grid(self) -> np.ndarray:
+        """Moving physical coordinates of a grid of fixed points spaced every
+        `footprint_sample_step` pixels, mapped through the transform sequence in one call.
+
+        Returns
+        -------
+        moving_coordinate_grid: np.ndarray
+            (y, x, 2) array of x,y moving physical coordinates
+        """
+        if self._moving_coordinate_grid is not None:
+            return self._moving_coordinate_grid
+
+        step = self.footprint_sample_step
+        x_size, y_size = self.reg_transform_seq.output_size
+        grid_spacing = (
+            np.asarray(self.reg_transform_seq.output_spacing, dtype=float)
+            * step
+        )
+        grid_size = [
+            int(np.ceil(x_size / step)) + 1,
+            int(np.ceil(y_size / step)) + 1,
+        ]
+
+        tform_to_dfield = sitk.TransformToDisplacementFieldFilter()
+        tform_to_dfield.SetOutputPixelType(sitk.sitkVectorFloat64)
+        tform_to_dfield.SetOutputSpacing(grid_spacing.tolist())
+        tform_to_dfield.SetOutputOrigin((0.0, 0.0))
+        tform_to_dfield.SetSize(grid_size)
+        displacements = sitk.GetArrayFromImage(
+            tform_to_dfield.Execute(self.reg_transform_seq.composite_transform)
+        )
+
+        yy, xx = np.mgrid[0 : grid_size[1], 0 : grid_size[0]]
+        self._moving_coordinate_grid = (
+            np.stack([xx, yy], axis=-1) * grid_spacing + displacements
+        )
+        return self._moving_coordinate_grid
+
+    def _get_moving_boundary_line(
+        self, axis: int, position: int
+    ) -> np.ndarray:
+        """Moving physical coordinates of every pixel of a fixed row (`axis` 0) or column
+        (`axis` 1) of the output at `position` pixels, mapped through the transform sequence.
+
+        Returns
+        -------
+        moving_line: np.ndarray
+            (n, 2) array of x,y moving physical coordinates
+        """
+        key = (axis, int(position))
+        if key in self._moving_boundary_lines:
+            return self._moving_boundary_lines[key]
+
+        x_size, y_size = self.reg_transform_seq.output_size
+        spacing = np.asarray(
+            self.reg_transform_seq.output_spacing, dtype=float
+        )
+        origin = (
+            np.array([0.0, position])
+            if axis == 0
+            else np.array([position, 0.0])
+        ) * spacing
+        line_size = [x_size + 1, 1] if axis == 0 else [1, y_size + 1]
+
+        tform_to_dfield = sitk.TransformToDisplacementFieldFilter()
+        tform_to_dfield.SetOutputPixelType(sitk.sitkVectorFloat64)
+        tform_to_dfield.SetOutputSpacing(spacing.tolist())
+        tform_to_dfield.SetOutputOrigin(origin.tolist())
+        tform_to_dfield.SetSize(line_size)
+        displacements = sitk.GetArrayFromImage(
+            tform_to_dfield.Execute(self.reg_transform_seq.composite_transform)
+        ).reshape(-1, 2)
+
+        line_px = np.arange(displacements.shape[0])
+        fixed_line = (
+            np.stack([line_px, np.full_like(line_px, position)], axis=-1)
+            if axis == 0
+            else np.stack([np.full_like(line_px, position), line_px], axis=-1)
+        )
+        self._moving_boundary_lines[key] = fixed_line * spacing + displacements
+        return self._moving_boundary_lines[key]
+
+    def _get_moving_tile_corners(
+        self, fixed_tile_position: Tuple[np.ndarray, np.ndarray]
+    ) -> Tuple[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+        """Bounding box in moving, physical and pixel coordinates, of a fixed tile given in pixels.
+        Uses all points of the footprint sampling grid covering the tile, padded by
+        `moving_tile_padding` moving pixels. Non-linear transforms can deform the tile between
+        the grid points, so its boundary is also mapped at every pixel, which bounds the
+        footprint of a non-folding transform."""
+        moving_coordinate_grid = self._get_moving_coordinate_grid()
+        x_min, y_min = np.floor(
+            np.asarray(fixed_tile_position[0]) / self.footprint_sample_step
+        ).astype(int)
+        x_max, y_max = np.ceil(
+            np.asarray(fixed_tile_position[1]) / self.footprint_sample_step
+        ).astype(int)
+        tile_pts = moving_coordinate_grid[
+            y_min : y_max + 1, x_min : x_max + 1
+        ].reshape(-1, 2)
+
+        if self._has_nonlinear_transform():
+            (x_min, y_min), (x_max, y_max) = [
+                np.asarray(p).astype(int) for p in fixed_tile_position
+            ]
+            tile_pts = np.concatenate(
+                [tile_pts]
+                + [
+                    self._get_moving_boundary_line(0, y)[x_min : x_max + 1]
+                    for y in (y_min, y_max)
+                ]
+                + [
+                    self._get_moving_boundary_line(1, x)[y_min : y_max + 1]
+                    for x in (x_min, x_max)
+                ]
+            )
+
+        padding = self.moving_tile_padding * self.reg_image.image_res
+        corners_phys = (
+            tile_pts.min(axis=0) - padding,
+            tile_pts.max(axis=0) + padding,
+        )
+        corners_px = tuple(c / self.reg_image.image_res for c in corners_phys)
+
+        return corners_phys, corners_px
 
     def set_output_spacing(
         self, output_spacing: Tuple[Union[int, float], Union[int, float]]
@@ -265,36 +454,88 @@ class OmeTiffTiledWriter:
         self._build_transformation_tiles()
 
     def _create_tile_resampler(
-        self, tile_origin: Tuple[float, float]
+        self,
+        tile_origin: Tuple[float, float],
+        tile_size: Optional[Tuple[int, int]] = None,
+        transform: Optional[sitk.Transform] = None,
     ) -> sitk.ResampleImageFilter:
         """
-        Build each tile's resampler.
+        Get the tile resampler of the calling thread. Resamplers are created once per thread,
+        for each tile only the origin, size and transform change.
         Parameters
         ----------
         tile_origin: Tuple[float, float]
             Position of the tile in physical coordinates
+        tile_size: Tuple[int, int]
+            Size of the tile in pixels (x, y), defaults to the zarr tile shape
+        transform: sitk.Transform
+            Transform of the tile, defaults to the composite transform of the sequence
 
         Returns
         -------
         resampler: sitk.ResampleImageFilter
             resampler for an individual fixed tile
         """
-        resampler = sitk.ResampleImageFilter()
+        resampler = getattr(self._thread_resamplers, "resampler", None)
+        if resampler is None:
+            resampler = sitk.ResampleImageFilter()
+            resampler.SetOutputDirection(
+                self.reg_transform_seq.reg_transforms[-1].output_direction
+            )
+            resampler.SetOutputSpacing(self.reg_transform_seq.output_spacing)
+
+            interpolator = ELX_TO_ITK_INTERPOLATORS.get(
+                self.reg_transform_seq.reg_transforms[-1].resample_interpolator
+            )
+            resampler.SetInterpolator(interpolator)
+            self._thread_resamplers.resampler = resampler
+
         resampler.SetOutputOrigin(tile_origin)
-        resampler.SetOutputDirection(
-            self.reg_transform_seq.reg_transforms[-1].output_direction
+        resampler.SetSize(
+            self.zarr_tile_shape
+            if tile_size is None
+            else [int(s) for s in tile_size]
         )
-        resampler.SetSize(self.zarr_tile_shape)
-        resampler.SetOutputSpacing(self.reg_transform_seq.output_spacing)
-
-        interpolator = ELX_TO_ITK_INTERPOLATORS.get(
-            self.reg_transform_seq.reg_transforms[-1].resample_interpolator
+        resampler.SetTransform(
+            self.reg_transform_seq.composite_transform
+            if transform is None
+            else transform
         )
-        resampler.SetInterpolator(interpolator)
-        resampler.SetTransform(self.reg_transform_seq.composite_transform)
 
         return resampler
 
+    def _has_nonlinear_transform(self) -> bool:
+        """Whether the transform sequence contains a non-linear transform."""
+        return not all(
+            rt.is_linear for rt in self.reg_transform_seq.reg_transforms
+        )
+
+    def _tile_displacement_field(
+        self,
+        tile_origin: Tuple[float, float],
+        tile_size: Optional[Tuple[int, int]] = None,
+    ) -> Optional[sitk.DisplacementFieldTransform]:
+        """Evaluate the composite transform once at the pixels of a tile, the displacement field
+        is exact at these pixels and cheap to evaluate for each channel. None for linear
+        sequences, whose composite transform is cheaper to evaluate than a field."""
+        if not self._has_nonlinear_transform():
+            return None
+        tform_to_dfield = sitk.TransformToDisplacementFieldFilter()
+        tform_to_dfield.SetOutputPixelType(sitk.sitkVectorFloat64)
+        tform_to_dfield.SetOutputOrigin(tile_origin)
+        tform_to_dfield.SetOutputDirection(
+            self.reg_transform_seq.reg_transforms[-1].output_direction
+        )
+        tform_to_dfield.SetOutputSpacing(self.reg_transform_seq.output_spacing)
+        tform_to_dfield.SetSize(
+            self.zarr_tile_shape
+            if tile_size is None
+            else [int(s) for s in tile_size]
+        )
+        return sitk.DisplacementFieldTransform(
+            tform_to_dfield.Execute(self.reg_transform_seq.composite_transform)
+        )
+
     def write_tiles_to_zarr_store(
         self,
         temp_zarr_store: zarr.TempStore,
@@ -324,6 +565,7 @@ class OmeTiffTiledWriter:
                 ),
                 chunks=self.tile_shape,
                 dtype=self.reg_image.im_dtype,
+                write_empty_chunks=False,
             )
         else:
             resample_zarray = zgrp.create_dataset(
@@ -335,6 +577,7 @@ class OmeTiffTiledWriter:
                 ),
                 chunks=(1,) + self.tile_shape,
                 dtype=self.reg_image.im_dtype,
+                write_empty_chunks=False,
             )
 
         self._transform_write_tile_set(
@@ -343,6 +586,97 @@ class OmeTiffTiledWriter:
 
         return resample_zarray
 
+    def to_dask_array(self, chunk_size: Optional[int] = None) -> da.Array:
+        """
+        Lazy view of the transformed image in fixed space. Nothing is resampled until
+        chunks are computed, each chunk maps its bounds into moving space, reads only
+        that region of the moving image and resamples it.
+
+        Parameters
+        ----------
+        chunk_size: int
+            Chunk size in x and y of the dask array, defaults to the zarr tile size
+
+        Returns
+        -------
+        transformed_image: da.Array
+            Transformed image, (y, x, 3) for RGB images, (channels, y, x) otherwise
+        """
+        chunk_shape = (
+            self.zarr_tile_shape
+            if chunk_size is None
+            else (chunk_size, chunk_size)
+        )
+        x_size, y_size = self.reg_transform_seq.output_size
+        if self.reg_image.is_rgb:
+            shape = (y_size, x_size, self.reg_image.shape[-1])
+            chunks = chunk_shape + (self.reg_image.shape[-1],)
+        else:
+            shape = (self.reg_image.n_ch, y_size, x_size)
+            chunks = (1,) + chunk_shape
+
+        return da.zeros(
+            shape, chunks=chunks, dtype=self.reg_image.im_dtype
+        ).map_blocks(self._transform_block, dtype=self.reg_image.im_dtype)
+
+    def _transform_block(self, block: np.ndarray, block_info=None):
+        """Resample one chunk of the dask view from its array location."""
+        if self.reg_image.is_rgb:
+            (y_min, y_max), (x_min, x_max), _ = block_info[0]["array-location"]
+            ch_idx = 0
+        else:
+            (ch_idx, _), (y_min, y_max), (x_min, x_max) = block_info[0][
+                "array-location"
+            ]
+
+        fixed_tile_position = (
+            np.array([x_min, y_min]),
+            np.array([x_max, y_max]),
+        )
+
+        return self._resample_output_tile(ch_idx, fixed_tile_position).reshape(
+            block.shape
+        )
+
+    def _resample_output_tile(
+        self,
+        ch_idx: Optional[int],
+        fixed_tile_position: Tuple[np.ndarray, np.ndarray],
+    ) -> np.ndarray:
+        """Resample a region of the fixed image given by its top-left and bottom-right
+        pixel positions, regions outside of the moving image are zero.
+        With `ch_idx` None, all channels are resampled at once and returned as (y, x, channels)."""
+        _, moving_tile_corners = self._get_moving_tile_corners(
+            fixed_tile_position
+        )
+        x_size, y_size = fixed_tile_position[1] - fixed_tile_position[0]
+
+        tile_resampled = self._transform_tile(
+            ch_idx,
+            fixed_tile_position,
+            tuple(
+                (
+                    fixed_tile_position[0]
+                    * self.reg_transform_seq.output_spacing
+                ).astype(float)
+            ),
+            moving_tile_corners,
+            tile_size=(x_size, y_size),
+        )
+
+        if tile_resampled is None:
+            if self.reg_image.is_rgb:
+                tile_shape = (y_size, x_size, self.reg_image.shape[-1])
+            elif ch_idx is None:
+                tile_shape = (y_size, x_size, self.reg_image.n_ch)
+            else:
+                tile_shape = (y_size, x_size)
+            tile_resampled = np.zeros(
+                tile_shape, dtype=self.reg_image.im_dtype
+            )
+
+        return tile_resampled
+
     def _transform_write_tile(self, data):
         """Worker function to transform and place tile in zarr store."""
         (
@@ -353,19 +687,11 @@ class OmeTiffTiledWriter:
             moving_tile_corners,
         ) = data
 
-        tile_resampler = self._create_tile_resampler(fixed_tile_origin)
-
-        x_size, y_size = self._get_image_size()
-
-        x_max, x_min, y_max, y_min = self._get_moving_tile_slice(
-            moving_tile_corners, x_size, y_size
-        )
-
-        tile_resampled = self._resample_tile(
-            ch_idx, tile_resampler, x_max, x_min, y_max, y_min
+        tile_resampled = self._transform_tile(
+            ch_idx, fixed_tile_position, fixed_tile_origin, moving_tile_corners
         )
 
-        if tile_resampled:
+        if tile_resampled is not None:
             (
                 x_max_fixed,
                 x_min_fixed,
@@ -373,21 +699,65 @@ class OmeTiffTiledWriter:
                 y_min_fixed,
             ) = self._get_fixed_slice(fixed_tile_position)
 
-            x_max, y_max = self._correct_end_moving_slices(
-                x_max_fixed,
-                x_min_fixed,
-                y_max_fixed,
-                y_min_fixed,
-            )
-
             if self.reg_image.is_rgb:
                 resample_zarray[
                     y_min_fixed:y_max_fixed, x_min_fixed:x_max_fixed, :
-                ] = sitk.GetArrayFromImage(tile_resampled)[:y_max, :x_max, :]
+                ] = tile_resampled
+            elif ch_idx is None:
+                resample_zarray[
+                    :, y_min_fixed:y_max_fixed, x_min_fixed:x_max_fixed
+                ] = np.moveaxis(tile_resampled, -1, 0)
             else:
                 resample_zarray[
                     ch_idx, y_min_fixed:y_max_fixed, x_min_fixed:x_max_fixed
-                ] = sitk.GetArrayFromImage(tile_resampled)[:y_max, :x_max]
+                ] = tile_resampled
+
+    def _transform_tile(
+        self,
+        ch_idx: Optional[int],
+        fixed_tile_position: Tuple[np.ndarray, np.ndarray],
+        fixed_tile_origin: Tuple[float, float],
+        moving_tile_corners: Tuple[np.ndarray, np.ndarray],
+        tile_size: Optional[Tuple[int, int]] = None,
+    ) -> Optional[np.ndarray]:
+        """Read the moving region of a fixed tile and resample it, returns the
+        tile cropped to the fixed image or None if it is outside of the moving image
+        or all background.
+        With `ch_idx` None, all channels are resampled at once and returned as (y, x, channels)."""
+        x_size, y_size = self._get_image_size()
+
+        x_max, x_min, y_max, y_min = self._get_moving_tile_slice(
+            moving_tile_corners, x_size, y_size
+        )
+
+        if x_min >= x_max or y_min >= y_max:
+            return
+
+        tile_resampler = self._create_tile_resampler(
+            fixed_tile_origin,
+            tile_size=tile_size,
+            transform=self._tile_displacement_field(
+                fixed_tile_origin, tile_size=tile_size
+            )
+            if ch_idx is None
+            else None,
+        )
+
+        tile_resampled = self._resample_tile(
+            ch_idx, tile_resampler, x_max, x_min, y_max, y_min
+        )
+        if tile_resampled is None:
+            return
+
+        x_max, y_max = self._correct_end_moving_slices(
+            *self._get_fixed_slice(fixed_tile_position)
+        )
+
+        tile_resampled = sitk.GetArrayFromImage(tile_resampled)[:y_max, :x_max]
+        if is_empty_tile(tile_resampled):
+            return
+
+        return tile_resampled
 
     def _get_image_size(self) -> Tuple[int, int]:
         """Get moving image size for tile dilineation"""
@@ -405,7 +775,7 @@ class OmeTiffTiledWriter:
 
     def _resample_tile(
         self,
-        ch_idx: int,
+        ch_idx: Optional[int],
         tile_resampler: sitk.ResampleImageFilter,
         x_max: int,
         x_min: int,
@@ -413,24 +783,36 @@ class OmeTiffTiledWriter:
         y_min: int,
     ) -> Optional[sitk.Image]:
         """Resample tile or don't if it is outside of the moving
-        image space."""
+        image space or the moving region is all background (zero).
+        `ch_idx` None reads all channels at once and returns them as a vector image."""
 
-        if x_min == 0 and x_max == 0:
+        if x_min >= x_max or y_min >= y_max:
             return
 
-        if y_min == 0 and y_max == 0:
+        image = self._read_moving_region(ch_idx, x_max, x_min, y_max, y_min)
+        if is_empty_tile(image):
             return
 
         if self.reg_image.is_rgb:
-            image = self.reg_image.dask_image[y_min:y_max, x_min:x_max, :]
             image = sitk.GetImageFromArray(image, isVector=True)
-        elif self.reg_image.n_ch == 1:
-            image = da.squeeze(self.reg_image.dask_image)[
-                y_min:y_max, x_min:x_max
+        elif ch_idx is None:
+            images = [
+                sitk.GetImageFromArray(plane, isVector=False)
+                for plane in image
             ]
-            image = sitk.GetImageFromArray(image, isVector=False)
+            for image in images:
+                image.SetSpacing(
+                    (self.reg_image.image_res, self.reg_image.image_res)
+                )
+                image.SetOrigin(
+                    image.TransformIndexToPhysicalPoint(
+                        [int(x_min), int(y_min)]
+                    )
+                )
+            return sitk.Compose(
+                [tile_resampler.Execute(image) for image in images]
+            )
         else:
-            image = self.reg_image.dask_image[ch_idx, y_min:y_max, x_min:x_max]
             image = sitk.GetImageFromArray(image, isVector=False)
         image.SetSpacing((self.reg_image.image_res, self.reg_image.image_res))
         image.SetOrigin(
@@ -441,6 +823,43 @@ class OmeTiffTiledWriter:
 
         return tile_resampled
 
+    def _read_moving_region(
+        self,
+        ch_idx: Optional[int],
+        x_max: int,
+        x_min: int,
+        y_max: int,
+        y_min: int,
+    ) -> np.ndarray:
+        """Read a region of one channel, all channels (`ch_idx` None) or the RGB moving image,
+        through the chunk cache if enabled."""
+        dask_image = self.reg_image.dask_image
+        yx_region = (
+            slice(int(y_min), int(y_max)),
+            slice(int(x_min), int(x_max)),
+        )
+        if self.reg_image.is_rgb:
+            region = yx_region + (slice(0, dask_image.shape[-1]),)
+        elif dask_image.ndim == 2:
+            region = yx_region
+        elif ch_idx is None:
+            region = (slice(0, dask_image.shape[0]),) + yx_region
+        else:
+            region = (slice(ch_idx, ch_idx + 1),) + yx_region
+
+        if self.chunk_cache is not None:
+            image = self.chunk_cache.read_region(region)
+        else:
+            image = np.asarray(dask_image[region])
+
+        if (
+            not self.reg_image.is_rgb
+            and dask_image.ndim == 3
+            and ch_idx is not None
+        ):
+            image = image[0]
+        return image
+
     def _correct_end_moving_slices(
         self,
         x_max_fixed: int,
@@ -471,77 +890,157 @@ class OmeTiffTiledWriter:
         y_size: int,
     ) -> Tuple[int, int, int, int]:
         """Get tile slice in moving tile pixels."""
-        x_min = (
-            moving_tile_corners[0][0] if moving_tile_corners[0][0] >= 0 else 0
-        )
-        x_min = x_min if x_min <= x_size else x_size
-        x_min = np.ceil(x_min).astype(int)
-        x_max = (
-            moving_tile_corners[1][0] if moving_tile_corners[1][0] >= 0 else 0
-        )
-        x_max = x_max if x_max <= x_size else x_size
-        x_max = np.ceil(x_max).astype(int)
-        y_min = (
-            moving_tile_corners[0][1] if moving_tile_corners[0][1] >= 0 else 0
-        )
-        y_min = y_min if y_min <= y_size else y_size
-        y_min = np.ceil(y_min).astype(int)
-        y_max = (
-            moving_tile_corners[1][1] if moving_tile_corners[1][1] >= 0 else 0
-        )
-        y_max = y_max if y_max <= y_size else y_size
-        y_max = np.ceil(y_max).astype(int)
-        # catch changing positions of x and y when there are coordinate flips
-        if y_min > y_max:
-            y_max_temp = y_min
-            y_min_temp = y_max
-            y_max = y_max_temp
-            y_min = y_min_temp
-        if x_min > x_max:
-            x_max_temp = x_min
-            x_min_temp = x_max
-            x_max = x_max_temp
-            x_min = x_min_temp
+        x_min, y_min = np.floor(
+            np.clip(moving_tile_corners[0], 0, [x_size, y_size])
+        ).astype(int)
+        x_max, y_max = np.ceil(
+            np.clip(moving_tile_corners[1], 0, [x_size, y_size])
+        ).astype(int)
         return x_max, x_min, y_max, y_min
 
+    def tile_memory_estimate(
+        self, all_channels: bool = True, streamed: bool = False
+    ) -> int:
+        """
+        Peak memory in bytes of resampling one tile, i.e. the largest moving
+        tile and the output tile, as float32 during resampling.
+
+        Parameters
+        ----------
+        all_channels: bool
+            all channels of a tile resampled together, with the displacement field of the
+            tile for non-linear sequences, otherwise a single channel of an output tile
+        streamed: bool
+            tiles of the OME-TIFF as resampled by `strip_generator` rather than zarr tiles
+
+        Returns
+        -------
+        n_bytes: int
+            estimated peak memory of one tile worker
+        """
+        moving_tile_areas = [
+            abs(mt_pos[1][0] - mt_pos[0][0]) * abs(mt_pos[1][1] - mt_pos[0][1])
+            for mt_pos in self._moving_tile_positions
+        ]
+        if self.reg_image.is_rgb:
+            n_comp = 3
+        else:
+            n_comp = self.reg_image.n_ch if all_channels else 1
+        itemsize = max(np.dtype(self.reg_image.im_dtype).itemsize, 4)
+        if all_channels and not streamed:
+            tile_area = self.zarr_tile_shape[0] * self.zarr_tile_shape[1]
+        else:
+            tile_area = self.tile_shape[0] * self.tile_shape[1]
+        field_bytes = 0
+        if all_channels and self._has_nonlinear_transform():
+            # 2D vectors of float64
+            field_bytes = tile_area * 2 * 8
+        return int(
+            (max(moving_tile_areas, default=0) + tile_area) * n_comp * itemsize
+            + field_bytes
+        )
+
+    def _moving_chunk_shape(self) -> Tuple[int, int]:
+        """(y, x) chunk shape of the moving image."""
+        return (
+            self.reg_image.dask_image.chunksize[:2]
+            if self.reg_image.is_rgb
+            else self.reg_image.dask_image.chunksize[1:]
+        )
+
+    def _tile_schedule(self) -> List[int]:
+        """Order of the tile jobs, tiles are sorted along a Hilbert curve over the
+        moving chunks containing the centers of their moving footprints so
+        that consecutive jobs read the same or neighbouring source chunks."""
+        return self._hilbert_schedule(
+            [
+                (np.asarray(mt_pos[0]) + np.asarray(mt_pos[1])) / 2
+                for mt_pos in self._moving_tile_positions
+            ]
+        )
+
+    def _output_tile_schedule(
+        self, tile_positions: List[Tuple[np.ndarray, np.ndarray]]
+    ) -> List[int]:
+        """`_tile_schedule` of OME-TIFF tiles, the moving center of each tile is looked up
+        in the footprint sampling grid rather than mapping its footprint."""
+        moving_coordinate_grid = self._get_moving_coordinate_grid()
+        grid_shape = np.asarray(moving_coordinate_grid.shape[1::-1]) - 1
+        centers = []
+        for tile_position in tile_positions:
+            x_idx, y_idx = np.clip(
+                np.round(
+                    (tile_position[0] + tile_position[1])
+                    / 2
+                    / self.footprint_sample_step
+                ).astype(int),
+                0,
+                grid_shape,
+            )
+            centers.append(
+                moving_coordinate_grid[y_idx, x_idx] / self.reg_image.image_res
+            )
+        return self._hilbert_schedule(centers)
+
+    def _hilbert_schedule(self, moving_centers: List[np.ndarray]) -> List[int]:
+        """Indices of moving pixel positions sorted along a Hilbert curve over the
+        moving chunks containing them."""
+        if not len(moving_centers):
+            return []
+
+        yx_chunks = np.asarray(self._moving_chunk_shape())
+        centers = np.asarray(moving_centers)
+        # x,y moving chunk containing each center, shifted to start at 0
+        cells = np.floor(centers / yx_chunks[::-1]).astype(np.int64)
+        cells -= cells.min(axis=0)
+        order = max(int(np.ceil(np.log2(cells.max() + 1))), 1)
+
+        return np.argsort(
+            hilbert_index(cells[:, 0], cells[:, 1], order), kind="stable"
+        ).tolist()
+
     def _transform_write_tile_set(
         self, resample_zarray: zarr.Array, max_workers: Optional[int] = None
     ):
-        """Function to loop over all channels and tile positions
-        and write to zarr"""
+        """Function to loop over all tile positions and write to zarr,
+        all channels of a tile are resampled together"""
+        if not max_workers:
+            max_workers = workers_for_memory(
+                get_n_threads(), self.tile_memory_estimate()
+            )
+
         if max_workers == 1:
             use_multiprocessing = False
         else:
             use_multiprocessing = True
-            if not max_workers:
-                max_workers = multiprocessing.cpu_count()
 
-        n_ch = 1 if self.reg_image.is_rgb else self.reg_image.n_ch
+        ch_idx = 0 if self.reg_image.n_ch == 1 else None
+        tile_schedule = self._tile_schedule()
         all_tile_args = []
-        for ch_idx in range(n_ch):
-            for ft_pos, mt_pos in tqdm(
-                zip(
-                    self._fixed_tile_positions,
-                    self._moving_tile_positions,
-                ),
-                total=len(self._fixed_tile_positions),
-                desc="Writing zarr tiles",
-                unit=" tile",
-                disable=True if use_multiprocessing else False,
-            ):
-                tile_origin = (
-                    ft_pos[0] * self.reg_transform_seq.output_spacing[0]
-                )
-                tile_args = (
-                    resample_zarray,
-                    ch_idx,
-                    ft_pos,
-                    tuple(tile_origin.astype(float)),
-                    mt_pos,
+        for ft_pos, mt_pos in tqdm(
+            (
+                (
+                    self._fixed_tile_positions[tile_idx],
+                    self._moving_tile_positions[tile_idx],
                 )
-                all_tile_args.append(tile_args)
-                if not use_multiprocessing:
-                    self._transform_write_tile(tile_args)
+                for tile_idx in tile_schedule
+            ),
+            total=len(tile_schedule),
+            desc="Writing zarr tiles",
+            unit=" tile",
+            disable=True if use_multiprocessing else False,
+        ):
+            tile_origin = ft_pos[0] * self.reg_transform_seq.output_spacing[0]
+            tile_args = (
+                resample_zarray,
+                0 if self.reg_image.is_rgb else ch_idx,
+                ft_pos,
+                tuple(tile_origin.astype(float)),
+                mt_pos,
+            )
+            all_tile_args.append(tile_args)
+            if not use_multiprocessing:
+                self._transform_write_tile(tile_args)
 
         if use_multiprocessing:
             with ThreadPoolExecutor(max_workers) as executor:
@@ -556,6 +1055,9 @@ class OmeTiffTiledWriter:
                     )
                 )
 
+        if self.chunk_cache is not None:
+            print(f"moving chunk cache: {self.chunk_cache.summary()}")
+
     def _prepare_image_info(
         self,
         image_name,
@@ -574,7 +1076,7 @@ class OmeTiffTiledWriter:
             out_tile_shape = (out_tile_shape[0] // 2, out_tile_shape[1] // 2)
 
         pyr_levels, _ = get_pyramid_info(
-            y_size, x_size, self.reg_image.n_ch, self.tile_shape[0]
+            y_size, x_size, self.reg_image.n_ch, out_tile_shape[0]
         )
 
         n_pyr_levels = len(pyr_levels)
@@ -605,24 +1107,326 @@ class OmeTiffTiledWriter:
         return n_pyr_levels, subifds, out_tile_shape, omexml
 
     def _transformed_tile_generator(self, d_array: da.Array, ch_idx: int):
-        """Create generator of tifffile tiles for OME-TIFF."""
+        """Create generator of tifffile tiles for OME-TIFF, background tiles are
+        yielded as None and written as empty (zero-byte) tiles."""
         out_shape = (
             d_array.shape[:2] if self.reg_image.is_rgb else d_array.shape[1:]
         )
         for y in range(0, out_shape[0], self.tile_shape[0]):
             for x in range(0, out_shape[1], self.tile_shape[1]):
                 if self.reg_image.is_rgb:
-                    yield d_array[
+                    tile = d_array[
                         y : y + self.tile_shape[0],
                         x : x + self.tile_shape[1],
                         :,
                     ].compute()
                 else:
-                    yield d_array[
+                    tile = d_array[
                         ch_idx,
                         y : y + self.tile_shape[0],
                         x : x + self.tile_shape[1],
                     ].compute()
+                yield None if is_empty_tile(tile) else tile
+
+    def _output_tile_positions(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Top-left and bottom-right pixel positions of the OME-TIFF tiles
+        in the order tifffile writes them, i.e., row-major."""
+        x_size, y_size = self.reg_transform_seq.output_size
+        return [
+            (
+                np.array([x, y]),
+                np.array(
+                    [
+                        min(x + self.tile_shape[1], x_size),
+                        min(y + self.tile_shape[0], y_size),
+                    ]
+                ),
+            )
+            for y in range(0, y_size, self.tile_shape[0])
+            for x in range(0, x_size, self.tile_shape[1])
+        ]
+
+    def tile_band_rows(self) -> int:
+        """Rows of OME-TIFF tiles resampled out of order by `strip_generator`, the rows
+        spanning the height of a moving chunk and at least 2. 1 if the chunk cache holds
+        the moving chunks of a row of tiles, reading rows in order then decodes each chunk
+        about once per row, while reordering a band evicts chunks the next rows read."""
+        if self.chunk_cache is None:
+            return 1
+
+        chunk_shape = np.asarray(self._moving_chunk_shape())
+        # the strips resample all channels, each read spans all channels of a chunk
+        chunk_bytes = self.chunk_cache.max_chunk_bytes
+        if self.chunk_cache.channel_axis is not None:
+            chunk_bytes *= self.reg_image.dask_image.shape[
+                self.chunk_cache.channel_axis
+            ]
+        image_size = np.asarray(self._get_image_size())
+        moving_coordinate_grid = (
+            self._get_moving_coordinate_grid() / self.reg_image.image_res
+        )
+        grid_rows = int(
+            np.ceil(self.tile_shape[0] / self.footprint_sample_step)
+        )
+        row_chunks = 0
+        for y_idx in range(0, moving_coordinate_grid.shape[0], grid_rows):
+            row_pts = moving_coordinate_grid[y_idx : y_idx + grid_rows + 1]
+            row_pts = row_pts.reshape(-1, 2)
+            row_pts = row_pts[
+                np.all((row_pts >= 0) & (row_pts < image_size), axis=1)
+            ]
+            row_chunks = max(
+                row_chunks,
+                len(np.unique(row_pts // chunk_shape[::-1], axis=0)),
+            )
+        if row_chunks * chunk_bytes <= self.chunk_cache.max_bytes:
+            return 1
+        return max(2, int(chunk_shape[0]) // self.tile_shape[0])
+
+    def _resampled_tile_generator(
+        self, ch_idx: Optional[int], max_workers: int
+    ):
+        """Resample OME-TIFF tiles in parallel and yield their positions and data in
+        row-major order.
+
+        Tiles are resampled in bands of `tile_band_rows` rows, within a band in the order of
+        `_output_tile_schedule` so that consecutive tiles read the same or neighbouring moving
+        chunks. At least `2 * max_workers` tiles are in flight, finished tiles wait until all
+        tiles before them are yielded, so at most a band of tiles is held.
+        """
+        tile_positions = self._output_tile_positions()
+        x_size, _ = self.reg_transform_seq.output_size
+        band_size = self.tile_band_rows() * int(
+            np.ceil(x_size / self.tile_shape[1])
+        )
+        with ThreadPoolExecutor(max_workers) as executor:
+            for band_start in range(0, len(tile_positions), band_size):
+                band = tile_positions[band_start : band_start + band_size]
+                schedule = deque(self._output_tile_schedule(band))
+                pending = {}
+                for tile_idx, tile_position in enumerate(band):
+                    while schedule and (
+                        tile_idx not in pending
+                        or len(pending) < 2 * max_workers
+                    ):
+                        scheduled_idx = schedule.popleft()
+                        pending[scheduled_idx] = executor.submit(
+                            self._resample_output_tile,
+                            ch_idx,
+                            band[scheduled_idx],
+                        )
+                    yield tile_position, pending.pop(tile_idx).result()
+
+    def strip_generator(
+        self, ch_idx: Optional[int], max_workers: Optional[int] = None
+    ):
+        """
+        Resample a channel, all channels, or the RGB image, tile-by-tile in parallel and
+        assemble the tiles into strips of one row of tiles, top to bottom, background tiles
+        are left as zeros.
+
+        Parameters
+        ----------
+        ch_idx: int or None
+            index of the channel, None for all channels of a multichannel image, which
+            are resampled together with one read of the moving footprint and one evaluation
+            of the transform per tile, ignored for RGB images
+        max_workers: int
+            number of threads resampling tiles, defaults to the thread and memory budget
+            of wsireg
+
+        Yields
+        ------
+        strip: np.ndarray
+            (tile rows, output width) strip of the transformed channel, with the RGB
+            components or the channels last for RGB images and `ch_idx` None
+        """
+        if not max_workers:
+            max_workers = workers_for_memory(
+                get_n_threads(),
+                self.tile_memory_estimate(
+                    all_channels=ch_idx is None, streamed=True
+                ),
+            )
+        x_size, _ = self.reg_transform_seq.output_size
+        if self.reg_image.is_rgb:
+            rgb_shape = (self.reg_image.shape[-1],)
+        elif ch_idx is None:
+            rgb_shape = (self.reg_image.n_ch,)
+        else:
+            rgb_shape = ()
+        strip = None
+        for tile_position, tile in self._resampled_tile_generator(
+            ch_idx, max_workers
+        ):
+            (x_min, y_min), (x_max, y_max) = tile_position
+            if x_min == 0:
+                strip = np.zeros(
+                    (y_max - y_min, x_size) + rgb_shape,
+                    dtype=self.reg_image.im_dtype,
+                )
+            if not is_empty_tile(tile):
+                strip[:, x_min:x_max] = tile
+            if x_max == x_size:
+                yield strip
+
+    def _write_streamed_plane(
+        self,
+        tif: TiffWriter,
+        strips,
+        n_pyr_levels: int,
+        subifds: Optional[int],
+        description: Optional[str],
+        options: dict,
+        temp_dir: Optional[Union[str, Path]] = None,
+    ) -> None:
+        """Stream the base layer of a channel (or the RGB image) to the TIFF in strips of
+        tiles, the pyramid is built from the strips as they are written."""
+        x_size, y_size = self.reg_transform_seq.output_size
+        rgb_shape = (
+            (self.reg_image.shape[-1],) if self.reg_image.is_rgb else ()
+        )
+        write_strip_pyramid(
+            tif,
+            strips,
+            (y_size, x_size) + rgb_shape,
+            self.reg_image.im_dtype,
+            self.tile_shape,
+            n_pyr_levels,
+            options,
+            subifds=subifds,
+            description=description,
+            temp_dir=temp_dir,
+        )
+
+    def _write_image_by_tile_stream(
+        self,
+        output_file_name: str,
+        image_name: str,
+        write_pyramid: bool,
+        compression: Optional[str],
+        temp_dir: Optional[Union[str, Path]] = None,
+        max_workers: Optional[int] = None,
+        compression_workers: Optional[int] = None,
+    ) -> str:
+        """Write tiles to OME-TIFF as they are resampled, without the temporary zarr store.
+        All channels of a tile are resampled together, the first channel is written as it
+        is resampled and the others are buffered, memory-mapped beyond half of the memory
+        budget, until their plane is written."""
+        (
+            n_pyr_levels,
+            subifds,
+            out_tile_shape,
+            omexml,
+        ) = self._prepare_image_info(image_name, write_pyramid=write_pyramid)
+        if not write_pyramid:
+            n_pyr_levels = 1
+
+        if not max_workers:
+            max_workers = workers_for_memory(
+                get_n_threads(), self.tile_memory_estimate(streamed=True)
+            )
+
+        options = dict(
+            tile=self.tile_shape,
+            compression=compression,
+            photometric="rgb" if self.reg_image.is_rgb else "minisblack",
+            metadata=None,
+            maxworkers=get_compression_workers(compression_workers),
+        )
+
+        x_size, y_size = self.reg_transform_seq.output_size
+        n_ch = 1 if self.reg_image.is_rgb else self.reg_image.n_ch
+        buffered_channels = allocate_pyramid_level(
+            (n_ch - 1, y_size, x_size),
+            self.reg_image.im_dtype,
+            temp_dir=temp_dir,
+        )
+
+        def _first_channel_strips():
+            if n_ch == 1:
+                yield from self.strip_generator(0, max_workers)
+                return
+            y = 0
+            for strip in self.strip_generator(None, max_workers):
+                buffered_channels[:, y : y + strip.shape[0]] = np.moveaxis(
+                    strip[..., 1:], -1, 0
+                )
+                y += strip.shape[0]
+                yield strip[..., 0]
+
+        with TiffWriter(output_file_name, bigtiff=True) as tif:
+            print("streaming channel 0")
+            self._write_streamed_plane(
+                tif,
+                _first_channel_strips(),
+                n_pyr_levels,
+                subifds,
+                omexml,
+                options,
+                temp_dir=temp_dir,
+            )
+            for channel_idx in range(1, n_ch):
+                print(f"writing buffered channel {channel_idx}")
+                self._write_streamed_plane(
+                    tif,
+                    (
+                        buffered_channels[
+                            channel_idx - 1, y : y + self.tile_shape[0]
+                        ]
+                        for y in range(0, y_size, self.tile_shape[0])
+                    ),
+                    n_pyr_levels,
+                    subifds,
+                    None,
+                    options,
+                    temp_dir=temp_dir,
+                )
+
+        if self.chunk_cache is not None:
+            print(f"moving chunk cache: {self.chunk_cache.summary()}")
+
+        return output_file_name
+
+    def _build_pyramid(
+        self,
+        dask_image: da.Array,
+        n_pyr_levels: int,
+        zarr_store: zarr.TempStore,
+    ) -> List[da.Array]:
+        """Build pyramid levels by 2x2 block means of the previous level. Each level is stored
+        in the temporary zarr store so the next one reads it rather than re-reading the base layer.
+
+        Parameters
+        ----------
+        dask_image: da.Array
+            base layer
+        n_pyr_levels: int
+            number of levels including the base layer
+        zarr_store: zarr.TempStore
+            temporary store where the levels are kept
+
+        Returns
+        -------
+        pyramid: list of da.Array
+            base layer followed by the sub-resolutions
+        """
+        pyramid = [dask_image]
+        for pyr_idx in range(1, n_pyr_levels):
+            sub_res = compute_sub_res(
+                pyramid[-1],
+                1,
+                self.tile_shape[0],
+                self.reg_image.is_rgb,
+                self.reg_image.im_dtype,
+            )
+            component = f"{random_str()}_pyr{pyr_idx}"
+            print(f"pyr {pyr_idx} : computing shape: {sub_res.shape}")
+            sub_res.to_zarr(
+                zarr_store, component=component, write_empty_chunks=False
+            )
+            pyramid.append(da.from_zarr(zarr_store, component=component))
+        return pyramid
 
     def write_image_by_tile(
         self,
@@ -631,9 +1435,12 @@ class OmeTiffTiledWriter:
         write_pyramid: bool = True,
         compression: Optional[str] = "default",
         zarr_temp_dir: Optional[Union[str, Path]] = None,
+        stream: bool = False,
+        compression_workers: Optional[int] = None,
     ) -> str:
         """
-        Write images to OME-TIFF from temp zarr store with data.
+        Write images to OME-TIFF from temp zarr store with data or, with `stream`,
+        directly as tiles are resampled.
 
         Parameters
         ----------
@@ -648,13 +1455,35 @@ class OmeTiffTiledWriter:
             and "jpeg" for RGB images
         zarr_temp_dir: Path or str
             Directory to store the temporary zarr data
-            (mostly used for debugging)
+            (mostly used for debugging), when streaming, pyramid levels that
+            don't fit in the memory budget are stored here
+        stream: bool
+            Resample tiles in parallel and write them to the OME-TIFF in order, without the
+            temporary zarr store. Pyramid levels are downsampled from the streamed tiles,
+            each level from the previous one
+        compression_workers: int
+            Number of threads encoding tiles, defaults to the thread budget of wsireg.
+            Tiles are written in order
 
         Returns
         -------
         output_file_name: Path
             Path to written image file
         """
+        if stream:
+            if compression == "default":
+                compression = "jpeg" if self.reg_image.is_rgb else "deflate"
+            output_file_name = str(Path(output_dir) / f"{image_name}.ome.tiff")
+            print(f"saving to {output_file_name}")
+            return self._write_image_by_tile_stream(
+                output_file_name,
+                image_name,
+                write_pyramid,
+                compression,
+                temp_dir=zarr_temp_dir,
+                compression_workers=compression_workers,
+            )
+
         zstr = zarr.TempStore(dir=zarr_temp_dir)
         try:
             resample_zarray = self.write_tiles_to_zarr_store(zstr)
@@ -678,11 +1507,17 @@ class OmeTiffTiledWriter:
             print(f"saving to {output_file_name}")
 
             dask_image = da.from_zarr(resample_zarray)
+            pyramid = (
+                self._build_pyramid(dask_image, n_pyr_levels, zstr)
+                if write_pyramid
+                else [dask_image]
+            )
             options = dict(
                 tile=self.tile_shape,
                 compression=compression,
                 photometric="rgb" if self.reg_image.is_rgb else "minisblack",
                 metadata=None,
+                maxworkers=get_compression_workers(compression_workers),
             )
             with TiffWriter(output_file_name, bigtiff=True) as tif:
                 if self.reg_image.is_rgb:
@@ -704,13 +1539,7 @@ class OmeTiffTiledWriter:
 
                     if write_pyramid:
                         for pyr_idx in range(1, n_pyr_levels):
-                            sub_res = compute_sub_res(
-                                dask_image,
-                                pyr_idx,
-                                self.tile_shape[0],
-                                self.reg_image.is_rgb,
-                                self.reg_image.im_dtype,
-                            )
+                            sub_res = pyramid[pyr_idx]
                             print(
                                 f"pyr {pyr_idx} : RGB-shape: {sub_res.shape}"
                             )
@@ -747,13 +1576,7 @@ class OmeTiffTiledWriter:
                         )
                         if write_pyramid:
                             for pyr_idx in range(1, n_pyr_levels):
-                                sub_res = compute_sub_res(
-                                    dask_image,
-                                    pyr_idx,
-                                    self.tile_shape[0],
-                                    self.reg_image.is_rgb,
-                                    self.reg_image.im_dtype,
-                                )
+                                sub_res = pyramid[pyr_idx]
 
                                 sub_res_tile_iterator = (
                                     self._transformed_tile_generator(
@@ -830,6 +1653,349 @@ def compute_sub_res(
     return resampled_zarray_subres
 
 
+def hilbert_index(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    """
+    Distance along a Hilbert curve filling a 2**order x 2**order grid of integer
+    x,y cells, cells at consecutive distances are neighbours.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        x cell indices in [0, 2**order)
+    y: np.ndarray
+        y cell indices in [0, 2**order)
+    order: int
+        order of the curve
+
+    Returns
+    -------
+    distances: np.ndarray
+        distance of each cell along the curve
+    """
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    distances = np.zeros_like(x)
+    s = 2 ** (order - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        distances += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the sub-curve is in its base orientation
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return distances
+
+
+def is_empty_tile(tile: Optional[np.ndarray]) -> bool:
+    """
+    Whether a tile is all background, i.e., missing or all zero, the default pixel
+    value of the resampling.
+
+    Parameters
+    ----------
+    tile: np.ndarray or None
+        tile data
+
+    Returns
+    -------
+    is_empty: bool
+        True if the tile can be skipped
+    """
+    return tile is None or not tile.any()
+
+
+def downsample_2x(image: np.ndarray) -> np.ndarray:
+    """
+    Factor-of-2 mean downsampling of a plane or RGB interleaved image, trailing odd
+    rows and columns are trimmed like `compute_sub_res`.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        (y, x) plane or (y, x, 3) RGB image
+
+    Returns
+    -------
+    downsampled_image: np.ndarray
+        image downsampled in y and x, same dtype as `image`
+    """
+    y_size, x_size = image.shape[0] // 2, image.shape[1] // 2
+    image = image[: y_size * 2, : x_size * 2]
+    if image.dtype.kind not in "ui":
+        return (
+            image.reshape((y_size, 2, x_size, 2) + image.shape[2:])
+            .mean(axis=(1, 3))
+            .astype(image.dtype)
+        )
+
+    # integer means from sums of the four strided quarters, exact in float32
+    # for 8 and 16 bit images, truncated like the mean above
+    acc_dtype = np.float32 if image.dtype.itemsize <= 2 else np.float64
+    downsampled_image = image[0::2, 0::2].astype(acc_dtype)
+    downsampled_image += image[1::2, 0::2]
+    downsampled_image += image[0::2, 1::2]
+    downsampled_image += image[1::2, 1::2]
+    downsampled_image /= 4
+    return downsampled_image.astype(image.dtype)
+
+
+def allocate_pyramid_level(
+    shape: Tuple[int, ...],
+    dtype: np.dtype,
+    temp_dir: Optional[Union[str, Path]] = None,
+) -> np.ndarray:
+    """
+    Zero-initialized array for a pyramid level or buffered channels, memory-mapped to a temporary file
+    if it would take more than half of the memory budget (see `get_memory_budget`).
+
+    Parameters
+    ----------
+    shape: tuple of int
+        shape of the level
+    dtype: np.dtype
+        dtype of the level
+    temp_dir: Path or str
+        directory of the temporary file
+
+    Returns
+    -------
+    level: np.ndarray
+        array or memory-mapped array of zeros
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    memory_budget = get_memory_budget()
+    if memory_budget is not None and nbytes > memory_budget // 2:
+        temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".dat")
+        level = np.memmap(temp_file, dtype=dtype, mode="w+", shape=shape)
+        # the file is deleted when closed, keep it open as long as the level
+        level.temp_file = temp_file
+        return level
+    return np.zeros(shape, dtype=dtype)
+
+
+def array_tile_generator(image: np.ndarray, tile_shape: Tuple[int, int]):
+    """
+    Create generator of tifffile tiles from an in-memory plane or RGB image,
+    background tiles are yielded as None and written as empty (zero-byte) tiles.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        (y, x) plane or (y, x, 3) RGB image
+    tile_shape: tuple of int
+        (y, x) shape of the tiles
+    """
+    for y in range(0, image.shape[0], tile_shape[0]):
+        for x in range(0, image.shape[1], tile_shape[1]):
+            tile = np.asarray(
+                image[y : y + tile_shape[0], x : x + tile_shape[1]]
+            )
+            yield None if is_empty_tile(tile) else tile
+
+
+class StripPyramid:
+    """
+    Builds all sub-resolutions of an image in one pass over strips of rows of the base
+    level. Each strip is downsampled 2x2 into the first sub-resolution and the new rows of
+    every level are passed on to the next one, so the base level is never held in memory
+    and no level is re-read to build the next. Levels are 2x2 means like `downsample_2x`,
+    trailing odd rows and columns are trimmed.
+
+    Parameters
+    ----------
+    shape: tuple of int
+        (y, x) or (y, x, 3) shape of the base level
+    dtype: np.dtype
+        dtype of the image
+    n_pyr_levels: int
+        number of levels including the base level
+    temp_dir: Path or str
+        directory for sub-resolutions memory-mapped because they would take more than half
+        of the memory budget
+
+    Attributes
+    ----------
+    levels: list of np.ndarray
+        sub-resolutions, 2x, 4x, ... downsampled
+    """
+
+    def __init__(
+        self,
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        n_pyr_levels: int,
+        temp_dir: Optional[Union[str, Path]] = None,
+    ):
+        self.levels: List[np.ndarray] = []
+        level_shape = tuple(shape)
+        for _ in range(1, n_pyr_levels):
+            level_shape = (
+                level_shape[0] // 2,
+                level_shape[1] // 2,
+            ) + level_shape[2:]
+            self.levels.append(
+                allocate_pyramid_level(level_shape, dtype, temp_dir=temp_dir)
+            )
+
+        self._n_rows = [0] * len(self.levels)
+        self._odd_rows: List[Optional[np.ndarray]] = [None] * len(self.levels)
+
+    def add_strip(self, strip: np.ndarray) -> None:
+        """
+        Add the next strip of rows of the base level.
+
+        Parameters
+        ----------
+        strip: np.ndarray
+            (rows, x) or (rows, x, 3) rows following the previous strip
+        """
+        self._add_strip(0, strip)
+
+    def _add_strip(self, level_idx: int, strip: np.ndarray) -> None:
+        """Downsample the rows of the level above into `levels[level_idx]`, an odd
+        trailing row waits for the next strip."""
+        if level_idx >= len(self.levels):
+            return
+
+        if self._odd_rows[level_idx] is not None:
+            strip = np.concatenate([self._odd_rows[level_idx], strip])
+            self._odd_rows[level_idx] = None
+        n_even_rows = strip.shape[0] - strip.shape[0] % 2
+        if n_even_rows < strip.shape[0]:
+            self._odd_rows[level_idx] = strip[n_even_rows:]
+        if n_even_rows == 0:
+            return
+
+        level = self.levels[level_idx]
+        y = self._n_rows[level_idx]
+        strip = strip[:n_even_rows]
+        if is_empty_tile(strip):
+            # levels start as zeros
+            sub_strip = np.zeros(
+                (n_even_rows // 2,) + level.shape[1:], dtype=level.dtype
+            )
+        else:
+            sub_strip = downsample_2x(strip)
+            level[y : y + sub_strip.shape[0]] = sub_strip
+        self._n_rows[level_idx] += sub_strip.shape[0]
+
+        self._add_strip(level_idx + 1, sub_strip)
+
+
+def write_strip_pyramid(
+    tif: TiffWriter,
+    strips,
+    shape: Tuple[int, ...],
+    dtype: np.dtype,
+    tile_shape: Tuple[int, int],
+    n_pyr_levels: int,
+    options: dict,
+    subifds: Optional[int] = None,
+    description: Optional[str] = None,
+    temp_dir: Optional[Union[str, Path]] = None,
+) -> None:
+    """
+    Write an image given as strips of `tile_shape[0]` rows and its pyramid to an open TIFF.
+    The tiles of each strip are written as it arrives while a `StripPyramid` builds the
+    sub-resolutions, which are written as sub-IFDs after the base level.
+
+    Parameters
+    ----------
+    tif: TiffWriter
+        open TIFF
+    strips: iterable of np.ndarray
+        consecutive (rows, x) or (rows, x, 3) strips of the base level
+    shape: tuple of int
+        (y, x) or (y, x, 3) shape of the base level
+    dtype: np.dtype
+        dtype of the image
+    tile_shape: tuple of int
+        (y, x) shape of the TIFF tiles
+    n_pyr_levels: int
+        number of levels including the base level
+    options: dict
+        options passed to `tif.write`, i.e., compression, photometric
+    subifds: int
+        number of sub-IFDs of the base level
+    description: str
+        ImageDescription of the base level, i.e., OME-XML
+    temp_dir: Path or str
+        directory for memory-mapped sub-resolutions
+    """
+    pyramid = StripPyramid(shape, dtype, n_pyr_levels, temp_dir=temp_dir)
+
+    def _strip_tiles():
+        for strip in strips:
+            pyramid.add_strip(strip)
+            yield from array_tile_generator(strip, tile_shape)
+
+    tif.write(
+        _strip_tiles(),
+        shape=shape,
+        dtype=dtype,
+        subifds=subifds,
+        description=description,
+        **options,
+    )
+
+    for pyr_idx, level in enumerate(pyramid.levels, start=1):
+        print(f"pyr {pyr_idx} : shape: {level.shape}")
+        tif.write(
+            array_tile_generator(level, tile_shape),
+            shape=level.shape,
+            dtype=dtype,
+            **options,
+            subfiletype=1,
+        )
+
+
+def registered_dask_array(
+    reg_image: RegImage,
+    reg_transform_seq: RegTransformSeq,
+    chunk_size: int = 512,
+    moving_tile_padding: Optional[int] = None,
+    output_spacing: Optional[
+        Tuple[Union[int, float], Union[int, float]]
+    ] = None,
+) -> da.Array:
+    """
+    Lazy view of a registered image in fixed space as a dask array. Regions or
+    sub-resolutions can be computed without writing the whole image to disk.
+
+    Parameters
+    ----------
+    reg_image: RegImage
+        wsireg RegImage that has a dask store that is chunked in XY
+    reg_transform_seq: RegTransformSeq
+        wsireg registration transform sequence to be applied to the image
+    chunk_size: int
+        Chunk size in x and y of the dask array
+    moving_tile_padding: int
+        How many additional moving pixels to pull around the footprint of each chunk,
+        defaults to the support of the resampling interpolator
+    output_spacing: Tuple[Union[int,float], Union[int,float]]
+        Spacing of the output grid, i.e., to view a lower resolution, defaults to
+        the spacing of reg_transform_seq. Note: sets the output spacing of reg_transform_seq
+
+    Returns
+    -------
+    transformed_image: da.Array
+        Transformed image, (y, x, 3) for RGB images, (channels, y, x) otherwise
+    """
+    tiled_writer = OmeTiffTiledWriter(
+        reg_image,
+        reg_transform_seq,
+        moving_tile_padding=moving_tile_padding,
+    )
+    if output_spacing is not None:
+        tiled_writer.set_output_spacing(output_spacing)
+
+    return tiled_writer.to_dask_array(chunk_size=chunk_size)
+
+
 def random_str() -> str:
     """Get a random string to store the zarr array"""
     letters = string.ascii_lowercase
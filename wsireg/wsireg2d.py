@@ -1,7 +1,11 @@
 import json
+import multiprocessing
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy, deepcopy
+from functools import partial, wraps
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union
 from warnings import warn
@@ -10,6 +14,7 @@ import shutil
 import numpy as np
 import yaml
 
+from wsireg.parameter_maps.convergence import ConvergenceParams
 from wsireg.parameter_maps.preprocessing import ImagePreproParams
 from wsireg.parameter_maps.reg_model import RegModel
 from wsireg.reg_images import MergeRegImage
@@ -24,20 +29,68 @@ from wsireg.utils.im_utils import ARRAYLIKE_CLASSES
 from wsireg.utils.output_utils import (
     read_elastix_iteration_dir,
     read_elastix_transform_dir,
+    write_iteration_npz,
     write_iteration_plots,
 )
 from wsireg.utils.reg_utils import (
     _prepare_reg_models,
+    _reg_models_match,
+    calibrate_reg_models,
+    calibration_reg_models,
     register_2d_images_itkelx,
     sitk_pmap_to_dict,
 )
+from wsireg.utils.resource_utils import get_n_threads, set_resource_limits
 from wsireg.utils.shape_utils import invert_nonrigid_transforms
-from wsireg.utils.tform_utils import identity_elx_transform
+from wsireg.utils.tform_utils import (
+    elastix_transform_to_txt,
+    identity_elx_transform,
+    write_wsireg_transform_npz,
+)
+from wsireg.utils.writer_utils import (
+    PLANE_ONLY_READERS,
+    choose_file_writer,
+    choose_merge_file_writer,
+)
 from wsireg.writers.merge_ome_tiff_writer import MergeOmeTiffWriter
 from wsireg.writers.ome_tiff_writer import OmeTiffWriter
+from wsireg.writers.ome_zarr_writer import OmeZarrWriter
 from wsireg.writers.tiled_ome_tiff_writer import OmeTiffTiledWriter
 
 
+DIAGNOSTICS_LEVELS = ("full", "compact", "none")
+TRANSFORM_FILE_FORMATS = ("json", "npz", "both")
+
+
+def _write_iteration_plot_jobs(
+    plot_jobs: List[
+        Tuple[Dict[int, Dict[int, Dict[str, np.ndarray]]], str, Path]
+    ]
+) -> None:
+    for all_iteration_data, data_key, output_path in plot_jobs:
+        write_iteration_plots(all_iteration_data, data_key, output_path)
+
+
+def _dfield_cache_dir(reg_graph: "WsiReg2D") -> Path:
+    """Directory of the displacement fields baked while writing images."""
+    return reg_graph.output_dir / f".dfield_cache_{reg_graph.project_name}"
+
+
+def _removes_dfield_cache(transform_images):
+    """Remove the baked displacement fields when `transform_images` returns or fails."""
+
+    @wraps(transform_images)
+    def _transform_images(self, *args, **kwargs):
+        try:
+            return transform_images(self, *args, **kwargs)
+        finally:
+            dfield_cache = _dfield_cache_dir(self)
+            if dfield_cache.exists():
+                shutil.rmtree(dfield_cache)
+
+    return _transform_images
+
+
 class WsiReg2D(object):
     """
     Class to define a 2D registration graph and execute the registrations and transformations of the graph
@@ -53,6 +106,18 @@ class WsiReg2D(object):
         this will avoid image io and preprocessing)
     config: str or Path
         path to a 2D wsireg YAML configuration
+    diagnostics: str
+        how much registration diagnostic data is kept, see `DIAGNOSTICS_LEVELS`:
+        "full" writes elastix logs, iteration info, per-resolution transforms and
+        iteration plots to the output directory,
+        "compact" registers in a local temporary directory, keeps iteration and transform data
+        in memory and writes them as a single npz per edge, plots are made with `write_iteration_plots`,
+        "none" keeps no diagnostic data
+    n_threads: int
+        CPU budget shared by elastix, SimpleITK, dask and the image readers and writers,
+        defaults to all CPUs
+    memory_limit: int or str
+        memory budget in bytes or with a unit (i.e., "16GB") that bounds concurrent tile resampling
 
     Attributes
     ----------
@@ -92,11 +157,16 @@ class WsiReg2D(object):
         shape data attached to a modality to be transformed along the graph
 
     registration_iter_data: Dict[str,Dict[int, Dict[int, Dict[str, np.ndarray]]]]
-        elastix data for each iteration in the registration sorted by transformation model and resolution
+        elastix data for each iteration in the registration sorted by transformation model and resolution,
+        with the preset and calibrated iteration counts when registered with convergence control
 
     registration_tform_data: Dict[str, Dict[int, Dict[int, Dict[str, str]]]]
         elastix transform data for each resolution sorted by transformation model and resolution
 
+    reg_stacks: dict
+        serial-section stacks added with `add_reg_stack`, their ordered modalities,
+        reference index and whether linear transforms are collapsed
+
     """
 
     def __init__(
@@ -105,7 +175,22 @@ class WsiReg2D(object):
         output_dir: Optional[Union[str, Path]] = None,
         cache_images: bool = True,
         config: Optional[Union[str, Path]] = None,
+        diagnostics: str = "full",
+        n_threads: Optional[int] = None,
+        memory_limit: Optional[Union[int, str]] = None,
     ):
+        if diagnostics not in DIAGNOSTICS_LEVELS:
+            raise ValueError(
+                f"diagnostics must be one of {DIAGNOSTICS_LEVELS}, "
+                f"got {diagnostics}"
+            )
+        self.diagnostics = diagnostics
+
+        self.n_threads: Optional[int] = None
+        self.memory_limit: Optional[Union[int, str]] = None
+        if n_threads is not None or memory_limit is not None:
+            self.set_resource_limits(n_threads, memory_limit)
+
         self.project_name: Optional[str] = None
         self.output_dir: Optional[Union[str, Path]] = None
         self.image_cache: Optional[Path] = None
@@ -113,6 +198,8 @@ class WsiReg2D(object):
         self.setup_project_output(project_name, output_dir)
 
         self.cache_images = cache_images
+        # calibrated registration models of convergence control by models and image pair
+        self._calibration_cache: Dict[str, Any] = dict()
 
         self.pairwise = False
 
@@ -141,6 +228,8 @@ class WsiReg2D(object):
 
         self.merge_modalities = dict()
         self.original_size_transforms = dict()
+        self.reg_stacks = dict()
+        self._cache_locks: Dict[str, threading.Lock] = dict()
 
         self.registration_iter_data: Dict[
             str, Dict[int, Dict[int, Dict[str, np.ndarray]]]
@@ -152,6 +241,26 @@ class WsiReg2D(object):
         if config:
             self.add_data_from_config(config)
 
+    def set_resource_limits(
+        self,
+        n_threads: Optional[int] = None,
+        memory_limit: Optional[Union[int, str]] = None,
+    ) -> None:
+        """
+        Set the CPU and memory budget used for registration, transformation and writing.
+        The budget applies to the whole process (see wsireg.utils.resource_utils).
+
+        Parameters
+        ----------
+        n_threads: int
+            maximum number of threads, None to use all CPUs
+        memory_limit: int or str
+            memory budget in bytes or with a unit (i.e., "16GB"), None for no limit
+        """
+        set_resource_limits(n_threads, memory_limit)
+        self.n_threads = n_threads
+        self.memory_limit = memory_limit
+
     def setup_project_output(
         self,
         project_name: Optional[str] = None,
@@ -618,9 +727,17 @@ class WsiReg2D(object):
                 }
             )
 
-        reg_graph_edges = deepcopy(self.reg_graph_edges)
-
-        [rge.pop("transforms", None) for rge in reg_graph_edges]
+        # transforms of registered edges hold ITK objects that can't be copied
+        reg_graph_edges = [
+            deepcopy(
+                {
+                    k: v
+                    for k, v in rge.items()
+                    if k not in ["transforms", "reg_state"]
+                }
+            )
+            for rge in self.reg_graph_edges
+        ]
 
         modalities_out = deepcopy(self.modalities)
         for mod, data in modalities_out.items():
@@ -650,6 +767,9 @@ class WsiReg2D(object):
             if len(self.attachment_images) > 0
             else None,
             "merge_modalities": self.merge_modalities,
+            "reg_stacks": self.reg_stacks
+            if len(self.reg_stacks) > 0
+            else None,
         }
 
         if not output_file_path:
@@ -663,171 +783,569 @@ class WsiReg2D(object):
 
         return str(output_file_path)
 
-    def register_images(self, parallel=False):
+    def add_reg_stack(
+        self,
+        stack_name: str,
+        modalities: List[str],
+        reference_idx: int = 0,
+        reg_params: Union[str, RegModel, List[str], List[RegModel]] = [
+            "rigid"
+        ],
+        override_prepro: dict = {"source": None, "target": None},
+        collapse_linear: bool = True,
+    ) -> None:
         """
-        Start image registration process for all modalities
+        Add a serial-section stack to the graph. Each section is registered to its
+        neighbour towards the reference section and transformed to the reference
+        through the chain of neighbouring sections.
 
         Parameters
         ----------
-        parallel : bool
-            whether to run each edge in parallel (not implemented yet)
+        stack_name: str
+            Unique name identifier for the stack
+        modalities: list of str
+            Ordered list of modalities (sections) that have been added to the graph
+        reference_idx: int
+            Index in `modalities` of the section all others are transformed to
+        reg_params: list of RegModel/str or str
+            Elastix registration parameters used for every adjacent pair
+        override_prepro: dict
+            set specific preprocessing for the source or target image of every
+            adjacent pair registration
+        collapse_linear: bool
+            Merge consecutive linear transforms of each section's chain into a single
+            affine transform so resampling cost does not grow with the distance
+            from the reference
         """
-        if self.cache_images is True:
-            self.image_cache.mkdir(parents=False, exist_ok=True)
+        if stack_name in self.reg_stacks:
+            raise ValueError(
+                'stack named \"{}\" is already in reg_stacks'.format(
+                    stack_name
+                )
+            )
+        if len(modalities) < 2:
+            raise ValueError(
+                "a registration stack needs at least 2 modalities"
+            )
+        if len(set(modalities)) != len(modalities):
+            raise ValueError(
+                "modalities in a registration stack must be unique"
+            )
+        if reference_idx < 0 or reference_idx >= len(modalities):
+            raise ValueError(
+                f"reference_idx {reference_idx} is out of range for stack "
+                f"of {len(modalities)} modalities"
+            )
 
-        self.save_config(registered=False)
+        reference_modality = modalities[reference_idx]
+        for idx, modality in enumerate(modalities):
+            if idx == reference_idx:
+                continue
+            neighbour_idx = idx + 1 if idx < reference_idx else idx - 1
+            thru_modality = (
+                modalities[neighbour_idx]
+                if neighbour_idx != reference_idx
+                else None
+            )
+            self.add_reg_path(
+                modality,
+                reference_modality,
+                thru_modality=thru_modality,
+                reg_params=reg_params,
+                override_prepro=override_prepro,
+            )
+
+        self.reg_stacks[stack_name] = {
+            "modalities": list(modalities),
+            "reference_idx": reference_idx,
+            "collapse_linear": collapse_linear,
+        }
+
+    def _load_reg_image(
+        self, modality_name: str, reg_edge: dict, edge_role: str
+    ) -> RegImage:
+        """Read, preprocess and cache (or load from cache) the image of one side
+        of a registration edge."""
+        other_role = "target" if edge_role == "source" else "source"
+        other_name = reg_edge["modalities"][other_role]
+        mod_data = self.modalities[modality_name].copy()
+
+        reg_image = reg_image_loader(
+            mod_data["image_filepath"],
+            mod_data["image_res"],
+            preprocessing=mod_data["preprocessing"],
+            mask=mod_data["mask"],
+        )
+        override_prepro = reg_edge.get(f"{edge_role}_override")
+
+        with self._cache_locks[modality_name]:
+            cached = reg_image.check_cache_preprocessing(
+                self.image_cache, modality_name
+            )
+            if not cached and not override_prepro:
+                reg_image.read_reg_image()
+                if self.cache_images:
+                    reg_image.cache_image_data(
+                        self.image_cache, modality_name, check=False
+                    )
+            elif override_prepro:
+                reg_image._preprocessing = override_prepro
+                reg_image.read_reg_image()
+                if self.cache_images:
+                    reg_image.cache_image_data(
+                        self.image_cache,
+                        f"{modality_name}-{other_name}-override",
+                        check=False,
+                    )
+            else:
+                reg_image.load_from_cache(self.image_cache, modality_name)
+
+        self._preprocessed_image_spacings.update(
+            {modality_name: reg_image.reg_image.GetSpacing()}
+        )
+        self._preprocessed_image_sizes.update(
+            {modality_name: reg_image.reg_image.GetSize()}
+        )
+        return reg_image
+
+    def _edge_output_path(self, reg_edge: dict) -> Path:
+        """Directory of the registration outputs of an edge."""
+        return self.output_dir / "{}-{}_to_{}_reg_output".format(
+            self.project_name,
+            reg_edge["modalities"]["source"],
+            reg_edge["modalities"]["target"],
+        )
+
+    @staticmethod
+    def _edge_data_key(reg_edge: dict) -> str:
+        """Key of an edge in `registration_iter_data` and `registration_tform_data`."""
+        return f'{reg_edge["modalities"]["source"]}_to_{reg_edge["modalities"]["target"]}'
+
+    def write_iteration_plots(
+        self, background: bool = False
+    ) -> Optional[multiprocessing.Process]:
+        """
+        Write plots of the elastix iteration data of all registered edges to their output
+        directories. Used to plot on request when `diagnostics` is not "full".
 
+        Parameters
+        ----------
+        background: bool
+            Write the plots in a separate process and return without waiting for it
+
+        Returns
+        -------
+        plot_process: multiprocessing.Process or None
+            the plotting process when `background` is True, join it to wait for the plots
+        """
+        plot_jobs = []
         for reg_edge in self.reg_graph_edges:
-            if (
-                reg_edge.get("registered") is None
-                or reg_edge.get("registered") is False
-            ):
-                src_name = reg_edge["modalities"]["source"]
-                tgt_name = reg_edge["modalities"]["target"]
+            data_key = self._edge_data_key(reg_edge)
+            if data_key not in self.registration_iter_data:
+                continue
+            output_path = self._edge_output_path(reg_edge)
+            output_path.mkdir(parents=False, exist_ok=True)
+            plot_jobs.append(
+                (self.registration_iter_data[data_key], data_key, output_path)
+            )
 
-                src_mod_data = self.modalities[src_name].copy()
-                tgt_mod_data = self.modalities[tgt_name].copy()
+        if background:
+            plot_process = multiprocessing.Process(
+                target=_write_iteration_plot_jobs, args=(plot_jobs,)
+            )
+            plot_process.start()
+            return plot_process
 
-                src_reg_image = reg_image_loader(
-                    src_mod_data["image_filepath"],
-                    src_mod_data["image_res"],
-                    preprocessing=src_mod_data["preprocessing"],
-                    mask=src_mod_data["mask"],
-                )
+        _write_iteration_plot_jobs(plot_jobs)
+        return None
 
-                tgt_reg_image = reg_image_loader(
-                    tgt_mod_data["image_filepath"],
-                    tgt_mod_data["image_res"],
-                    preprocessing=tgt_mod_data["preprocessing"],
-                    mask=tgt_mod_data["mask"],
-                )
+    def _reusable_transforms(
+        self, reg_edge: dict, reg_params_prepared: List[Dict[str, List[str]]]
+    ) -> List[Dict[str, List[str]]]:
+        """Elastix transforms of a previous registration of the edge whose models are
+        unchanged and precede any changed model, so they can be used as a fixed prefix."""
+        reg_state = reg_edge.get("reg_state")
+        prev_transforms = reg_edge.get("transforms")
+        if not reg_state or not prev_transforms:
+            return []
+
+        src_name = reg_edge["modalities"]["source"]
+        tgt_name = reg_edge["modalities"]["target"]
+        if (
+            reg_state["source_preprocessing"]
+            != self.modalities[src_name]["preprocessing"]
+            or reg_state["target_preprocessing"]
+            != self.modalities[tgt_name]["preprocessing"]
+            or reg_state["source_override"] != reg_edge.get("source_override")
+            or reg_state["target_override"] != reg_edge.get("target_override")
+        ):
+            return []
 
-                src_override_prepro = reg_edge.get("source_override")
-                tgt_override_prepro = reg_edge.get("target_override")
+        prev_reg_tforms = [
+            rt.elastix_transform
+            for rt in prev_transforms["registration"].reg_transforms
+        ]
+        n_reused = 0
+        for prev_model, model in zip(
+            reg_state["reg_params"], reg_params_prepared
+        ):
+            if not _reg_models_match(prev_model, model):
+                break
+            n_reused += 1
 
-                src_cached = src_reg_image.check_cache_preprocessing(
-                    self.image_cache, src_name
-                )
-                tgt_cached = src_reg_image.check_cache_preprocessing(
-                    self.image_cache, tgt_name
-                )
+        return prev_reg_tforms[:n_reused]
 
-                if not src_cached and not src_override_prepro:
-                    src_reg_image.read_reg_image()
-                    if self.cache_images:
-                        src_reg_image.cache_image_data(
-                            self.image_cache, src_name, check=False
-                        )
-                elif src_override_prepro:
-                    if src_override_prepro:
-                        src_reg_image._preprocessing = src_override_prepro
-                    src_reg_image.read_reg_image()
-                    if self.cache_images:
-                        src_reg_image.cache_image_data(
-                            self.image_cache,
-                            f"{src_name}-{tgt_name}-override",
-                            check=False,
-                        )
-                else:
-                    src_reg_image.load_from_cache(self.image_cache, src_name)
+    def _register_edge(
+        self,
+        reg_edge: dict,
+        warm_start: bool = False,
+        convergence: Optional[ConvergenceParams] = None,
+        n_threads: Optional[int] = None,
+    ) -> Tuple[Optional[Path], int, Dict[int, Dict[int, Dict[str, int]]]]:
+        """Register a single edge of the graph and store its transforms.
+        Returns the elastix output directory (None if nothing was optimized or
+        `diagnostics` is "none"),
+        the number of leading models reused from a previous registration and the
+        calibrated iteration counts of the optimized models."""
+        src_name = reg_edge["modalities"]["source"]
+        tgt_name = reg_edge["modalities"]["target"]
+
+        reg_params_prepared = _prepare_reg_models(reg_edge["params"])
+        reg_state = {
+            "reg_params": deepcopy(reg_params_prepared),
+            "source_preprocessing": deepcopy(
+                self.modalities[src_name]["preprocessing"]
+            ),
+            "target_preprocessing": deepcopy(
+                self.modalities[tgt_name]["preprocessing"]
+            ),
+            "source_override": deepcopy(reg_edge.get("source_override")),
+            "target_override": deepcopy(reg_edge.get("target_override")),
+        }
 
-                if not tgt_cached and not tgt_override_prepro:
-                    tgt_reg_image.read_reg_image()
-                    if self.cache_images:
-                        tgt_reg_image.cache_image_data(
-                            self.image_cache, tgt_name, check=False
-                        )
-                elif tgt_override_prepro:
-                    if tgt_override_prepro:
-                        tgt_reg_image._preprocessing = tgt_override_prepro
-                    tgt_reg_image.read_reg_image()
-                    if self.cache_images:
-                        src_reg_image.cache_image_data(
-                            self.image_cache,
-                            f"{tgt_name}-{src_name}-override",
-                            check=False,
+        if warm_start:
+            reused_tforms = self._reusable_transforms(
+                reg_edge, reg_params_prepared
+            )
+        else:
+            reused_tforms = []
+
+        if len(reused_tforms) == len(reg_params_prepared):
+            print(
+                f"registration models for {src_name} to {tgt_name} are "
+                "unchanged, reusing previous transforms"
+            )
+            reg_edge["reg_state"] = reg_state
+            reg_edge["registered"] = True
+            return None, len(reused_tforms), dict()
+
+        src_reg_image = self._load_reg_image(src_name, reg_edge, "source")
+        tgt_reg_image = self._load_reg_image(tgt_name, reg_edge, "target")
+
+        if self.diagnostics != "none":
+            output_path = self._edge_output_path(reg_edge)
+            output_path.mkdir(parents=False, exist_ok=True)
+
+        if reused_tforms:
+            print(
+                f"warm-starting {src_name} to {tgt_name} registration, "
+                f"reusing {len(reused_tforms)} of {len(reg_params_prepared)} models"
+            )
+
+        if self.diagnostics == "none":
+            # nothing is read back, elastix writes no output
+            elastix_output_path = None
+        elif self.diagnostics == "compact":
+            # elastix output is only read back, keep it off the output storage
+            elastix_output_path = Path(
+                tempfile.mkdtemp(prefix=f"{src_name}_to_{tgt_name}_")
+            )
+        elif reused_tforms:
+            # elastix numbers its output files from 0 for the models it runs,
+            # keep them apart from the outputs of the previous registration
+            elastix_output_path = output_path / "warm-start"
+            if elastix_output_path.exists():
+                shutil.rmtree(elastix_output_path)
+            elastix_output_path.mkdir(parents=False)
+        else:
+            elastix_output_path = output_path
+
+        reg_models = reg_params_prepared[len(reused_tforms) :]
+        iteration_counts = dict()
+
+        if convergence is not None:
+            # calibrations are reused for the same models, images and preprocessing
+            calibration_key = json.dumps(
+                [
+                    src_name,
+                    tgt_name,
+                    reg_state,
+                    reg_models,
+                    len(reused_tforms),
+                    convergence.dict(),
+                ],
+                sort_keys=True,
+                default=str,
+            )
+            if calibration_key in self._calibration_cache:
+                print(
+                    f"reusing convergence calibration of {src_name} to {tgt_name}"
+                )
+            else:
+                if elastix_output_path is None:
+                    # the calibration reads back the elastix iteration info
+                    calibration_path = Path(
+                        tempfile.mkdtemp(
+                            prefix=f"{src_name}_to_{tgt_name}_calibration_"
                         )
+                    )
                 else:
-                    tgt_reg_image.load_from_cache(self.image_cache, tgt_name)
+                    calibration_path = elastix_output_path / "calibration"
+                    if calibration_path.exists():
+                        shutil.rmtree(calibration_path)
+                    calibration_path.mkdir(parents=False)
 
-                self._preprocessed_image_spacings.update(
-                    {src_name: src_reg_image.reg_image.GetSpacing()}
-                )
-                self._preprocessed_image_spacings.update(
-                    {tgt_name: tgt_reg_image.reg_image.GetSpacing()}
-                )
-                self._preprocessed_image_sizes.update(
-                    {src_name: src_reg_image.reg_image.GetSize()}
+                register_2d_images_itkelx(
+                    src_reg_image,
+                    tgt_reg_image,
+                    calibration_reg_models(
+                        reg_models,
+                        convergence.calibration_sample_fraction,
+                        iteration_fraction=convergence.calibration_iteration_fraction,
+                        min_iterations=convergence.min_iterations,
+                    ),
+                    calibration_path,
+                    initial_transforms=reused_tforms,
+                    log_to_console=self.diagnostics == "full",
+                    n_threads=n_threads,
                 )
-                self._preprocessed_image_sizes.update(
-                    {tgt_name: tgt_reg_image.reg_image.GetSize()}
+                self._calibration_cache[
+                    calibration_key
+                ] = calibrate_reg_models(
+                    reg_models,
+                    read_elastix_iteration_dir(calibration_path),
+                    convergence,
                 )
+                if elastix_output_path is None:
+                    shutil.rmtree(calibration_path, ignore_errors=True)
+            reg_models, iteration_counts = deepcopy(
+                self._calibration_cache[calibration_key]
+            )
+            iteration_counts = {
+                model_idx + len(reused_tforms): counts
+                for model_idx, counts in iteration_counts.items()
+            }
 
-                reg_params = reg_edge["params"]
+        reg_tforms = register_2d_images_itkelx(
+            src_reg_image,
+            tgt_reg_image,
+            reg_models,
+            elastix_output_path,
+            initial_transforms=reused_tforms,
+            log_to_console=self.diagnostics == "full",
+            n_threads=n_threads,
+        )
 
-                output_path = (
-                    self.output_dir
-                    / "{}-{}_to_{}_reg_output".format(
-                        self.project_name,
-                        reg_edge["modalities"]["source"],
-                        reg_edge["modalities"]["target"],
-                    )
-                )
+        # the reused transforms are returned ahead of the optimized ones
+        reg_tforms = [sitk_pmap_to_dict(tf) for tf in reg_tforms]
 
-                output_path.mkdir(parents=False, exist_ok=True)
+        initial_transforms = src_reg_image.pre_reg_transforms
 
-                reg_params_prepared = _prepare_reg_models(reg_params)
+        if initial_transforms:
+            initial_transforms_rt = [
+                RegTransform(t) for t in initial_transforms
+            ]
+            initial_transforms_idx = [
+                idx for idx, _ in enumerate(initial_transforms_rt)
+            ]
+            initial_rt_seq = RegTransformSeq(
+                initial_transforms_rt, initial_transforms_idx
+            )
 
-                reg_tforms = register_2d_images_itkelx(
-                    src_reg_image,
-                    tgt_reg_image,
-                    reg_params_prepared,
-                    output_path,
-                )
+        reg_tforms_rt = [RegTransform(t) for t in reg_tforms]
+        reg_tforms_idx = [0 for _ in reg_tforms_rt]
+        reg_rt_seq = RegTransformSeq(reg_tforms_rt, reg_tforms_idx)
 
-                reg_tforms = [sitk_pmap_to_dict(tf) for tf in reg_tforms]
+        reg_edge["transforms"] = {
+            'initial': initial_rt_seq if initial_transforms else None,
+            'registration': reg_rt_seq,
+        }
 
-                initial_transforms = src_reg_image.pre_reg_transforms
+        self.original_size_transforms.update(
+            {tgt_name: tgt_reg_image.original_size_transform}
+        )
 
-                if initial_transforms:
-                    initial_transforms_rt = [
-                        RegTransform(t) for t in initial_transforms
-                    ]
-                    initial_transforms_idx = [
-                        idx for idx, _ in enumerate(initial_transforms_rt)
-                    ]
-                    initial_rt_seq = RegTransformSeq(
-                        initial_transforms_rt, initial_transforms_idx
-                    )
+        reg_edge["reg_state"] = reg_state
+        reg_edge["registered"] = True
 
-                reg_tforms_rt = [RegTransform(t) for t in reg_tforms]
-                reg_tforms_idx = [0 for _ in reg_tforms_rt]
-                reg_rt_seq = RegTransformSeq(reg_tforms_rt, reg_tforms_idx)
+        return elastix_output_path, len(reused_tforms), iteration_counts
 
-                reg_edge["transforms"] = {
-                    'initial': initial_rt_seq if initial_transforms else None,
-                    'registration': reg_rt_seq,
-                }
+    def register_images(
+        self,
+        parallel: bool = False,
+        n_workers: Optional[int] = None,
+        warm_start: bool = False,
+        convergence: Optional[Union[bool, dict, ConvergenceParams]] = None,
+    ):
+        """
+        Start image registration process for all modalities
+
+        Parameters
+        ----------
+        parallel : bool
+            whether to run each edge in parallel. Edges are independent registrations,
+            so this is most useful for graphs with many edges such as serial-section stacks
+        n_workers: int
+            Number of edges to register concurrently when `parallel` is True,
+            defaults to the thread budget (`n_threads` or all CPUs), at most the number of edges
+            to be registered. The thread budget is split between the concurrent registrations
+        warm_start: bool
+            For edges that were registered before (i.e., reset with `reset_registered_modality`
+            or `update_reg_params`), reuse the transforms of the leading registration models
+            that are unchanged as a fixed initial transform and only optimize the new or
+            changed models. Edges whose preprocessing changed are registered from scratch.
+        convergence: bool, dict or ConvergenceParams
+            Trim the iterations of each resolution to where the metric converges, as found by a
+            short calibration registration (see wsireg.parameter_maps.convergence.ConvergenceParams).
+            True uses the default settings. The preset and calibrated iterations are recorded as
+            "max_iterations" and "calibrated_iterations" in `registration_iter_data`
+        """
+        if self.cache_images is True:
+            self.image_cache.mkdir(parents=False, exist_ok=True)
+
+        self.save_config(registered=False)
+
+        # modality images may be shared between edges registered concurrently
+        self._cache_locks = {
+            modality_name: threading.Lock()
+            for modality_name in self.modality_names
+        }
+
+        edges_to_register = [
+            reg_edge
+            for reg_edge in self.reg_graph_edges
+            if reg_edge.get("registered") is None
+            or reg_edge.get("registered") is False
+        ]
+
+        if convergence is True:
+            convergence = ConvergenceParams()
+        elif isinstance(convergence, dict):
+            convergence = ConvergenceParams(**convergence)
+        elif convergence is False:
+            convergence = None
+
+        if parallel and len(edges_to_register) > 1:
+            if not n_workers:
+                n_workers = get_n_threads()
+            n_workers = min(n_workers, len(edges_to_register))
+        else:
+            n_workers = 1
+
+        # each concurrent registration gets its share of the thread budget
+        register_edge = partial(
+            self._register_edge,
+            warm_start=warm_start,
+            convergence=convergence,
+            n_threads=get_n_threads(n_workers),
+        )
+
+        if n_workers > 1:
+            with ThreadPoolExecutor(n_workers) as executor:
+                edge_outputs = list(
+                    executor.map(register_edge, edges_to_register)
+                )
+        else:
+            edge_outputs = [
+                register_edge(reg_edge) for reg_edge in edges_to_register
+            ]
 
-                self.original_size_transforms.update(
-                    {tgt_name: tgt_reg_image.original_size_transform}
+        # iteration data is read and plotted serially as matplotlib is not thread-safe
+        for reg_edge, (elastix_output_path, n_reused, iteration_counts) in zip(
+            edges_to_register, edge_outputs
+        ):
+            data_key = self._edge_data_key(reg_edge)
+
+            if iteration_counts:
+                n_max = sum(
+                    c["max_iterations"]
+                    for mc in iteration_counts.values()
+                    for c in mc.values()
+                )
+                n_calibrated = sum(
+                    c["calibrated_iterations"]
+                    for mc in iteration_counts.values()
+                    for c in mc.values()
+                )
+                print(
+                    f"{data_key} registered with {n_calibrated} of {n_max} "
+                    "iterations after convergence calibration"
                 )
 
-                reg_edge["registered"] = True
-                data_key = f'{reg_edge["modalities"]["source"]}_to_{reg_edge["modalities"]["target"]}'
+            if elastix_output_path is None:
+                continue
 
-                all_transform_data = read_elastix_transform_dir(output_path)
-                all_iteration_data = read_elastix_iteration_dir(output_path)
+            all_transform_data = read_elastix_transform_dir(
+                elastix_output_path
+            )
+            all_iteration_data = read_elastix_iteration_dir(
+                elastix_output_path
+            )
+
+            if self.diagnostics == "compact":
+                shutil.rmtree(elastix_output_path, ignore_errors=True)
+
+            if n_reused > 0:
+                all_transform_data = {
+                    k + n_reused: v for k, v in all_transform_data.items()
+                }
+                all_iteration_data = {
+                    k + n_reused: v for k, v in all_iteration_data.items()
+                }
+
+            for model_idx, model_counts in iteration_counts.items():
+                for res_idx, res_counts in model_counts.items():
+                    if res_idx in all_iteration_data.get(model_idx, dict()):
+                        all_iteration_data[model_idx][res_idx].update(
+                            {k: np.asarray(v) for k, v in res_counts.items()}
+                        )
+
+            if self.diagnostics == "full":
                 write_iteration_plots(
-                    all_iteration_data, data_key, output_path
+                    all_iteration_data, data_key, elastix_output_path
                 )
 
-                self.registration_iter_data.update(
-                    {data_key: all_iteration_data}
+            if n_reused > 0:
+                prev_transform_data = self.registration_tform_data.get(
+                    data_key, dict()
                 )
-                self.registration_tform_data.update(
-                    {data_key: all_transform_data}
+                prev_iteration_data = self.registration_iter_data.get(
+                    data_key, dict()
+                )
+                all_transform_data.update(
+                    {
+                        k: v
+                        for k, v in prev_transform_data.items()
+                        if k < n_reused
+                    }
                 )
+                all_iteration_data.update(
+                    {
+                        k: v
+                        for k, v in prev_iteration_data.items()
+                        if k < n_reused
+                    }
+                )
+
+            if self.diagnostics == "compact":
+                write_iteration_npz(
+                    all_iteration_data,
+                    all_transform_data,
+                    self._edge_output_path(reg_edge) / "IterationData.npz",
+                )
+
+            self.registration_iter_data.update({data_key: all_iteration_data})
+            self.registration_tform_data.update({data_key: all_transform_data})
 
         self.transformations = self.reg_graph_edges
 
@@ -854,11 +1372,32 @@ class WsiReg2D(object):
     def _generate_reg_transforms(self):
         self._reg_graph_edges["reg_transforms"]
 
+    def _collapse_linear_modalities(self) -> List[str]:
+        """Modalities of registration stacks whose linear transforms are merged."""
+        collapse_modalities = []
+        for stack_data in self.reg_stacks.values():
+            if stack_data.get("collapse_linear"):
+                collapse_modalities.extend(stack_data["modalities"])
+        return collapse_modalities
+
     def _collate_transformations(self):
         transforms = dict()
         edge_modality_pairs = [v['modalities'] for v in self.reg_graph_edges]
+        collapse_modalities = self._collapse_linear_modalities()
+
         for modality, tform_edges in self.transform_paths.items():
-            full_tform_seq = RegTransformSeq()
+            # gather the full chain first and build the sequence once rather than
+            # rebuilding the composite transform for every appended edge
+            seq_transforms = []
+            seq_idx = []
+
+            def extend_seq(rt_seq):
+                reindex_val = np.max(seq_idx) + 1 if seq_idx else 0
+                seq_transforms.extend(rt_seq.reg_transforms)
+                seq_idx.extend(
+                    [int(i + reindex_val) for i in rt_seq.transform_seq_idx]
+                )
+
             for idx, tform_edge in enumerate(tform_edges):
                 reg_edge_tforms = self.reg_graph_edges[
                     edge_modality_pairs.index(tform_edge)
@@ -873,14 +1412,22 @@ class WsiReg2D(object):
                         ],
                     }
                     if reg_edge_tforms['initial']:
-                        full_tform_seq.append(reg_edge_tforms['initial'])
-                    full_tform_seq.append(reg_edge_tforms['registration'])
+                        extend_seq(reg_edge_tforms['initial'])
+                    extend_seq(reg_edge_tforms['registration'])
                 else:
                     transforms[modality][
                         f"{str(idx).zfill(3)}-to-{tform_edges[idx]['target']}"
                     ] = reg_edge_tforms['registration']
-                    full_tform_seq.append(reg_edge_tforms['registration'])
-
+                    extend_seq(reg_edge_tforms['registration'])
+
+            if seq_transforms:
+                full_tform_seq = RegTransformSeq(seq_transforms, seq_idx)
+                if modality in collapse_modalities:
+                    collapsed_tforms = full_tform_seq.reg_transforms_simplified
+                    full_tform_seq = RegTransformSeq(
+                        collapsed_tforms,
+                        transform_seq_idx=list(range(len(collapsed_tforms))),
+                    )
                 transforms[modality]["full-transform-seq"] = full_tform_seq
 
         return transforms
@@ -1044,9 +1591,46 @@ class WsiReg2D(object):
 
         return im_data, transformations, output_path
 
+    def _bake_transformations(
+        self,
+        transformations: Optional[RegTransformSeq],
+        bake_grid_factor: Optional[int] = None,
+    ) -> Optional[RegTransformSeq]:
+        """Bake a transformation sequence with non-linear transforms into a displacement field,
+        shared through a zarr cache by all images written to the same output space. Returns
+        the baked copy, `transformations` keeps the exact transforms."""
+        if not bake_grid_factor or transformations is None:
+            return transformations
+        if all(t.is_linear for t in transformations.reg_transforms):
+            return transformations
+
+        dfield_cache = _dfield_cache_dir(self)
+        dfield_cache.mkdir(parents=False, exist_ok=True)
+        (
+            baked_transformations,
+            max_error,
+        ) = transformations.bake_displacement_field(
+            grid_factor=bake_grid_factor,
+            zarr_path=dfield_cache
+            / f"{transformations.transforms_digest}.zarr",
+        )
+        print(
+            "transforms baked into displacement field, "
+            f"max. deviation: {max_error:.4f}"
+        )
+        return baked_transformations
+
     def _transform_write_image(
-        self, im_data, transformations, output_path, file_writer="ome.tiff"
+        self,
+        im_data,
+        transformations,
+        output_path,
+        file_writer="ome.tiff",
+        bake_grid_factor=None,
     ):
+        transformations = self._bake_transformations(
+            transformations, bake_grid_factor
+        )
 
         tfregimage = reg_image_loader(
             im_data["image_filepath"],
@@ -1059,26 +1643,57 @@ class WsiReg2D(object):
             tfregimage, reg_transform_seq=transformations
         )
 
-        if (
-            file_writer == "ome.tiff-bytile"
-            and ometiffwriter.reg_image.reader not in ["czi", "sitk"]
+        tile_size, zarr_tile_size = 512, 2048
+        if file_writer == "auto":
+            writer_choice = choose_file_writer(tfregimage, transformations)
+            file_writer = writer_choice.file_writer
+            tile_size = writer_choice.tile_size
+            zarr_tile_size = writer_choice.zarr_tile_size
+        elif (
+            file_writer in ["ome.zarr", "ome.tiff-bytile"]
+            and tfregimage.reader in PLANE_ONLY_READERS
         ):
-            ometiffwriter = OmeTiffTiledWriter(
+            print(
+                f"{file_writer} is not supported for the {tfregimage.reader} reader, "
+                "writing ome.tiff plane-by-plane"
+            )
+            file_writer = "ome.tiff"
+
+        if file_writer == "ome.zarr":
+            omezarrwriter = OmeZarrWriter(
                 tfregimage, reg_transform_seq=transformations
             )
+            im_fp = omezarrwriter.write_image(
+                output_path.stem,
+                output_dir=str(self.output_dir),
+            )
+        elif file_writer == "ome.tiff-bytile":
+            ometiffwriter = OmeTiffTiledWriter(
+                tfregimage,
+                reg_transform_seq=transformations,
+                tile_size=tile_size,
+                zarr_tile_size=zarr_tile_size,
+            )
             im_fp = ometiffwriter.write_image_by_tile(
                 output_path.stem,
                 output_dir=str(self.output_dir),
+                stream=True,
             )
         else:
             im_fp = ometiffwriter.write_image_by_plane(
                 output_path.stem,
                 output_dir=str(self.output_dir),
+                tile_size=tile_size,
             )
 
         return im_fp
 
-    def _transform_write_merge_images(self, to_original_size=True):
+    def _transform_write_merge_images(
+        self,
+        to_original_size=True,
+        bake_grid_factor=None,
+        file_writer="ome.tiff",
+    ):
         def determine_attachment(sub_image):
             if sub_image in self.attachment_images.keys():
                 attachment_modality = self.attachment_images[sub_image]
@@ -1132,7 +1747,11 @@ class WsiReg2D(object):
                         to_original_size=to_original_size,
                     )
 
-                transformations.append(sub_im_transforms)
+                transformations.append(
+                    self._bake_transformations(
+                        sub_im_transforms, bake_grid_factor
+                    )
+                )
 
         output_path = self.output_dir / "{}-{}_merged-registered".format(
             self.project_name,
@@ -1149,19 +1768,55 @@ class WsiReg2D(object):
             merge_regimage, reg_transform_seqs=transformations
         )
 
-        im_fp = merge_ometiffwriter.merge_write_image_by_plane(
-            output_path.stem,
-            sub_images,
-            output_dir=str(self.output_dir),
-        )
+        tile_size, zarr_tile_size = 512, 2048
+        if file_writer == "auto":
+            writer_choice = choose_merge_file_writer(
+                merge_regimage.images, transformations
+            )
+            file_writer = writer_choice.file_writer
+            tile_size = writer_choice.tile_size
+            zarr_tile_size = writer_choice.zarr_tile_size
+        elif file_writer == "ome.tiff-bytile" and any(
+            im.reader in PLANE_ONLY_READERS for im in merge_regimage.images
+        ):
+            plane_only_readers = sorted(
+                {
+                    im.reader
+                    for im in merge_regimage.images
+                    if im.reader in PLANE_ONLY_READERS
+                }
+            )
+            print(
+                "ome.tiff-bytile is not supported for the "
+                f"{', '.join(plane_only_readers)} reader, writing the merged image "
+                "ome.tiff plane-by-plane"
+            )
+            file_writer = "ome.tiff"
+
+        if file_writer == "ome.tiff-bytile":
+            im_fp = merge_ometiffwriter.merge_write_image_by_tile(
+                output_path.stem,
+                sub_images,
+                output_dir=str(self.output_dir),
+                tile_size=tile_size,
+                zarr_tile_size=zarr_tile_size,
+            )
+        else:
+            im_fp = merge_ometiffwriter.merge_write_image_by_plane(
+                output_path.stem,
+                sub_images,
+                output_dir=str(self.output_dir),
+            )
         return im_fp
 
+    @_removes_dfield_cache
     def transform_images(
         self,
         file_writer="ome.tiff",
         transform_non_reg=True,
         remove_merged=True,
         to_original_size=True,
+        bake_grid_factor=None,
     ):
         """
         Transform and write images to disk after registration. Also transforms all attachment images
@@ -1169,8 +1824,11 @@ class WsiReg2D(object):
         Parameters
         ----------
         file_writer : str
-            output type to use, sitk writes a single resolution tiff, "zarr" writes an ome-zarr multiscale
-            zarr store
+            output type to use, "ome.tiff" writes a pyramidal OME-TIFF plane-by-plane,
+            "ome.tiff-bytile" writes it tile-by-tile, merged images included, "ome.zarr" writes
+            an OME-Zarr (NGFF) multiscale store tile-by-tile and "auto" chooses between
+            "ome.tiff" and "ome.tiff-bytile" and their tile sizes for each image from the estimated
+            peak memory, the memory budget (see `set_resource_limits`) and the cost of each writer
         transform_non_reg : bool
             whether to write the images that aren't transformed during registration as well
         remove_merged: bool
@@ -1178,6 +1836,10 @@ class WsiReg2D(object):
             will not be written as individual images as well
         to_original_size: bool
             write images that have been cropped for registration back to their original coordinate space
+        bake_grid_factor: int
+            bake transformations with non-linear transforms into a displacement field on a grid this
+            many times coarser than the output grid (see RegTransformSeq.bake_displacement_field),
+            computed once and reused by all images written to the same output space
         """
         image_fps = []
 
@@ -1222,6 +1884,7 @@ class WsiReg2D(object):
                     transformations,
                     output_path,
                     file_writer=file_writer,
+                    bake_grid_factor=bake_grid_factor,
                 )
                 image_fps.append(im_fp)
 
@@ -1259,12 +1922,15 @@ class WsiReg2D(object):
                     transformations,
                     output_path,
                     file_writer=file_writer,
+                    bake_grid_factor=bake_grid_factor,
                 )
                 image_fps.append(im_fp)
 
             if len(self.merge_modalities.items()) > 0:
                 im_fp = self._transform_write_merge_images(
-                    to_original_size=to_original_size
+                    to_original_size=to_original_size,
+                    bake_grid_factor=bake_grid_factor,
+                    file_writer=file_writer,
                 )
                 image_fps.append(im_fp)
 
@@ -1287,14 +1953,21 @@ class WsiReg2D(object):
                     transformations,
                     output_path,
                     file_writer=file_writer,
+                    bake_grid_factor=bake_grid_factor,
                 )
                 image_fps.append(im_fp)
 
         return image_fps
 
-    def transform_shapes(self):
+    def transform_shapes(self, inverse_grid_factor: int = 1):
         """
         Transform all attached shapes and write out shape data to geoJSON.
+
+        Parameters
+        ----------
+        inverse_grid_factor: int
+            invert non-linear transforms on a displacement field grid this many times coarser
+            than the registration grid, trading sub-pixel accuracy for much less memory and time
         """
         transformed_shapes_fps = []
 
@@ -1305,7 +1978,8 @@ class WsiReg2D(object):
                 invert_nonrigid_transforms(
                     self.transformations[attachment_modality][
                         "full-transform-seq"
-                    ].reg_transforms_itk_order
+                    ].reg_transforms_itk_order,
+                    grid_factor=inverse_grid_factor,
                 )
             else:
                 continue
@@ -1402,10 +2076,40 @@ class WsiReg2D(object):
 
         return tform_txt
 
-    def save_transformations(self):
+    def _write_transformations(
+        self, tform_txt: Dict[str, Any], output_stem: str, file_format: str
+    ) -> None:
+        if file_format in ["json", "both"]:
+            output_path = self.output_dir / f"{output_stem}.json"
+            tform_txt_json = {
+                k: elastix_transform_to_txt(v)
+                if isinstance(v, dict)
+                else [elastix_transform_to_txt(t) for t in v]
+                for k, v in tform_txt.items()
+            }
+            with open(output_path, 'w') as fp:
+                json.dump(tform_txt_json, fp, indent=1)
+
+        if file_format in ["npz", "both"]:
+            write_wsireg_transform_npz(
+                tform_txt, self.output_dir / f"{output_stem}.npz"
+            )
+
+    def save_transformations(self, file_format: str = "json"):
         """
-        Save all transformations for a given modality as JSON
+        Save all transformations for a given modality as JSON and/or binary .npz
+
+        Parameters
+        ----------
+        file_format: str
+            "json" for elastix-style text, "npz" for float64 arrays with a JSON header that loads
+            without parsing B-spline coefficients from text, or "both"
         """
+        if file_format not in TRANSFORM_FILE_FORMATS:
+            raise ValueError(
+                f"file_format must be one of {TRANSFORM_FILE_FORMATS}, got {file_format}"
+            )
+
         if all(
             [reg_edge.get("registered") for reg_edge in self.reg_graph_edges]
         ):
@@ -1413,18 +2117,16 @@ class WsiReg2D(object):
 
                 final_modality = self.reg_paths[key][-1]
 
-                output_path = (
-                    self.output_dir
-                    / "{}-{}_to_{}_transformations.json".format(
-                        self.project_name,
-                        key,
-                        final_modality,
-                    )
+                output_stem = "{}-{}_to_{}_transformations".format(
+                    self.project_name,
+                    key,
+                    final_modality,
                 )
                 tform_txt = self._transforms_to_txt(self.transformations[key])
 
-                with open(output_path, 'w') as fp:
-                    json.dump(tform_txt, fp, indent=1)
+                self._write_transformations(
+                    tform_txt, output_stem, file_format
+                )
 
             for (
                 modality,
@@ -1434,21 +2136,19 @@ class WsiReg2D(object):
 
                     final_modality = self.reg_paths[attachment_modality][-1]
 
-                    output_path = (
-                        self.output_dir
-                        / "{}-{}_to_{}_transformations.json".format(
-                            self.project_name,
-                            modality,
-                            final_modality,
-                        )
+                    output_stem = "{}-{}_to_{}_transformations".format(
+                        self.project_name,
+                        modality,
+                        final_modality,
                     )
 
                     tform_txt = self._transforms_to_txt(
                         self.transformations[key]
                     )
 
-                    with open(output_path, 'w') as fp:
-                        json.dump(tform_txt, fp, indent=4)
+                    self._write_transformations(
+                        tform_txt, output_stem, file_format
+                    )
         else:
             warn(
                 "registration has not been executed for the graph "
@@ -1501,6 +2201,20 @@ class WsiReg2D(object):
             print(
                 "warning: config file did not contain any registration paths"
             )
+        if reg_config.get("reg_stacks"):
+            for key, val in reg_config["reg_stacks"].items():
+                # stacks saved by save_config already have their paths in reg_paths
+                if any(m in self.reg_paths for m in val.get("modalities")):
+                    self.reg_stacks[key] = val
+                else:
+                    self.add_reg_stack(
+                        key,
+                        val.get("modalities"),
+                        reference_idx=val.get("reference_idx", 0),
+                        reg_params=val.get("reg_params", ["rigid"]),
+                        collapse_linear=val.get("collapse_linear", True),
+                    )
+
         if reg_config.get("attachment_images"):
 
             for key, val in reg_config["attachment_images"].items():
@@ -1529,6 +2243,30 @@ class WsiReg2D(object):
             for mn, mm in reg_config["merge_modalities"].items():
                 self.add_merge_modalities(mn, mm)
 
+    def update_reg_params(
+        self,
+        modality: str,
+        reg_params: Union[str, RegModel, List[str], List[RegModel]],
+    ) -> None:
+        """
+        Change the registration parameters of the edge where `modality` is the source
+        and mark it to be registered again.
+
+        Parameters
+        ----------
+        modality: str
+            source modality of the registration edge
+        reg_params: list of RegModel/str or str
+            Elastix registration parameters, from RegModel or as a string corresponding to one of the parameter
+            maps enumerated in wsireg.parameter_maps.reg_params.RegModel
+        """
+        edge_keys = [
+            r.get("modalities").get("source") for r in self.reg_graph_edges
+        ]
+        modality_idx = edge_keys.index(modality)
+        self.reg_graph_edges[modality_idx]["params"] = reg_params
+        self.reg_graph_edges[modality_idx]["registered"] = False
+
     def reset_registered_modality(self, modalities):
         edge_keys = [
             r.get("modalities").get("source") for r in self.reg_graph_edges
@@ -1553,6 +2291,13 @@ class WsiReg2D(object):
 
         [self.merge_modalities.pop(k) for k in to_rm]
 
+        to_rm = []
+        for stack_name, stack_data in self.reg_stacks.items():
+            if modality in stack_data["modalities"]:
+                to_rm.append(stack_name)
+
+        [self.reg_stacks.pop(k) for k in to_rm]
+
         self.n_modalities = len(self.modality_names)
 
         if modality in self.attachment_images.keys():
@@ -1641,6 +2386,9 @@ def wsireg_run(
     remove_merged: bool = True,
     file_writer: str = "ome.tiff",
     testing: bool = False,
+    n_threads: Optional[int] = None,
+    memory_limit: Optional[Union[int, str]] = None,
+    transform_file_format: str = "json",
 ):
     def config_to_WsiReg2D(config_filepath):
         reg_config = parse_check_reg_config(config_filepath)
@@ -1658,12 +2406,15 @@ def wsireg_run(
     elif isinstance(graph_configuration, WsiReg2D):
         reg_graph = graph_configuration
 
+    if n_threads is not None or memory_limit is not None:
+        reg_graph.set_resource_limits(n_threads, memory_limit)
+
     if testing:
         temp_dir = str(tempfile.mkdtemp())
         reg_graph.setup_project_output(reg_graph.project_name, temp_dir)
 
     reg_graph.register_images()
-    reg_graph.save_transformations()
+    reg_graph.save_transformations(file_format=transform_file_format)
     output_data = []
     if write_images:
         output_images = reg_graph.transform_images(
@@ -1705,7 +2456,8 @@ def main():
     parser.add_argument(
         "--fw",
         type=str,
-        help="how to write output registered images: ome.tiff, ome.zarr (default: ome.tiff)",
+        help="how to write output registered images: ome.tiff, ome.tiff-bytile, ome.zarr, "
+        "auto (default: ome.tiff)",
     )
 
     parser.add_argument('--write_im', dest='write_im', action='store_true')
@@ -1732,6 +2484,25 @@ def main():
         '--to_cropped', dest='to_original_size', action='store_false'
     )
     parser.add_argument('--testing', dest='testing', action='store_true')
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="maximum number of threads used for registration and writing (default: all CPUs)",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        dest="memory_limit",
+        type=str,
+        help="memory budget for writing, i.e., 16GB (default: no limit)",
+    )
+    parser.add_argument(
+        "--tform_format",
+        dest="transform_file_format",
+        type=str,
+        choices=["json", "npz", "both"],
+        default="json",
+        help="file format of saved transformations: json, npz or both (default: json)",
+    )
 
     parser.set_defaults(
         write_im=True,
@@ -1757,6 +2528,9 @@ def main():
         remove_merged=args.remove_merged,
         file_writer=file_writer,
         testing=args.testing,
+        n_threads=args.threads,
+        memory_limit=args.memory_limit,
+        transform_file_format=args.transform_file_format,
     )
 
 